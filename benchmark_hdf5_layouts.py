@@ -0,0 +1,133 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import time
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from data.sdd_dataloader import HDF5PresavedDatasetSDD
+from save_hdf5_dataset import rewrite_hdf5_dataset, unbatched_collate
+from utils.config import Config
+
+from typing import Dict
+
+
+# layout name --> storage options (see save_hdf5_dataset.apply_storage_options)
+LAYOUTS = {
+    'baseline': {},
+    'lzf': {'compression': 'lzf', 'shuffle': True},
+    'gzip_1': {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+    'gzip_4': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+    'lzf_float16': {'compression': 'lzf', 'shuffle': True, 'float16': True},
+    'lzf_large_chunks': {
+        'compression': 'lzf', 'shuffle': True,
+        'chunks': {'identities': 4096, 'trajectories': 256, 'true_trajectories': 256, 'observation_mask': 512,
+                   'true_observation_mask': 512, 'observed_velocities': 256, 'velocities': 256,
+                   'occlusion_map': 16, 'last_obs_indices': 4096,
+                   'obs_sequence_indices': 8192, 'pred_sequence_indices': 8192}
+    },
+}
+
+
+def make_dataset(args: argparse.Namespace, hdf5_file: str) -> HDF5PresavedDatasetSDD:
+    data_cfg = Config(cfg_id=args.cfg)
+    data_cfg.__setattr__('with_rgb_map', False)
+    data_cfg.__setattr__('hdf5_file', hdf5_file)
+    data_cfg.__setattr__('preload', False)
+    data_cfg.__setattr__('difficult', False)
+    data_cfg.__setattr__('subset', None)
+    data_cfg.__setattr__('custom_dataset_size', None)
+    return HDF5PresavedDatasetSDD(parser=data_cfg, split=args.split, legacy_mode=args.legacy)
+
+
+def random_access_latencies(dataset: HDF5PresavedDatasetSDD, n_instances: int, seed: int = 0) -> np.ndarray:
+    indices = np.random.default_rng(seed).integers(0, len(dataset), size=n_instances)
+    latencies = np.empty(n_instances)
+    for i, idx in enumerate(tqdm(indices, desc='random access', leave=False)):
+        start = time.perf_counter()
+        dataset.__getitem__(int(idx))
+        latencies[i] = time.perf_counter() - start
+    return latencies        # [s]
+
+
+def sequential_throughput(dataset: HDF5PresavedDatasetSDD, n_instances: int, num_workers: int) -> float:
+    loader = DataLoader(
+        dataset=Subset(dataset, range(min(n_instances, len(dataset)))), shuffle=False, num_workers=num_workers,
+        collate_fn=unbatched_collate
+    )
+    start = time.perf_counter()
+    n_read = sum(1 for _ in tqdm(loader, desc='sequential scan', leave=False))
+    return n_read / (time.perf_counter() - start)      # [instances / s]
+
+
+def benchmark_layout(args: argparse.Namespace, hdf5_file: str) -> Dict:
+    # the random access benchmark is run first, on a freshly opened file
+    latencies = random_access_latencies(dataset=make_dataset(args, hdf5_file), n_instances=args.n_random)
+    throughput = sequential_throughput(
+        dataset=make_dataset(args, hdf5_file), n_instances=args.n_sequential, num_workers=args.num_workers
+    )
+    return {
+        'file_size_MB': os.path.getsize(hdf5_file) * 1e-6,
+        'latency_mean_ms': latencies.mean() * 1e3,
+        'latency_median_ms': np.median(latencies) * 1e3,
+        'latency_p95_ms': np.percentile(latencies, 95) * 1e3,
+        'scan_instances_per_s': throughput,
+    }
+
+
+def main(args: argparse.Namespace):
+    assert all(layout in LAYOUTS.keys() for layout in args.layouts), f"Available layouts: {[*LAYOUTS.keys()]}"
+
+    source_path = args.source_path
+    if source_path is None:
+        source_path = make_dataset(args, hdf5_file=None).hdf5_file
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = os.path.join(os.path.dirname(source_path), 'layout_benchmark')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = dict()
+    for layout in args.layouts:
+        layout_path = os.path.join(work_dir, f'{layout}.h5')
+        if not os.path.exists(layout_path):
+            print(f"Writing the \'{layout}\' layout under:\n{layout_path}")
+            rewrite_hdf5_dataset(source_path=source_path, save_path=layout_path, storage_options=LAYOUTS[layout])
+
+        print(f"Benchmarking the \'{layout}\' layout")
+        results[layout] = benchmark_layout(args, hdf5_file=layout_path)
+
+    results_df = pd.DataFrame.from_dict(results, orient='index')
+    print(f"\nSource dataset file:\n{source_path}\n")
+    print(results_df.to_string(float_format=lambda x: f'{x:.3f}'))
+
+    if args.save_csv is not None:
+        print(f"\nSaving results under:\n{args.save_csv}")
+        results_df.to_csv(args.save_csv)
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, required=True, default=None,
+                        help="Dataset config file (specified as either name or path")
+    parser.add_argument('--split', type=str, default='test',
+                        help="\'train\' | \'val\' | \'test\'")
+    parser.add_argument('--legacy', action='store_true', default=False)
+    parser.add_argument('--source_path', type=os.path.abspath, default=None,
+                        help="dataset file to benchmark (by default, the dataset file of --cfg and --split).")
+    parser.add_argument('--work_dir', type=os.path.abspath, default=None,
+                        help="where to write the dataset file copies (by default, next to the source file). "
+                             "Place this directory on the storage you wish to benchmark.")
+    parser.add_argument('--layouts', nargs='+', default=[*LAYOUTS.keys()],
+                        help=f"layouts to benchmark, among: {[*LAYOUTS.keys()]}")
+    parser.add_argument('--n_random', type=int, default=1000,
+                        help="number of randomly accessed instances.")
+    parser.add_argument('--n_sequential', type=int, default=5000,
+                        help="number of instances read during the sequential scan.")
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--save_csv', type=os.path.abspath, default=None)
+    args = parser.parse_args()
+
+    main(args=args)
+    print("Goodbye!")
@@ -0,0 +1,102 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from utils.config import REPO_ROOT
+
+from typing import Dict, List
+
+
+# scripts whose start-up time is measured (paths relative to the repository root)
+SCRIPTS = [
+    'train.py',
+    'save_predictions.py',
+    'model_eval.py',
+    'save_hdf5_dataset.py',
+    'save_subset_indices.py',
+    'benchmark_hdf5_layouts.py',
+    'parameter_count.py',
+    'export_model.py',
+    'prune_model.py',
+    'plot_loss_graph.py',
+    'visualize_dataset.py',
+    'performance_analysis/performance_summary.py',
+    'performance_analysis/boxplots.py',
+    'performance_analysis/occlusion_score_histograms.py',
+    'performance_analysis/prediction_groups_statistics.py',
+    'performance_analysis/ttest.py',
+    'performance_analysis/variant_comparison.py',
+    'performance_analysis/qualitative_example.py',
+]
+BASELINE_COMMAND = ['-c', 'import torch']
+
+
+def run_command(command: List[str]) -> subprocess.CompletedProcess:
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([REPO_ROOT, os.environ.get('PYTHONPATH', '')])}
+    return subprocess.run(
+        [sys.executable, *command], cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+
+
+def startup_times(command: List[str], n_runs: int) -> np.ndarray:
+    times = np.empty(n_runs)
+    for i in range(n_runs):
+        start = time.perf_counter()
+        process = run_command(command)
+        times[i] = time.perf_counter() - start
+        assert process.returncode == 0, f"{' '.join(command)} failed:\n{process.stderr}"
+    return times        # [s]
+
+
+def slowest_imports(script: str, n_imports: int) -> List[Dict]:
+    # cumulative import times of the top level packages imported by the script (python -X importtime)
+    process = run_command(['-X', 'importtime', script, '--help'])
+    imports = dict()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit() or name.startswith('  '):
+            continue
+        imports[name.strip()] = int(cumulative) * 1e-3        # [ms]
+    return [
+        {'package': name, 'cumulative_ms': cumul}
+        for name, cumul in sorted(imports.items(), key=lambda item: -item[1])[:n_imports]
+    ]
+
+
+def main(args: argparse.Namespace):
+    assert all(script in SCRIPTS for script in args.scripts), f"Available scripts: {SCRIPTS}"
+
+    baseline = float(np.median(startup_times(BASELINE_COMMAND, n_runs=args.n_runs)))
+    print(f"Python interpreter + torch import: {baseline * 1e3:.0f}ms (median over {args.n_runs} runs)\n")
+
+    # every script is only started, and exits right after parsing its arguments (--help)
+    print(f"{'script':<55}{'median [ms]':>14}{'beyond torch [ms]':>20}")
+    for script in args.scripts:
+        median = float(np.median(startup_times([script, '--help'], n_runs=args.n_runs)))
+        print(f"{script:<55}{median * 1e3:>14.0f}{(median - baseline) * 1e3:>20.0f}")
+
+        if args.n_imports > 0:
+            for row in slowest_imports(script, n_imports=args.n_imports):
+                print(f"    {row['package']:<51}{row['cumulative_ms']:>14.0f}")
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scripts', nargs='+', default=SCRIPTS,
+                        help="scripts whose start-up time is measured (by default, all of them).")
+    parser.add_argument('--n_runs', type=int, default=5,
+                        help="number of times each script is started.")
+    parser.add_argument('--n_imports', type=int, default=0,
+                        help="additionally list the <n_imports> slowest top level imports of every script.")
+    args = parser.parse_args()
+
+    main(args=args)
+    print("Goodbye!")
@@ -0,0 +1,147 @@
+import numpy as np
+import torch
+import torch.nn.functional as fctl
+
+from data.map import parse_map_pyramid_key
+
+from typing import Dict, Optional
+Tensor = torch.Tensor
+
+
+class BatchedRandomRotation:
+    """
+    Random rotation of whole batches of collated instances, applied after the DataLoader.
+
+    Every instance of the batch is rotated by its own random angle, about the origin of the metric coordinate system
+    (which coincides with the center of the occlusion maps). Points are rotated with a single batched matrix product,
+    and all the maps of the batch are resampled with a single affine_grid / grid_sample call per map resolution.
+
+    The rotation follows the same conventions as MapManager.rotate_around_center: a rotation of theta degrees
+    rotates the points by -theta radians (the image reference frame is reversed).
+    The areas rotated into the maps from outside their bounds are filled with zeros, as with the rotations of
+    MapManager: black in scene maps, not visible in occlusion maps, and zero distance in distance-transformed maps
+    (rather than replicating their border pixels, which would extend occluded / visible regions).
+    The rotation angle applied to each instance is stored under 'augmentation_theta' [degrees], the presaved
+    'theta' and 'center_point' of the scene map are left untouched.
+    """
+
+    position_keys = [
+        'trajectories', 'true_trajectories', 'obs_position_sequence', 'pred_position_sequence',
+        'last_obs_positions', 'ego', 'occluder'
+    ]
+    velocity_keys = ['velocities', 'observed_velocities', 'obs_velocity_sequence', 'pred_velocity_sequence']
+    map_keys = {        # map name --> interpolation mode
+        'occlusion_map': 'nearest',
+        'dist_transformed_occlusion_map': 'bilinear',
+        'clipped_dist_transformed_occlusion_map': 'bilinear',
+        'scene_map': 'bilinear',
+    }
+
+    def __init__(self, max_angle: float = 360.):
+        self.max_angle = max_angle      # [degrees]
+
+    def sample_angles(self, batch_size: int) -> Tensor:     # [B]
+        return torch.rand(batch_size, dtype=torch.float64) * self.max_angle
+
+    @staticmethod
+    def rotation_matrices(
+            theta: Tensor       # [B]
+    ) -> Tensor:                # [B, 2, 2]
+        theta = -theta * np.pi / 180
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        return torch.stack([torch.stack([cos, -sin], dim=-1), torch.stack([sin, cos], dim=-1)], dim=-2)
+
+    @staticmethod
+    def rotate_points(
+            points: Tensor,         # [B, *, 2]
+            rotation: Tensor        # [B, 2, 2]
+    ) -> Tensor:                    # [B, *, 2]
+        rotation = rotation.to(points.dtype).view(points.shape[0], *([1] * (points.dim() - 2)), 2, 2)
+        return (rotation @ points.unsqueeze(-1)).squeeze(-1)
+
+    @staticmethod
+    def rotate_maps(
+            maps: Tensor,           # [B, C, H, W]
+            rotation: Tensor,       # [B, 2, 2]
+            mode: str = 'bilinear'
+    ) -> Tensor:                    # [B, C, H, W]
+        # the output pixel at (normalized) coordinates q samples the input map at R^-1 q, with R^-1 = R^T.
+        # the maps are square, normalized and pixel coordinates are therefore related by an isotropic scaling.
+        affine = torch.zeros([maps.shape[0], 2, 3], dtype=maps.dtype, device=maps.device)       # [B, 2, 3]
+        affine[:, :, :2] = rotation.transpose(-1, -2).to(maps.dtype)
+        grid = fctl.affine_grid(affine, size=list(maps.shape), align_corners=False)            # [B, H, W, 2]
+        return fctl.grid_sample(maps, grid, mode=mode, padding_mode='zeros', align_corners=False)
+
+    @staticmethod
+    def rotate_homographies(
+            homography: Tensor,     # [B, 3, 3]
+            rotation: Tensor,       # [B, 2, 2]
+            map_dims: torch.Size    # [H, W]
+    ) -> Tensor:                    # [B, 3, 3]
+        # the maps are rotated about their center pixel coordinate, and the points about the metric origin:
+        # new_homography = R_center @ homography @ R^-1
+        batch_size = homography.shape[0]
+        rotation = rotation.to(device=homography.device, dtype=homography.dtype)
+        center = torch.tensor(
+            [map_dims[1], map_dims[0]], dtype=homography.dtype, device=homography.device
+        ) * 0.5                                                                             # [2]
+
+        points_rotation = torch.eye(
+            3, dtype=homography.dtype, device=homography.device
+        ).repeat(batch_size, 1, 1)                                                          # [B, 3, 3]
+        points_rotation[:, :2, :2] = rotation
+
+        map_rotation = points_rotation.clone()                                              # [B, 3, 3]
+        map_rotation[:, :2, 2] = center - (rotation @ center.unsqueeze(-1)).squeeze(-1)
+        return map_rotation @ homography @ points_rotation.transpose(-1, -2)
+
+    def __call__(self, data: Dict, theta: Optional[Tensor] = None) -> Dict:
+        batch_size = data['identities'].shape[0]
+        if theta is None:
+            theta = self.sample_angles(batch_size=batch_size)       # [B]
+        rotation = self.rotation_matrices(theta=theta)              # [B, 2, 2]
+
+        for key in self.position_keys + self.velocity_keys:
+            if data.get(key, None) is not None:
+                data[key] = self.rotate_points(points=data[key], rotation=rotation)
+
+        map_dims = None
+        # the maps (and their downsampled versions, see data.map.map_pyramid_key) are grouped by resolution
+        map_groups = dict()
+        for key in data.keys():
+            base_key, level = parse_map_pyramid_key(key)
+            if base_key in self.map_keys and data[key] is not None:
+                map_groups.setdefault(tuple(data[key].shape[-2:]), []).append((key, base_key))
+                if map_dims is None or level == 0:
+                    # (the homography relates to the full resolution maps)
+                    map_dims = torch.Size([dim * 2 ** level for dim in data[key].shape[-2:]])
+
+        for group in map_groups.values():
+            # stacking all maps of a resolution along the channel dimension, and resampling them all at once
+            maps = [data[key] for key, _ in group]
+            channels = [map_tensor.shape[1] if map_tensor.dim() == 4 else 1 for map_tensor in maps]
+            stacked_maps = torch.cat(
+                [map_tensor.view(batch_size, -1, *map_tensor.shape[-2:]).to(torch.float32) for map_tensor in maps],
+                dim=1
+            )                                                       # [B, C_total, H, W]
+
+            modes = {self.map_keys[base_key] for _, base_key in group}
+            rotated_maps = {
+                mode: self.rotate_maps(maps=stacked_maps, rotation=rotation, mode=mode) for mode in modes
+            }
+
+            start = 0
+            for (key, base_key), map_tensor, n_channels in zip(group, maps, channels):
+                rotated = rotated_maps[self.map_keys[base_key]][:, start:start + n_channels]
+                start += n_channels
+                if map_tensor.dtype == torch.bool:
+                    rotated = rotated > 0.5
+                data[key] = rotated.view(map_tensor.shape).to(map_tensor.dtype)
+
+        if data.get('map_homography', None) is not None and map_dims is not None:
+            data['map_homography'] = self.rotate_homographies(
+                homography=data['map_homography'], rotation=rotation, map_dims=map_dims
+            )
+
+        data['augmentation_theta'] = theta
+        return data
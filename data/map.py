@@ -1,14 +1,15 @@
-import cv2
 import numpy as np
-from matplotlib.path import Path
 import os
-from scipy.ndimage import distance_transform_edt
 import torch
 import torch.nn.functional as fctl
-import torchvision.transforms.functional
-from PIL import Image
 
-from typing import Callable, Optional
+# cv2, matplotlib, scipy, torchvision and PIL are imported where they are used, so that importing this module
+# (e.g., from the HDF5 dataset loading pipeline) remains fast
+
+from data.homography_warper import transform_points
+from data.raster_store import TiledRasterStore
+
+from typing import Callable, Optional, Tuple
 Tensor = torch.Tensor
 softmax = fctl.softmax
 log_softmax = fctl.log_softmax
@@ -22,6 +23,7 @@ def compute_occlusion_map(
     occ_y = torch.arange(map_dimensions[0])
     occ_x = torch.arange(map_dimensions[1])
     xy = torch.dstack((torch.meshgrid(occ_x, occ_y))).reshape((-1, 2))
+    from matplotlib.path import Path
     mpath = Path(visibility_polygon_coordinates)
     return torch.from_numpy(mpath.contains_points(xy).reshape(map_dimensions)).to(torch.bool).T
 
@@ -30,6 +32,7 @@ def compute_distance_transformed_map(
         occlusion_map: Tensor,      # [H, W]
         scaling: float = 1.0
 ) -> Tensor:                        # [H, W]
+    from scipy.ndimage import distance_transform_edt
     return (torch.where(
         ~occlusion_map,
         torch.from_numpy(-distance_transform_edt(~occlusion_map)),
@@ -50,6 +53,40 @@ def apply_function_over_whole_map(
     return function(map_tensor.view(-1)).view(map_tensor.shape)
 
 
+def map_pyramid_key(key: str, level: int) -> str:
+    # name of the field holding level <level> of the pyramid of the map <key> (downsampled by a factor 2 ** level)
+    return key if level == 0 else f'{key}_level{level}'
+
+
+def parse_map_pyramid_key(key: str) -> Tuple[str, int]:
+    # inverse of map_pyramid_key: (name of the full resolution map, pyramid level)
+    base_key, separator, level = key.rpartition('_level')
+    if separator and level.isdigit():
+        return base_key, int(level)
+    return key, 0
+
+
+def downsample_map(
+        map_tensor: Tensor,         # [*, H, W]
+        level: int,
+        pooling: str = 'avg'        # 'min' | 'max' | 'avg'
+) -> Tensor:                        # [*, H / 2 ** level, W / 2 ** level]
+    # pooling over non overlapping windows of 2 ** level pixels (identical to <level> successive 2x2 poolings)
+    assert pooling in ['min', 'max', 'avg'], f"unknown pooling: {pooling}"
+    if level == 0:
+        return map_tensor
+    factor = 2 ** level
+    assert map_tensor.shape[-2] % factor == 0 and map_tensor.shape[-1] % factor == 0
+    x = map_tensor.reshape(-1, 1, *map_tensor.shape[-2:]).to(torch.float32)     # [*, 1, H, W]
+    if pooling == 'max':
+        x = fctl.max_pool2d(x, kernel_size=factor)
+    elif pooling == 'min':
+        x = -fctl.max_pool2d(-x, kernel_size=factor)
+    else:
+        x = fctl.avg_pool2d(x, kernel_size=factor)
+    return x.view(*map_tensor.shape[:-2], *x.shape[-2:]).to(map_tensor.dtype)
+
+
 def compute_probability_map(dt_map: Tensor) -> Tensor:
     return apply_function_over_whole_map(dt_map, lambda x: softmax(compute_clipped_map(x), dim=0))
 
@@ -66,6 +103,89 @@ def apply_homography(
     return (homography @ homogeneous_points).transpose(-1, -2)[..., :-1]
 
 
+def warp_affine_window(
+        image: Tensor,              # [C, H, W]
+        window_to_image: Tensor,    # [3, 3]
+        resolution: int,
+        padding_mode: str = 'reflection'
+) -> Tensor:                        # [C, resolution, resolution]
+    # Samples a square window of <resolution> pixels from the image, in a single pass.
+    # <window_to_image> maps window coordinates onto image coordinates (pixel (i, j) covers the area [j, j+1]x[i, i+1]).
+    # With align_corners=True, the 'reflection' padding mode reflects about the border pixels' centers,
+    # which follows the cv2.BORDER_REFLECT_101 convention.
+    return warp_affine_patches(
+        images=image.unsqueeze(0), patch_to_image=window_to_image.view(1, 1, 3, 3), resolution=resolution,
+        padding_mode=padding_mode
+    )[0, 0]
+
+
+def warp_affine_patches(
+        images: Tensor,             # [B, C, H, W]
+        patch_to_image: Tensor,     # [B, N, 3, 3]
+        resolution: int,
+        padding_mode: str = 'zeros'
+) -> Tensor:                        # [B, N, C, resolution, resolution]
+    # Samples N square patches of <resolution> pixels from each image (same conventions as warp_affine_window).
+    # The patches of an image are sampled with a single grid_sample call, as one tall [N * R, R] grid: the image
+    # itself is neither copied nor expanded.
+    B, C, H, W = images.shape
+    N = patch_to_image.shape[1]
+    coords = torch.arange(resolution, dtype=images.dtype, device=images.device) + 0.5      # patch pixel centers
+    grid_y, grid_x = torch.meshgrid(coords, coords)
+    patch_points = torch.stack([grid_x, grid_y], dim=-1).view(1, -1, 2).expand(B * N, -1, -1)  # [B * N, R*R, 2]
+
+    image_points = transform_points(
+        patch_to_image.to(images).view(B * N, 3, 3), patch_points
+    ) - 0.5                                                                                     # [B * N, R*R, 2]
+    image_points = image_points / torch.tensor([W - 1, H - 1], dtype=images.dtype, device=images.device) * 2 - 1
+
+    patches = fctl.grid_sample(
+        images, image_points.view(B, N * resolution, resolution, 2),
+        mode='bilinear', padding_mode=padding_mode, align_corners=True
+    )                                                                                           # [B, C, N * R, R]
+    return patches.view(B, C, N, resolution, resolution).transpose(1, 2)
+
+
+# scene map windows can be stored as compressed images (see save_hdf5_dataset.py)
+IMAGE_ENCODINGS = {'jpeg': '.jpg', 'png': '.png'}
+
+
+def encode_scene_map(
+        scene_map: Tensor,      # [C, H, W], RGB values in [0, 1]
+        encoding: str = 'jpeg',
+        resolution: Optional[int] = None,
+        jpeg_quality: int = 90
+) -> np.ndarray:                # [n_bytes]
+    import cv2
+    assert encoding in IMAGE_ENCODINGS.keys()
+    if resolution is not None and resolution < scene_map.shape[-1]:
+        scene_map = fctl.interpolate(scene_map.unsqueeze(0), size=(resolution, resolution), mode='area').squeeze(0)
+    elif resolution is not None and resolution > scene_map.shape[-1]:
+        scene_map = fctl.interpolate(
+            scene_map.unsqueeze(0), size=(resolution, resolution), mode='bilinear', align_corners=False
+        ).squeeze(0)
+    image = (scene_map.clamp(0., 1.) * 255).round().to(torch.uint8).permute(1, 2, 0).numpy()     # [H, W, C]
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)] if encoding == 'jpeg' else []
+    success, buffer = cv2.imencode(IMAGE_ENCODINGS[encoding], image, params)
+    assert success
+    return buffer.reshape(-1)
+
+
+def decode_scene_map(
+        buffer: np.ndarray,             # [n_bytes]
+        resolution: Optional[int] = None
+) -> Tensor:                            # [C, H, W], RGB values in [0, 1]
+    import cv2
+    image = cv2.imdecode(np.ascontiguousarray(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+    scene_map = torch.from_numpy(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).permute(2, 0, 1).to(torch.float32) / 255
+    if resolution is not None and resolution != scene_map.shape[-1]:
+        scene_map = fctl.interpolate(
+            scene_map.unsqueeze(0), size=(resolution, resolution), mode='bilinear', align_corners=False
+        ).squeeze(0)
+    return scene_map
+
+
 class HomographyMatrix:
 
     def __init__(
@@ -77,6 +197,9 @@ class HomographyMatrix:
     def set_homography(self, matrix: Tensor) -> None:
         self._frame = matrix
 
+    def get_homography(self) -> Tensor:     # [3, 3]
+        return self._frame
+
     def translate(
             self,
             point: Tensor   # [2]
@@ -150,6 +273,7 @@ class PILMap(BaseMap):
         (Image.open is a lazy operation)
         https://pillow.readthedocs.io/en/stable/reference/Image.html#functions
         """
+        from PIL import Image
         self._resolution = Image.open(image_path).size[::-1]         # [H, W]
         self._data = None
 
@@ -170,37 +294,130 @@ class PILMap(BaseMap):
         pass
 
 
-class TensorMap(BaseMap):
+class AffineWarpMap(BaseMap):
+    """
+    Base class for maps whose rotations and cropping are composed into a single affine transform.
+    The map's data is only sampled once, over the output window, when the map gets cropped
+    (the rotated full resolution map is never computed).
+    If <with_data> is False, only the map's resolution is tracked (similarly to <PILMap>).
+    """
 
-    convert_to_tensor = torchvision.transforms.ToTensor()
+    @staticmethod
+    def convert_to_tensor(image: np.ndarray) -> Tensor:     # [H, W, C] --> [C, H, W]
+        from torchvision.transforms.functional import to_tensor
+        return to_tensor(image)
 
-    def __init__(self, image_path: os.PathLike):
-        image = cv2.imread(image_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image = self.convert_to_tensor(image)
-        self._data = image       # [C, H, W]
+    def __init__(self, resolution: Tuple[int, int], with_data: bool = True):
+        self._resolution = resolution       # [H, W]
+        self._with_data = with_data
+        self._frame_to_image = torch.eye(3, dtype=torch.float64)       # current map frame --> source image frame
+        self._cropped = False
+        self._data = None
+
+    def sample_window(
+            self,
+            window_to_image: Tensor,    # [3, 3]
+            resolution: int
+    ) -> Tensor:                        # [C, resolution, resolution]
+        raise NotImplementedError
 
     def get_data(self) -> Optional[Tensor]:
         return self._data
 
     def get_resolution(self) -> Size:   # [H, W]
-        return self._data.shape[1:]
+        return Size(self._resolution)
 
     def crop(
             self,
             crop_coords: Tensor,    # [2, 2]
             resolution: int
     ) -> None:
-        top = torch.round(crop_coords[0, 1]).to(torch.int64)
-        left = torch.round(crop_coords[0, 0]).to(torch.int64)
-        side = torch.round(crop_coords[1, 0] - crop_coords[0, 0]).to(torch.int64)
-
-        self._data = torchvision.transforms.functional.resized_crop(
-            self._data, top=top, left=left, height=side, width=side, size=resolution
+        (x_0, y_0), (x_1, y_1) = crop_coords.tolist()
+        window_to_frame = torch.tensor(
+            [[(x_1 - x_0) / resolution, 0., x_0],
+             [0., (y_1 - y_0) / resolution, y_0],
+             [0., 0., 1.]], dtype=torch.float64
         )
+        if self._with_data:
+            self._data = self.sample_window(
+                window_to_image=self._frame_to_image @ window_to_frame, resolution=resolution
+            )
+        self._resolution = (resolution, resolution)
+        self._frame_to_image = torch.eye(3, dtype=torch.float64)
+        self._cropped = True
 
     def rotate_around_center(self, theta: float) -> None:
-        self._data = torchvision.transforms.functional.rotate(self._data, angle=theta)
+        if self._cropped:
+            if self._data is not None:
+                from torchvision.transforms.functional import rotate
+                self._data = rotate(self._data, angle=theta)
+            return
+
+        # same conventions as MapManager.rotate_around_center
+        height, width = self._resolution
+        c_x, c_y = width * 0.5, height * 0.5
+        theta = -theta * np.pi / 180
+        cos, sin = np.cos(theta), np.sin(theta)
+        rotation = torch.tensor(
+            [[cos, -sin, -cos * c_x + sin * c_y + c_x],
+             [sin, cos, -sin * c_x - cos * c_y + c_y],
+             [0., 0., 1.]], dtype=torch.float64
+        )
+        self._frame_to_image = self._frame_to_image @ torch.inverse(rotation)
+
+
+class TensorMap(AffineWarpMap):
+
+    def __init__(self, image_path: os.PathLike):
+        import cv2
+        image = cv2.imread(image_path)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = self.convert_to_tensor(image)
+        self._image = image       # [C, H, W]
+        super().__init__(resolution=tuple(image.shape[1:]))
+
+    def sample_window(
+            self,
+            window_to_image: Tensor,    # [3, 3]
+            resolution: int
+    ) -> Tensor:                        # [C, resolution, resolution]
+        # areas outside the image are filled with zeros, as with torchvision rotations of the image
+        return warp_affine_window(
+            image=self._image, window_to_image=window_to_image, resolution=resolution, padding_mode='zeros'
+        )
+
+
+class TiledTensorMap(AffineWarpMap):
+    """
+    Scene map read from a <TiledRasterStore>. The reflect padding of the scene image is virtual,
+    and only the tiles overlapped by the sampled window are ever read.
+    """
+
+    def __init__(self, store_path: os.PathLike, padding: int = 0, with_data: bool = True):
+        self._store = TiledRasterStore(store_path=store_path, padding=padding)
+        super().__init__(resolution=self._store.padded_shape(), with_data=with_data)
+
+    def sample_window(
+            self,
+            window_to_image: Tensor,    # [3, 3]
+            resolution: int
+    ) -> Tensor:                        # [C, resolution, resolution]
+        # reading the smallest area of the store which contains the sampled window
+        corners = torch.tensor(
+            [[0., 0.], [resolution, 0.], [0., resolution], [resolution, resolution]], dtype=torch.float64
+        )
+        corners = corners @ window_to_image[:2, :2].T + window_to_image[:2, 2]        # [4, 2]
+        left, top = (torch.floor(corners.min(dim=0).values) - 1).to(torch.int64).tolist()
+        right, bottom = (torch.ceil(corners.max(dim=0).values) + 1).to(torch.int64).tolist()
+        area = self.convert_to_tensor(self._store.read_window(
+            top=top, left=left, height=bottom - top, width=right - left
+        ))
+
+        area_to_image = torch.tensor([[1., 0., left], [0., 1., top], [0., 0., 1.]], dtype=torch.float64)
+        return warp_affine_window(
+            image=area, window_to_image=torch.inverse(area_to_image) @ window_to_image,
+            resolution=resolution, padding_mode='border'
+        )
 
 
 class MapManager:
@@ -249,6 +466,9 @@ class MapManager:
     def set_homography(self, matrix: Tensor) -> None:
         self._homography.set_homography(matrix=matrix)
 
+    def get_homography(self) -> Tensor:     # [3, 3]
+        return self._homography.get_homography().clone()
+
 
 MAP_DICT = {
     True: TensorMap,
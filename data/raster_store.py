@@ -0,0 +1,97 @@
+import json
+import numpy as np
+import os
+
+from typing import Tuple
+
+
+def reflect_101_indices(
+        indices: np.ndarray,    # [*]
+        length: int
+) -> np.ndarray:                # [*]
+    # maps pixel indices lying outside of [0, length) back inside the image, following the same convention as
+    # cv2.BORDER_REFLECT_101 (gfedcb|abcdefgh|gfedcba). Repeated reflections are handled by periodicity.
+    if length == 1:
+        return np.zeros_like(indices)
+    period = 2 * (length - 1)
+    indices = np.abs(indices) % period
+    return np.where(indices >= length, period - indices, indices)
+
+
+def save_tiled_raster(
+        image: np.ndarray,      # [H, W, C]
+        store_path: os.PathLike,
+        tile_size: int = 256
+) -> None:
+    # <store_path> is the path of the .npy tiles file, a .json metadata file is saved alongside it.
+    assert str(store_path).endswith('.npy')
+    height, width, channels = image.shape
+    n_tiles_y, n_tiles_x = -(-height // tile_size), -(-width // tile_size)
+
+    # tiles are stored contiguously: reading one tile amounts to reading one contiguous block of the file
+    tiles = np.lib.format.open_memmap(
+        store_path, mode='w+', dtype=np.uint8, shape=(n_tiles_y, n_tiles_x, tile_size, tile_size, channels)
+    )
+    for tile_y in range(n_tiles_y):
+        for tile_x in range(n_tiles_x):
+            block = image[tile_y * tile_size:(tile_y + 1) * tile_size, tile_x * tile_size:(tile_x + 1) * tile_size]
+            tiles[tile_y, tile_x] = 0
+            tiles[tile_y, tile_x, :block.shape[0], :block.shape[1]] = block
+    tiles.flush()
+    del tiles
+
+    with open(TiledRasterStore.metadata_path(store_path), 'w') as f:
+        json.dump({'height': height, 'width': width, 'channels': channels, 'tile_size': tile_size}, f)
+
+
+class TiledRasterStore:
+    """
+    Read-only access to an image saved with <save_tiled_raster>.
+
+    The image is memory-mapped, and surrounded by a virtual reflect padding of <padding> pixels on each side:
+    windows are expressed in the coordinates of the padded image, and only the tiles they overlap are read.
+    """
+
+    def __init__(self, store_path: os.PathLike, padding: int = 0):
+        with open(self.metadata_path(store_path), 'r') as f:
+            metadata = json.load(f)
+        self.height = int(metadata['height'])
+        self.width = int(metadata['width'])
+        self.channels = int(metadata['channels'])
+        self.tile_size = int(metadata['tile_size'])
+        self.padding = int(padding)
+
+        self._tiles = np.load(store_path, mmap_mode='r')      # [Ty, Tx, tile_size, tile_size, C]
+
+    @staticmethod
+    def metadata_path(store_path: os.PathLike) -> str:
+        return f'{os.path.splitext(store_path)[0]}.json'
+
+    @staticmethod
+    def exists(store_path: os.PathLike) -> bool:
+        return os.path.exists(store_path) and os.path.exists(TiledRasterStore.metadata_path(store_path))
+
+    def padded_shape(self) -> Tuple[int, int]:      # [H, W]
+        return self.height + 2 * self.padding, self.width + 2 * self.padding
+
+    def read_window(
+            self,
+            top: int,
+            left: int,
+            height: int,
+            width: int
+    ) -> np.ndarray:        # [height, width, C]
+        rows = reflect_101_indices(np.arange(top, top + height) - self.padding, self.height)        # [height]
+        cols = reflect_101_indices(np.arange(left, left + width) - self.padding, self.width)        # [width]
+
+        # reading the overlapped tiles only, and assembling them into a single block
+        tile_rows, tile_cols = np.unique(rows // self.tile_size), np.unique(cols // self.tile_size)
+        block = self._tiles[tile_rows[:, None], tile_cols[None, :]]             # [ty, tx, tile_size, tile_size, C]
+        block = block.transpose(0, 2, 1, 3, 4).reshape(
+            tile_rows.shape[0] * self.tile_size, tile_cols.shape[0] * self.tile_size, self.channels
+        )
+
+        # pixel indices, relative to the assembled block
+        block_rows = np.searchsorted(tile_rows, rows // self.tile_size) * self.tile_size + rows % self.tile_size
+        block_cols = np.searchsorted(tile_cols, cols // self.tile_size) * self.tile_size + cols % self.tile_size
+        return block[block_rows[:, None], block_cols[None, :]]
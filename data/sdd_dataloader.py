@@ -1,9 +1,8 @@
-import cv2
+import csv
+import functools
 import h5py
 import numpy as np
 import os.path
-import pandas as pd
-import skgeom as sg
 import struct
 import torch
 
@@ -11,22 +10,33 @@ from collections import defaultdict
 from torch.utils.data import Dataset
 
 from data.map import \
-    compute_occlusion_map, compute_distance_transformed_map, \
-    HomographyMatrix, MapManager, MAP_DICT
+    apply_homography, compute_occlusion_map, compute_distance_transformed_map, decode_scene_map, \
+    downsample_map, parse_map_pyramid_key, HomographyMatrix, MapManager, TiledTensorMap, MAP_DICT
+from data.raster_store import TiledRasterStore, save_tiled_raster
 from data.trajectory_operations import impute_and_cv_predict, \
     last_observed_indices, last_observed_positions, \
-    observed_velocity, true_velocity
+    observed_velocity, true_velocity, flat_sequence_indices
 from utils.config import Config, REPO_ROOT
-from utils.performance_analysis import get_difficult_occlusion_indices
+from utils.utils import instance_rng
 
-from typing import Dict
+from typing import Dict, Iterable, List, Optional, Tuple
 Tensor = torch.Tensor
 
-# imports from https://github.com/PFery4/occlusion-prediction
-from src.data.sdd_dataloader import StanfordDroneDataset, StanfordDroneDatasetWithOcclusionSim
-import src.occlusion_simulation.visibility as visibility
-import src.occlusion_simulation.polygon_generation as poly_gen
-import src.data.config as sdd_conf
+# The dependencies which are only required for generating instances (cv2, skgeom, and the occlusion simulation
+# package from https://github.com/PFery4/occlusion-prediction) are imported inside TorchDataGeneratorSDD,
+# so that loading presaved HDF5 datasets does not require importing them.
+
+COORD_CONV_FILE = os.path.join(REPO_ROOT, 'datasets', 'SDD', 'coordinates_conversion.txt')
+
+
+@functools.lru_cache(maxsize=None)
+def coordinates_conversion_table() -> Dict[Tuple[str, str], Dict[str, float]]:
+    # (scene, video) --> pixel / meter conversion factors, read on first use
+    with open(COORD_CONV_FILE, 'r', newline='') as f:
+        return {
+            (row['scene'], row['video']): {'px/m': float(row['px/m']), 'm/px': float(row['m/px'])}
+            for row in csv.DictReader(f, delimiter=';')
+        }
 
 
 class BaseDataset:
@@ -37,8 +47,51 @@ class BaseDataset:
     # scene side length of <self.map_side> meters, the required padding is equal to the following value.
     # (note that if you need to change the desired side length to a different value, then you will need to
     # recompute the required padding)
+    # Alternatively (opt-in, with scene_image_store: tiled), scene images are saved in a tiled raster store, whose
+    # padding is resolved virtually at read time (see data/raster_store.py): only the tiles overlapped by a cropped
+    # scene map are then read from disk.
     padding_px = 2075
     padded_images_path = os.path.join(REPO_ROOT, 'datasets', 'SDD', f'padded_images_{padding_px}')
+    tiled_images_path = os.path.join(REPO_ROOT, 'datasets', 'SDD', 'tiled_images')
+
+    # field projection (see set_required_fields): fields which are always returned,
+    # and the fields every derived field is computed from
+    always_returned_fields = [
+        'frame', 'scene', 'video', 'seq', 'instance_name', 'identities', 'timesteps', 'scene_orig', 'map_homography'
+    ]
+    obs_sequence_fields = [
+        'obs_identity_sequence', 'obs_timestep_sequence', 'obs_position_sequence', 'obs_velocity_sequence'
+    ]
+    pred_sequence_fields = [
+        'pred_identity_sequence', 'pred_timestep_sequence', 'pred_position_sequence', 'pred_velocity_sequence'
+    ]
+    sequence_fields = [*obs_sequence_fields, 'last_obs_positions', 'last_obs_timesteps', *pred_sequence_fields]
+    trajectory_fields = ['trajectories', 'true_trajectories', 'observed_velocities', 'velocities']
+    occlusion_map_fields = ['occlusion_map', 'dist_transformed_occlusion_map', 'clipped_dist_transformed_occlusion_map']
+    field_dependencies = {
+        'obs_identity_sequence': ['observation_mask', 'last_obs_indices'],
+        'obs_timestep_sequence': ['observation_mask', 'last_obs_indices'],
+        'obs_position_sequence': ['trajectories', 'observation_mask', 'last_obs_indices'],
+        'obs_velocity_sequence': ['observed_velocities', 'observation_mask', 'last_obs_indices'],
+        'last_obs_positions': ['trajectories', 'observation_mask', 'last_obs_indices'],
+        'last_obs_timesteps': ['observation_mask', 'last_obs_indices'],
+        'pred_identity_sequence': ['observation_mask', 'last_obs_indices'],
+        'pred_timestep_sequence': ['observation_mask', 'last_obs_indices'],
+        'pred_position_sequence': ['trajectories', 'observation_mask', 'last_obs_indices'],
+        'pred_velocity_sequence': ['velocities', 'observation_mask', 'last_obs_indices'],
+        'imputation_mask': ['true_observation_mask', 'observation_mask'],
+        'occlusion_map': ['is_occluded'],
+        'dist_transformed_occlusion_map': ['occlusion_map', 'is_occluded'],
+        'clipped_dist_transformed_occlusion_map': ['occlusion_map', 'is_occluded'],
+    }
+    # maps of which downsampled versions can be required (see data.map.map_pyramid_key), and the pooling with which
+    # they are downsampled. The distance transformed occlusion map is positive in the visible region: min pooling
+    # keeps it conservative, as a downsampled pixel is only deemed visible if all the pixels it covers are.
+    map_pyramid_pooling = {
+        'dist_transformed_occlusion_map': 'min',
+        'clipped_dist_transformed_occlusion_map': 'min',
+        'scene_map': 'avg'
+    }
 
     def __init__(self, parser: Config, split: str = 'train'):
         self.split = split
@@ -62,7 +115,9 @@ class BaseDataset:
         self.map_resolution = int(parser.global_map_resolution)     # [px]
         self.traj_scale = float(parser.traj_scale)
         self.with_rgb_map = bool(parser.with_rgb_map)
+        self.scene_image_store = str(parser.get('scene_image_store', 'padded_jpg'))    # 'padded_jpg' | 'tiled'
         assert self.map_resolution % 8 == 0
+        assert self.scene_image_store in ['tiled', 'padded_jpg']
 
         self.map_crop_coords = self.get_map_crop_coordinates()
         self.map_homography = self.get_map_homography()
@@ -70,6 +125,10 @@ class BaseDataset:
         # dataset identification
         self.dataset_name = self.get_dataset_name()
 
+        # field projection (by default, every field is returned)
+        self.returned_fields = None
+        self.required_fields = None
+
     def get_dataset_name(self):
         dset_name = self.occlusion_process
         if self.impute:
@@ -113,8 +172,15 @@ class BaseDataset:
             predict_mask[i, pred_idx:] = True
         return predict_mask
 
-    def get_scene_map_manager(self, image_path: os.PathLike) -> MapManager:
-        scene_map = MAP_DICT[self.with_rgb_map](image_path=image_path)
+    def get_scene_map_manager(self, scene: str, video: str) -> MapManager:
+        if self.scene_image_store == 'tiled':
+            scene_map = TiledTensorMap(
+                store_path=os.path.join(self.tiled_images_path, f'{scene}_{video}_tiles.npy'),
+                padding=self.padding_px, with_data=self.with_rgb_map
+            )
+        else:
+            image_path = os.path.join(self.padded_images_path, f'{scene}_{video}_padded_img.jpg')
+            scene_map = MAP_DICT[self.with_rgb_map](image_path=image_path)
         homography = HomographyMatrix(matrix=torch.eye(3))
         return MapManager(map_object=scene_map, homography=homography)
 
@@ -125,6 +191,47 @@ class BaseDataset:
         )
         scene_map_manager.set_homography(matrix=self.map_homography)
 
+    def set_required_fields(self, fields: Optional[Iterable[str]]) -> None:
+        # restricts the fields of the instances to <fields> (and to the always returned fields).
+        # Only the fields <fields> are derived from are then computed. Every field is returned if <fields> is None.
+        if fields is None:
+            self.returned_fields, self.required_fields = None, None
+            return
+        self.returned_fields = {*self.always_returned_fields, *fields}
+        self.required_fields = set(self.returned_fields)
+        while True:
+            dependencies = {dep for field in self.required_fields for dep in self.dependencies_of(field)}
+            if dependencies.issubset(self.required_fields):
+                break
+            self.required_fields.update(dependencies)
+
+    def dependencies_of(self, field: str) -> List[str]:
+        base_field, level = parse_map_pyramid_key(field)
+        if level > 0:
+            assert base_field in self.map_pyramid_pooling, f"No map pyramid available for: {base_field}"
+            assert self.map_resolution % 2 ** level == 0
+            return [base_field]
+        return self.field_dependencies.get(field, [])
+
+    def add_map_pyramid_data(self, data_dict: Dict) -> None:
+        # the downsampled maps are only computed if required, from their full resolution map
+        if self.required_fields is None:
+            return
+        for field in self.required_fields:
+            base_field, level = parse_map_pyramid_key(field)
+            if level > 0 and data_dict.get(base_field, None) is not None:
+                data_dict[field] = downsample_map(
+                    data_dict[base_field], level=level, pooling=self.map_pyramid_pooling[base_field]
+                )
+
+    def requires(self, *fields: str) -> bool:
+        return self.required_fields is None or any(field in self.required_fields for field in fields)
+
+    def project_fields(self, data_dict: Dict) -> Dict:
+        if self.returned_fields is None:
+            return data_dict
+        return {key: value for key, value in data_dict.items() if key in self.returned_fields}
+
     @staticmethod
     def get_instance_idx(instance_num: int) -> int:
         return instance_num
@@ -134,6 +241,9 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
     def __init__(self, parser: Config, split: str = 'train'):
         BaseDataset.__init__(self, parser=parser, split=split)
 
+        import src.data.config as sdd_conf
+        from src.data.sdd_dataloader import StanfordDroneDatasetWithOcclusionSim
+
         self.sdd_config = sdd_conf.get_config(os.path.join(sdd_conf.REPO_ROOT, parser.sdd_config_file_name))
         dataset = StanfordDroneDatasetWithOcclusionSim(self.sdd_config, split=self.split)
 
@@ -146,6 +256,10 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         assert os.path.exists(self.image_path)
 
         self.rand_rot_scene = bool(parser.rand_rot_scene)
+        # random draws are made from per-instance generators keyed by (seed, split, index), unless disabled
+        # (in which case, the global numpy random state is used, as done for our legacy datasets)
+        self.seed = int(parser.get('seed', 0))
+        self.per_instance_rng = bool(parser.get('per_instance_rng', True))
         self.max_train_agent = int(parser.max_train_agent)
         self.distance_threshold_occluded_target = self.map_side / 4     # [m]
 
@@ -155,7 +269,10 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         }
         self.trajectory_processing_strategy = strategies[self.occlusion_process]
 
-        self.make_padded_scene_images()
+        if self.scene_image_store == 'tiled':
+            self.make_tiled_scene_images()
+        else:
+            self.make_padded_scene_images()
 
         assert self.T_obs == dataset.T_obs
         assert self.T_pred == dataset.T_pred
@@ -163,6 +280,7 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         self.lookup_time_window = np.arange(0, self.T_total) * self.frame_skip
 
     def make_padded_scene_images(self):
+        import cv2
         os.makedirs(self.padded_images_path, exist_ok=True)
         for scene in os.scandir(self.image_path):
             for video in os.scandir(scene):
@@ -181,6 +299,21 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
                     print(f"Saving padded image of {scene.name} {video.name}, with padding {self.padding_px}, under:\n"
                           f"{save_padded_img_path}")
 
+    def make_tiled_scene_images(self):
+        import cv2
+        os.makedirs(self.tiled_images_path, exist_ok=True)
+        for scene in os.scandir(self.image_path):
+            for video in os.scandir(scene):
+                save_tiles_path = os.path.join(self.tiled_images_path, f"{scene.name}_{video.name}_tiles.npy")
+                if TiledRasterStore.exists(save_tiles_path):
+                    continue
+                else:
+                    image_path = os.path.join(video, 'reference.jpg')
+                    assert os.path.exists(image_path)
+                    img = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+                    save_tiled_raster(image=img, store_path=save_tiles_path)
+                    print(f"Saving tiled image of {scene.name} {video.name}, under:\n{save_tiles_path}")
+
     def __len__(self) -> int:
         return len(self.occlusion_table)
 
@@ -257,6 +390,10 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
             scene_map_manager: MapManager,
             m_by_px: float
     ):
+        import skgeom as sg
+        import src.occlusion_simulation.visibility as visibility
+        import src.occlusion_simulation.polygon_generation as poly_gen
+
         # mapping trajectories to the scene map coordinate system
         ego = scene_map_manager.to_map_points(ego)
         occluder = scene_map_manager.to_map_points(occluder)
@@ -324,6 +461,7 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         if self.impute:
             true_trajs = (true_trajs - center_point) * scaling
         ego_visipoly = sg.Polygon((torch.from_numpy(ego_visipoly.coords) - center_point) * scaling)
+        visibility_polygon = torch.from_numpy(ego_visipoly.coords).to(torch.float32)        # [P, 2]
         scene_map_manager.homography_translation(center_point)
         scene_map_manager.homography_scaling(1 / scaling)
 
@@ -333,9 +471,7 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         # computing the occlusion map and distance transformed occlusion map
         occlusion_map = compute_occlusion_map(
             map_dimensions=scene_map_manager.get_map_dimensions(),
-            visibility_polygon_coordinates=scene_map_manager.to_map_points(
-                torch.from_numpy(ego_visipoly.coords).to(torch.float32)
-            )
+            visibility_polygon_coordinates=scene_map_manager.to_map_points(visibility_polygon)
         )
         dist_transformed_occlusion_map = compute_distance_transformed_map(
             occlusion_map=occlusion_map,
@@ -352,6 +488,7 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         process_dict['center_point'] = center_point
         process_dict['ego'] = ego
         process_dict['occluder'] = occluder
+        process_dict['visibility_polygon'] = visibility_polygon
         if self.impute:
             process_dict['true_trajs'] = true_trajs
             process_dict['true_obs_mask'] = true_obs_mask
@@ -410,8 +547,7 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         lookup_row = self.lookuptable.iloc[lookup_idx]
 
         # extract the reference image
-        image_path = os.path.join(self.padded_images_path, f'{scene}_{video}_padded_img.jpg')
-        scene_map_mgr = self.get_scene_map_manager(image_path=image_path)
+        scene_map_mgr = self.get_scene_map_manager(scene=scene, video=video)
         scene_map_mgr.homography_translation(Tensor([self.padding_px, self.padding_px]))
 
         # generate a time window to extract the relevant section of the scene
@@ -434,10 +570,12 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         px_by_m = self.coord_conv.loc[scene, video]['px/m']
 
         # prepare for random rotation by choosing a rotation angle and rotating the map
-        theta_rot = np.random.rand() * 360 * self.rand_rot_scene
+        rng = instance_rng(self.seed, self.split, idx) if self.per_instance_rng else np.random
+        theta_rot = rng.random() * 360 * self.rand_rot_scene
         scene_map_mgr.rotate_around_center(theta=theta_rot)
 
         # mapping the trajectories to scene map coordinate system
+        annotation_to_map = scene_map_mgr.get_homography().to(torch.float64)        # [3, 3]
         trajs = scene_map_mgr.to_map_points(trajs)
 
         process_dict = defaultdict(None)
@@ -454,6 +592,15 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
         process_dict['dist_transformed_occlusion_map'] *= px_by_m * self.map_side / self.map_resolution
         clipped_dist_transformed_occlusion_map = torch.clamp(process_dict['dist_transformed_occlusion_map'], min=0.)
 
+        # homography mapping the annotation coordinates of the scene to the coordinates of the instance's trajectories
+        scaling = self.traj_scale * m_by_px
+        c_x, c_y = process_dict['center_point'].tolist()
+        trajectory_homography = torch.tensor(
+            [[scaling, 0., -scaling * c_x],
+             [0., scaling, -scaling * c_y],
+             [0., 0., 1.]], dtype=torch.float64
+        ) @ annotation_to_map                                                       # [3, 3]
+
         # removing agent surplus
         ids = ids[process_dict['keep_agent_mask']]
         trajs = process_dict['trajs'][process_dict['keep_agent_mask']]
@@ -522,9 +669,11 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
             'map_homography': self.map_homography,
             'theta': theta_rot,
             'center_point': process_dict['center_point'],
+            'trajectory_homography': trajectory_homography,
             'is_occluded': True if 'ego' in process_dict.keys() else False,
             'ego': process_dict.get('ego', torch.full([1, 2], float('nan'))),
             'occluder': process_dict.get('occluder', torch.full([2, 2], float('nan'))),
+            'visibility_polygon': process_dict.get('visibility_polygon', torch.zeros([0, 2])),
 
             'scene': scene,
             'video': video,
@@ -547,16 +696,43 @@ class TorchDataGeneratorSDD(BaseDataset, Dataset):
                 true_observation_mask=true_obs_mask
             )
 
-        return data_dict
+        self.add_map_pyramid_data(data_dict=data_dict)
+        return self.project_fields(data_dict)
 
 
 class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
 
     dataset_filenames = {False: 'dataset_v2.h5', True: 'legacy_dataset_v2.h5'}
+    # format version 3 additionally stores the flattened observed / prediction sequence indices of every instance,
+    # indexed by their own lookup indices (files without a 'format_version' attribute are version 2)
+    sequence_datasets = {
+        # sequence dataset name <--> lookup indices dataset name
+        'obs_sequence_indices': 'obs_lookup_indices',
+        'pred_sequence_indices': 'pred_lookup_indices'
+    }
+    # occlusion maps can alternatively be stored as the vertices of the ego's visibility polygon (in metric
+    # coordinates), which are rasterized at the configured map resolution when loaded. Instances without any
+    # simulated occlusion store no vertices.
+    polygon_datasets = {
+        # polygon dataset name <--> lookup indices dataset name
+        'visibility_polygon': 'visibility_polygon_lookup_indices'
+    }
+    # the final (cropped and rotated) RGB scene map window of every instance can optionally be stored as a
+    # JPEG / PNG compressed image, indexed by its own lookup indices. Images are decoded when loading instances
+    # (i.e., inside the DataLoader workers), at the configured map resolution.
+    scene_map_datasets = {
+        # encoded image dataset name <--> lookup indices dataset name
+        'scene_map': 'scene_map_lookup_indices'
+    }
+    indexed_datasets = {**sequence_datasets, **polygon_datasets, **scene_map_datasets}
+    # trajectories can alternatively be stored once per agent track (sampled at the dataset's frame rate) in the
+    # 'tracks' dataset, instances then only store for each agent the row of the track at which their time window
+    # begins, alongside the homography mapping track coordinates to the instance's coordinate system.
+    # Trajectories, velocities and imputed trajectories are then recomputed when loading instances.
+    track_datasets = ['tracks']
     presaved_datasets_dir = os.path.join(REPO_ROOT, 'datasets', 'SDD', 'pre_saved_datasets')
 
-    coord_conv_dir = os.path.join(REPO_ROOT, 'datasets', 'SDD', 'coordinates_conversion.txt')
-    coord_conv_table = pd.read_csv(coord_conv_dir, sep=';', index_col=('scene', 'video'))
+    coord_conv_dir = COORD_CONV_FILE
 
     def __init__(self, parser: Config, split: str = 'train', legacy_mode: bool = False):
         BaseDataset.__init__(self, parser=parser, split=split)
@@ -569,6 +745,10 @@ class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
         self.dataset_filename = self.dataset_filenames[legacy_mode]
         dataset_dir_name = f'{self.occlusion_process}_imputed' if self.impute else self.occlusion_process
         self.dataset_dir = os.path.join(self.presaved_datasets_dir, dataset_dir_name, self.split)
+        if parser.get('hdf5_file', None) is not None:
+            # explicitly specified dataset file (e.g., a dataset file saved with a different storage layout)
+            self.dataset_filename = os.path.basename(parser.hdf5_file)
+            self.dataset_dir = os.path.dirname(os.path.abspath(parser.hdf5_file))
         self.hdf5_file = os.path.join(self.dataset_dir, self.dataset_filename)
         assert os.path.exists(self.dataset_dir)
         assert os.path.exists(self.hdf5_file)
@@ -581,12 +761,22 @@ class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
         self.lookup_indices = None
         self.lookup_datasets = []       # datasets which will have to be indexed using self.lookup_indices
         with h5py.File(self.hdf5_file, 'r') as h5_file:
+            self.format_version = int(h5_file.attrs.get('format_version', 2))
+            self.occlusion_map_storage = 'polygon' if 'visibility_polygon' in h5_file else 'bitmask'
+            self.trajectory_storage = 'track' if 'tracks' in h5_file else 'instance'
+            self.with_presaved_scene_map = 'scene_map' in h5_file
             for dset_name, dset in h5_file.items():       # str, dataset
-                if None in dset.maxshape:
+                if None in dset.maxshape and dset_name not in [*self.indexed_datasets, *self.track_datasets]:
                     self.lookup_datasets.append(dset_name)
             self.lookup_indices = torch.from_numpy(h5_file['lookup_indices'][()])
         self.indices = torch.arange(len(self.lookup_indices))
 
+        # optional whole-split preloading of the dataset into (shared) RAM
+        self.preloaded_datasets = None      # dataset name --> shared memory tensor
+        self.string_categories = dict()     # dataset name --> list of unique strings (for string datasets)
+        if parser.get('preload', False):
+            self.preload_datasets(max_memory_gb=float(parser.get('preload_max_memory', 8.0)))
+
         # flags for __getitem__ behaviour
         self.with_map_transforms = True
         self.with_occlusion_state = True if self.occlusion_process == 'occlusion_simulation' else False
@@ -598,15 +788,14 @@ class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
             self.with_map_transforms = False
             self.with_occlusion_objects = False
 
-        if parser.get('difficult', False):
-            print("KEEPING ONLY THE DIFFICULT CASES")
-            # verifying the dataset is the correct configuration
-            assert self.occlusion_process == 'occlusion_simulation'
-            assert not self.impute
-            difficult_instances = get_difficult_occlusion_indices(
-                split=self.split).get_level_values('idx').unique().tolist()
-            self.indices = torch.tensor(difficult_instances, dtype=torch.int64)
-            assert len(self.indices) == len(difficult_instances)
+        # subset selection ('difficult: true' is equivalent to 'subset: difficult')
+        self.subsets_file = os.path.join(
+            self.dataset_dir, f'{os.path.splitext(self.dataset_filename)[0]}_subsets.h5'
+        )
+        subset = parser.get('subset', 'difficult' if parser.get('difficult', False) else None)
+        if subset is not None:
+            print(f"KEEPING ONLY THE {str(subset).upper()} CASES")
+            self.indices = self.get_subset_indices(subset=str(subset))
             assert torch.all(self.indices[1:] != self.indices[:-1])        # verifying no duplicates
 
         # dataset subsampling
@@ -623,59 +812,231 @@ class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
         print(f'total number of samples: {self.__len__()}')
         print(f'------------------------------ done --------------------------------\n')
 
+    @property
+    def coord_conv_table(self) -> Dict[Tuple[str, str], Dict[str, float]]:
+        return coordinates_conversion_table()
+
+    def get_subset_indices(self, subset: str) -> Tensor:
+        # subset indices are precomputed with the save_subset_indices.py script
+        if os.path.exists(self.subsets_file):
+            with h5py.File(self.subsets_file, 'r') as subsets_file:
+                if subset in subsets_file:
+                    return torch.from_numpy(subsets_file[subset][()]).to(torch.int64)
+
+        assert subset == 'difficult', f"Subset \'{subset}\' not found in:\n{self.subsets_file}\n" \
+                                      f"You must first run:\npython save_subset_indices.py --cfg <DATASET_CFG> " \
+                                      f"--split {self.split} [--legacy]"
+
+        # fallback for the difficult subset: reading the CV predictor's performance scores
+        print(f"No precomputed difficult subset found, reading the CV predictor's performance scores instead.")
+        from utils.performance_analysis import get_difficult_occlusion_indices
+        assert self.occlusion_process == 'occlusion_simulation'
+        assert not self.impute
+        difficult_instances = get_difficult_occlusion_indices(
+            split=self.split).get_level_values('idx').unique().tolist()
+        return torch.tensor(difficult_instances, dtype=torch.int64)
+
+    def preload_datasets(self, max_memory_gb: float) -> None:
+        # Every dataset of the split is read once, and stored inside tensors placed in shared memory.
+        # DataLoader workers then all access the same memory, instead of each holding their own copy or file handle.
+        # String datasets are interned as categorical codes, alongside their list of unique strings.
+        with h5py.File(self.hdf5_file, 'r') as h5_file:
+            required_bytes = sum(dset.size * dset.dtype.itemsize for dset in h5_file.values())
+            if required_bytes > max_memory_gb * 1e9:
+                print(f"Preloading the dataset requires {required_bytes * 1e-9:.2f}GB, which exceeds the "
+                      f"configured cap of {max_memory_gb:.2f}GB: instances will be read from disk instead.")
+                return
+
+            print(f"Preloading the dataset into memory ({required_bytes * 1e-9:.2f}GB)")
+            preloaded_datasets = dict()
+            for dset_name, dset in h5_file.items():
+                if h5py.check_string_dtype(dset.dtype) is not None:
+                    categories, codes = np.unique(dset.asstr()[()], return_inverse=True)
+                    self.string_categories[dset_name] = categories.tolist()
+                    data = codes.astype(np.int32)
+                elif dset.dtype.kind == 'V':
+                    # opaque datasets are stored as rows of raw bytes
+                    data = dset[()].view(np.uint8).reshape(dset.shape[0], -1)
+                else:
+                    data = dset[()]
+                preloaded_datasets[dset_name] = torch.from_numpy(data).share_memory_()
+        self.preloaded_datasets = preloaded_datasets
+
+    def read_dataset(self, dset_name: str, key) -> np.ndarray:
+        if self.preloaded_datasets is not None:
+            data = self.preloaded_datasets[dset_name][key].numpy()
+        else:
+            data = self.h5_dataset[dset_name][key]
+        # reduced precision datasets are processed in single precision
+        return data.astype(np.float32) if data.dtype == np.float16 else data
+
+    def read_string_dataset(self, dset_name: str, idx: int) -> str:
+        if self.preloaded_datasets is not None:
+            return self.string_categories[dset_name][int(self.preloaded_datasets[dset_name][idx])]
+        return self.h5_dataset[dset_name].asstr()[idx]
+
     def add_instance_identifiers(self, data_dict: Dict, idx: int):
-        data_dict['frame'] = self.h5_dataset['frame'][idx].astype(np.int64)
-        data_dict['scene'] = self.h5_dataset['scene'].asstr()[idx]
-        data_dict['video'] = self.h5_dataset['video'].asstr()[idx]
+        data_dict['frame'] = np.int64(self.read_dataset('frame', idx))
+        data_dict['scene'] = self.read_string_dataset('scene', idx)
+        data_dict['video'] = self.read_string_dataset('video', idx)
         data_dict['seq'] = f"{data_dict['scene']}_{data_dict['video']}"
         data_dict['instance_name'] = f'{idx:08}'
 
     def add_occlusion_state(self, data_dict: Dict, idx: int):
-        data_dict['is_occluded'] = bool(self.h5_dataset['is_occluded'][idx])
+        data_dict['is_occluded'] = bool(self.read_dataset('is_occluded', idx))
 
     def add_occlusion_objects(self, data_dict: Dict, idx: int):
-        data_dict['ego'] = torch.from_numpy(self.h5_dataset['ego'][idx]).view(1, 2)
-        data_dict['occluder'] = torch.from_numpy(self.h5_dataset['occluder'][idx])
+        data_dict['ego'] = torch.from_numpy(self.read_dataset('ego', idx)).view(1, 2)
+        data_dict['occluder'] = torch.from_numpy(self.read_dataset('occluder', idx))
 
     def add_scene_map_transform_parameters(self, data_dict: Dict, idx: int):
-        data_dict['theta'] = float(self.h5_dataset['theta'][idx])
-        data_dict['center_point'] = torch.from_numpy(self.h5_dataset['center_point'][idx])
+        data_dict['theta'] = float(self.read_dataset('theta', idx))
+        data_dict['center_point'] = torch.from_numpy(self.read_dataset('center_point', idx))
 
     def add_trajectory_data(self, data_dict):
         agent_grid = self.agent_grid(ids=data_dict['identities'])
         timestep_grid = self.timestep_grid(ids=data_dict['identities'])
         last_obs_indices = last_observed_indices(obs_mask=data_dict['observation_mask'].to(torch.int16))
         pred_mask = self.predict_mask(last_obs_indices=last_obs_indices)
+        obs_mask = data_dict['observation_mask']
+
+        if self.requires('obs_identity_sequence'):
+            data_dict['obs_identity_sequence'] = agent_grid[obs_mask, ...]
+        if self.requires('obs_timestep_sequence'):
+            data_dict['obs_timestep_sequence'] = timestep_grid[obs_mask, ...]
+        if self.requires('obs_position_sequence'):
+            data_dict['obs_position_sequence'] = data_dict['trajectories'][obs_mask, ...]
+        if self.requires('obs_velocity_sequence'):
+            data_dict['obs_velocity_sequence'] = data_dict['observed_velocities'][obs_mask, ...]
+
+        if self.requires('last_obs_positions'):
+            data_dict['last_obs_positions'] = last_observed_positions(
+                trajs=data_dict['trajectories'], last_obs_indices=last_obs_indices
+            )
+        if self.requires('last_obs_timesteps'):
+            data_dict['last_obs_timesteps'] = self.last_observed_timesteps(
+                last_obs_indices=last_obs_indices
+            )
 
-        data_dict['obs_identity_sequence'] = agent_grid[data_dict['observation_mask'], ...]
-        data_dict['obs_timestep_sequence'] = timestep_grid[data_dict['observation_mask'], ...]
-        data_dict['obs_position_sequence'] = data_dict['trajectories'][data_dict['observation_mask'], ...]
-        data_dict['obs_velocity_sequence'] = data_dict['observed_velocities'][data_dict['observation_mask'], ...]
-
-        data_dict['last_obs_positions'] = last_observed_positions(
-            trajs=data_dict['trajectories'], last_obs_indices=last_obs_indices
-        )
-        data_dict['last_obs_timesteps'] = self.last_observed_timesteps(
-            last_obs_indices=last_obs_indices
-        )
+        if self.requires('pred_identity_sequence'):
+            data_dict['pred_identity_sequence'] = agent_grid.T[pred_mask.T, ...]
+        if self.requires('pred_position_sequence'):
+            data_dict['pred_position_sequence'] = data_dict['trajectories'].transpose(0, 1)[pred_mask.T, ...]
+        if self.requires('pred_velocity_sequence'):
+            data_dict['pred_velocity_sequence'] = data_dict['velocities'].transpose(0, 1)[pred_mask.T, ...]
+        if self.requires('pred_timestep_sequence'):
+            data_dict['pred_timestep_sequence'] = timestep_grid.T[pred_mask.T, ...]
+
+    def set_required_fields(self, fields: Optional[Iterable[str]]) -> None:
+        BaseDataset.set_required_fields(self, fields=fields)
+        if self.required_fields is not None and self.trajectory_storage == 'track' and \
+                self.requires(*self.trajectory_fields):
+            # trajectories and velocities are all reconstructed from the agents' tracks
+            self.required_fields.update(['track_view_start', 'observation_mask'])
+            if self.impute:
+                self.required_fields.add('true_observation_mask')
+
+    def read_track_rows(self, rows: Tensor) -> Tensor:     # [*] -> [*, 2]
+        if self.preloaded_datasets is not None:
+            return self.preloaded_datasets['tracks'][rows]
+        # HDF5 point selections must be increasing: we read every required row once, in order
+        unique_rows, inverse = torch.unique(rows, sorted=True, return_inverse=True)
+        return torch.from_numpy(self.h5_dataset['tracks'][unique_rows.numpy()])[inverse]
+
+    def add_track_trajectory_data(self, data_dict: Dict, idx: int):
+        # reconstruction of the trajectory data of instances from the agents' tracks
+        track_view_start = data_dict.pop('track_view_start').to(torch.int64)               # [N]
+        rows = track_view_start.unsqueeze(-1) + torch.arange(self.T_total)                  # [N, T]
+        homography = torch.from_numpy(self.read_dataset('trajectory_homography', idx))     # [3, 3]
+        trajs = (
+                self.read_track_rows(rows).to(torch.float64) @ homography[:2, :2].T + homography[:2, 2]
+        ).to(torch.float32)                                                                 # [N, T, 2]
 
-        data_dict['pred_identity_sequence'] = agent_grid.T[pred_mask.T, ...]
-        data_dict['pred_position_sequence'] = data_dict['trajectories'].transpose(0, 1)[pred_mask.T, ...]
-        data_dict['pred_velocity_sequence'] = data_dict['velocities'].transpose(0, 1)[pred_mask.T, ...]
-        data_dict['pred_timestep_sequence'] = timestep_grid.T[pred_mask.T, ...]
+        if self.impute:
+            true_obs_mask = data_dict['true_observation_mask']
+            data_dict['true_trajectories'] = trajs
+            imputed_trajs = impute_and_cv_predict(trajs=trajs, obs_mask=true_obs_mask, timesteps=self.timesteps)
+            imputed_trajs[~data_dict['observation_mask'], :] = trajs[~data_dict['observation_mask'], :]
+            trajs = imputed_trajs
+
+        data_dict['trajectories'] = trajs
+        data_dict['observed_velocities'] = observed_velocity(trajs=trajs, obs_mask=data_dict['observation_mask'])
+        data_dict['velocities'] = true_velocity(trajs=trajs)
+
+    def add_presaved_trajectory_data(self, data_dict: Dict, idx: int):
+        # format version >= 3: the sequences are gathered using the presaved flattened sequence indices
+        last_obs_indices = data_dict.pop('last_obs_indices').to(torch.int64)        # [N]
+
+        if self.requires(*self.obs_sequence_fields):
+            obs_start, obs_end = self.read_dataset('obs_lookup_indices', idx)
+            obs_indices = torch.from_numpy(
+                self.read_dataset('obs_sequence_indices', slice(obs_start, obs_end))
+            ).to(torch.int64)       # [O]
+            if self.requires('obs_identity_sequence'):
+                data_dict['obs_identity_sequence'] = data_dict['identities'][obs_indices // self.T_total]
+            if self.requires('obs_timestep_sequence'):
+                data_dict['obs_timestep_sequence'] = self.timesteps[obs_indices % self.T_total]
+            if self.requires('obs_position_sequence'):
+                data_dict['obs_position_sequence'] = data_dict['trajectories'].view(-1, 2)[obs_indices]
+            if self.requires('obs_velocity_sequence'):
+                data_dict['obs_velocity_sequence'] = data_dict['observed_velocities'].view(-1, 2)[obs_indices]
+
+        if self.requires('last_obs_positions'):
+            data_dict['last_obs_positions'] = last_observed_positions(
+                trajs=data_dict['trajectories'], last_obs_indices=last_obs_indices
+            )
+        if self.requires('last_obs_timesteps'):
+            data_dict['last_obs_timesteps'] = self.last_observed_timesteps(
+                last_obs_indices=last_obs_indices
+            )
 
-    def add_occlusion_map_data(self, data_dict: Dict, idx: int):
-        retrieved_bytes = self.h5_dataset['occlusion_map'][idx]
+        if self.requires(*self.pred_sequence_fields):
+            pred_start, pred_end = self.read_dataset('pred_lookup_indices', idx)
+            pred_indices = torch.from_numpy(
+                self.read_dataset('pred_sequence_indices', slice(pred_start, pred_end))
+            ).to(torch.int64)       # [P]
+            if self.requires('pred_identity_sequence'):
+                data_dict['pred_identity_sequence'] = data_dict['identities'][pred_indices // self.T_total]
+            if self.requires('pred_timestep_sequence'):
+                data_dict['pred_timestep_sequence'] = self.timesteps[pred_indices % self.T_total]
+            if self.requires('pred_position_sequence'):
+                data_dict['pred_position_sequence'] = data_dict['trajectories'].view(-1, 2)[pred_indices]
+            if self.requires('pred_velocity_sequence'):
+                data_dict['pred_velocity_sequence'] = data_dict['velocities'].view(-1, 2)[pred_indices]
+
+    def read_occlusion_bitmask(self, idx: int) -> Tensor:       # [H, W]
+        retrieved_bytes = self.read_dataset('occlusion_map', idx)
         retrieved_bytes = struct.unpack(self.struct_format, retrieved_bytes)
         retrieved_bytes = [f'{num:08b}' for num in retrieved_bytes]
         retrieved_bytes = "".join(retrieved_bytes)
-        processed_occl_map = torch.BoolTensor(
+        return torch.BoolTensor(
             [int(num) for num in retrieved_bytes]
         ).reshape(self.map_resolution, self.map_resolution)
+
+    def rasterize_visibility_polygon(self, idx: int, is_occluded: bool) -> Tensor:     # [H, W]
+        if not is_occluded:
+            return torch.full([self.map_resolution, self.map_resolution], True)
+        polygon_start, polygon_end = self.read_dataset('visibility_polygon_lookup_indices', idx)
+        visibility_polygon = torch.from_numpy(
+            self.read_dataset('visibility_polygon', slice(polygon_start, polygon_end))
+        )       # [P, 2]
+        return compute_occlusion_map(
+            map_dimensions=torch.Size([self.map_resolution, self.map_resolution]),
+            visibility_polygon_coordinates=apply_homography(points=visibility_polygon, homography=self.map_homography)
+        )
+
+    def add_occlusion_map_data(self, data_dict: Dict, idx: int):
+        if self.occlusion_map_storage == 'polygon':
+            processed_occl_map = self.rasterize_visibility_polygon(idx=idx, is_occluded=data_dict['is_occluded'])
+        else:
+            processed_occl_map = self.read_occlusion_bitmask(idx=idx)
         data_dict['occlusion_map'] = processed_occl_map
 
-        px_by_m = self.coord_conv_table.loc[data_dict['scene'], data_dict['video']]['px/m']
-        m_by_px = self.coord_conv_table.loc[data_dict['scene'], data_dict['video']]['m/px']
+        if not self.requires('dist_transformed_occlusion_map', 'clipped_dist_transformed_occlusion_map'):
+            return
+
+        px_by_m = self.coord_conv_table[data_dict['scene'], data_dict['video']]['px/m']
+        m_by_px = self.coord_conv_table[data_dict['scene'], data_dict['video']]['m/px']
         scaling = self.traj_scale * m_by_px
         if not data_dict['is_occluded']:
             dist_transformed_occlusion_map = torch.zeros([self.map_resolution, self.map_resolution])
@@ -696,19 +1057,30 @@ class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
 
     def add_scene_map_data(self, data_dict: Dict):
         # loading the scene map
-        image_path = os.path.join(self.padded_images_path, f"{data_dict['seq']}_padded_img.jpg")
-        scene_map_mgr = self.get_scene_map_manager(image_path=image_path)
+        scene_map_mgr = self.get_scene_map_manager(scene=data_dict['scene'], video=data_dict['video'])
         scene_map_mgr.homography_translation(Tensor([self.padding_px, self.padding_px]))
         scene_map_mgr.rotate_around_center(theta=data_dict['theta'])
         scene_map_mgr.set_homography(torch.eye(3))
         scene_map_mgr.homography_translation(data_dict['center_point'])
         scene_map_mgr.homography_scaling(
-            1 / (self.traj_scale * self.coord_conv_table.loc[data_dict['scene'], data_dict['video']]['m/px'])
+            1 / (self.traj_scale * self.coord_conv_table[data_dict['scene'], data_dict['video']]['m/px'])
         )
         self.crop_scene_map(scene_map_manager=scene_map_mgr)
 
         data_dict['scene_map'] = scene_map_mgr.get_map()
 
+    def add_presaved_scene_map_data(self, data_dict: Dict, idx: int):
+        image_start, image_end = self.read_dataset('scene_map_lookup_indices', idx)
+        data_dict['scene_map'] = decode_scene_map(
+            buffer=self.read_dataset('scene_map', slice(image_start, image_end)), resolution=self.map_resolution
+        )       # [C, H, W]
+
+    def scene_map_requested(self) -> bool:
+        # the scene map is returned if explicitly required (see set_required_fields), or if <with_rgb_map> is set
+        if self.required_fields is not None:
+            return 'scene_map' in self.required_fields
+        return self.with_rgb_map
+
     def get_instance_idx(self, instance_num: int) -> int:
         return int((self.indices == instance_num).nonzero(as_tuple=True)[0])
 
@@ -719,37 +1091,48 @@ class HDF5PresavedDatasetSDD(BaseDataset, Dataset):
         instance_idx = self.indices[idx]
         lookup_idx_start, lookup_idx_end = self.lookup_indices[instance_idx]
 
-        if self.h5_dataset is None:
+        if self.h5_dataset is None and self.preloaded_datasets is None:
             self.h5_dataset = h5py.File(self.hdf5_file, 'r')
 
         data_dict = dict()
 
         self.add_instance_identifiers(data_dict=data_dict, idx=instance_idx)
-        if self.with_map_transforms:
+        if self.with_map_transforms and self.requires('theta', 'center_point'):
             self.add_scene_map_transform_parameters(data_dict=data_dict, idx=instance_idx)
-        if self.with_occlusion_state:
+        if self.with_occlusion_state and self.requires('is_occluded'):
             self.add_occlusion_state(data_dict=data_dict, idx=instance_idx)
-        if self.with_occlusion_objects:
+        if self.with_occlusion_objects and self.requires('ego', 'occluder'):
             self.add_occlusion_objects(data_dict=data_dict, idx=instance_idx)
 
+        lookup_slice = slice(lookup_idx_start, lookup_idx_end)
         for dset_name in self.lookup_datasets:
-            data_dict[dset_name] = torch.from_numpy(self.h5_dataset[dset_name][lookup_idx_start:lookup_idx_end])
+            if dset_name == 'identities' or self.requires(dset_name):
+                data_dict[dset_name] = torch.from_numpy(self.read_dataset(dset_name, lookup_slice))
         data_dict['identities'] = data_dict['identities'].to(torch.int64)
+        if self.trajectory_storage == 'track' and self.requires(*self.trajectory_fields):
+            self.add_track_trajectory_data(data_dict=data_dict, idx=instance_idx)
 
-        self.add_trajectory_data(data_dict=data_dict)
-        if self.with_occlusion_map_data:
+        if self.requires(*self.sequence_fields):
+            if self.format_version >= 3:
+                self.add_presaved_trajectory_data(data_dict=data_dict, idx=instance_idx)
+            else:
+                self.add_trajectory_data(data_dict=data_dict)
+        if self.with_occlusion_map_data and self.requires(*self.occlusion_map_fields):
             self.add_occlusion_map_data(data_dict=data_dict, idx=instance_idx)
+        if self.with_presaved_scene_map and self.scene_map_requested():
+            self.add_presaved_scene_map_data(data_dict=data_dict, idx=instance_idx)
         # self.add_scene_map_data(data_dict=data_dict)
 
         data_dict['timesteps'] = self.timesteps
         data_dict['scene_orig'] = torch.zeros([2])
         data_dict['map_homography'] = self.map_homography
 
-        if self.impute:
-            assert 'true_trajectories' in data_dict.keys()
+        if self.impute and self.requires('imputation_mask'):
+            assert 'true_observation_mask' in data_dict.keys()
             data_dict['imputation_mask'] = data_dict['true_observation_mask'][data_dict['observation_mask']]
 
-        return data_dict
+        self.add_map_pyramid_data(data_dict=data_dict)
+        return self.project_fields(data_dict)
 
 
 dataset_dict = dict(
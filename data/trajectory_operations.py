@@ -1,70 +1,134 @@
 import torch
-from scipy.interpolate import interp1d
 
+from typing import Tuple
 Tensor = torch.Tensor
 
+# Unless specified otherwise by their shapes, the trajectory operations below support any number of leading
+# dimensions: they can equally be applied to the [N, T] agents of an instance, or to whole [B, N, T] batches.
+
 
 def last_observed_indices(
-        obs_mask: Tensor    # [N, T]
-) -> Tensor:                # [N]
-    return obs_mask.shape[1] - torch.argmax(torch.flip(obs_mask, dims=[1]), dim=1) - 1
+        obs_mask: Tensor    # [*, T]
+) -> Tensor:                # [*]
+    return obs_mask.shape[-1] - torch.argmax(torch.flip(obs_mask, dims=[-1]), dim=-1) - 1
+
+
+def gather_timesteps(
+        trajs: Tensor,      # [*, T, 2]
+        indices: Tensor     # [*, S]
+) -> Tensor:                # [*, S, 2]
+    return torch.gather(trajs, dim=-2, index=indices.unsqueeze(-1).expand(*indices.shape, trajs.shape[-1]))
 
 
 def last_observed_positions(
-        trajs: Tensor,              # [N, T, 2]
-        last_obs_indices: Tensor    # [N]
-) -> Tensor:                        # [N, 2]
-    return trajs[torch.arange(trajs.shape[0]), last_obs_indices, :]
+        trajs: Tensor,              # [*, T, 2]
+        last_obs_indices: Tensor    # [*]
+) -> Tensor:                        # [*, 2]
+    return gather_timesteps(trajs=trajs, indices=last_obs_indices.unsqueeze(-1)).squeeze(-2)
+
+
+def previous_observed_indices(
+        obs_mask: Tensor    # [*, T]
+) -> Tensor:                # [*, T]
+    # index of the last observed timestep strictly preceding every timestep (-1 if there is none)
+    T = obs_mask.shape[-1]
+    observed_indices = torch.where(
+        obs_mask.to(torch.bool),
+        torch.arange(T, device=obs_mask.device),
+        torch.full_like(obs_mask, -1, dtype=torch.int64)
+    )       # [*, T]
+    previous_indices = torch.full_like(observed_indices, -1)
+    previous_indices[..., 1:] = torch.cummax(observed_indices, dim=-1)[0][..., :-1]
+    return previous_indices
+
+
+def flat_sequence_indices(
+        obs_mask: Tensor    # [N, T]
+) -> Tuple[Tensor, Tensor, Tensor]:    # [O], [P], [N]
+    # indices (into the flattened [N * T] agent / timestep grid) of the elements of the observed sequence
+    # (ordered agent by agent) and of the prediction sequence (ordered timestep by timestep),
+    # alongside the last observed indices of every agent.
+    N, T = obs_mask.shape
+    last_obs_indices = last_observed_indices(obs_mask=obs_mask.to(torch.int16))     # [N]
+    pred_mask = torch.arange(T).unsqueeze(0) > last_obs_indices.unsqueeze(1)        # [N, T]
+    flat_indices = torch.arange(N * T).view(N, T)                                   # [N, T]
+    return flat_indices[obs_mask.to(torch.bool)], flat_indices.T[pred_mask.T], last_obs_indices
 
 
 def true_velocity(
-        trajs: Tensor   # [N, T, 2]
-) -> Tensor:            # [N, T, 2]
+        trajs: Tensor   # [*, T, 2]
+) -> Tensor:            # [*, T, 2]
     vel = torch.zeros_like(trajs)
-    vel[:, 1:, :] = trajs[:, 1:, :] - trajs[:, :-1, :]
+    vel[..., 1:, :] = trajs[..., 1:, :] - trajs[..., :-1, :]
     return vel
 
 
 def observed_velocity(
-        trajs: Tensor,      # [N, T, 2]
-        obs_mask: Tensor    # [N, T]
-) -> Tensor:                # [N, T, 2]
-    vel = torch.zeros_like(trajs)
-    for traj, mask, v in zip(trajs, obs_mask, vel):
-        obs_indices = torch.nonzero(mask)  # [Z, 1]
-        motion_diff = traj[obs_indices[1:, 0], :] - traj[obs_indices[:-1, 0], :]  # [Z - 1, 2]
-        v[obs_indices[1:].squeeze(), :] = motion_diff / (obs_indices[1:, :] - obs_indices[:-1, :])  # [Z - 1, 2]
-    return vel
+        trajs: Tensor,      # [*, T, 2]
+        obs_mask: Tensor    # [*, T]
+) -> Tensor:                # [*, T, 2]
+    # masked finite differences: the velocity at an observed timestep is the displacement from the previous observed
+    # timestep, divided by the number of timesteps separating them. Velocities are zero everywhere else.
+    T = trajs.shape[-2]
+    previous_indices = previous_observed_indices(obs_mask=obs_mask)                         # [*, T]
+    valid = torch.logical_and(obs_mask.to(torch.bool), previous_indices >= 0)              # [*, T]
+
+    motion_diff = trajs - gather_timesteps(trajs=trajs, indices=previous_indices.clamp(min=0))     # [*, T, 2]
+    time_diff = torch.arange(T, device=trajs.device) - previous_indices                     # [*, T]
+    vel = motion_diff / time_diff.unsqueeze(-1)                                             # [*, T, 2]
+    return torch.where(valid.unsqueeze(-1), vel, torch.zeros_like(vel))
 
 
 def cv_extrapolate(
-        trajs: Tensor,              # [N, T, 2]
-        obs_vel: Tensor,            # [N, T, 2]
-        last_obs_indices: Tensor    # [N]
-) -> Tensor:                        # [N, T, 2]
-    xtrpl_trajs = trajs.detach().clone()
-    for traj, vel, obs_idx in zip(xtrpl_trajs, obs_vel, last_obs_indices):
-        last_pos = traj[obs_idx]
-        last_vel = vel[obs_idx]
-        extra_seq = last_pos + torch.arange(traj.shape[0] - obs_idx).unsqueeze(1) * last_vel
-        traj[obs_idx:] = extra_seq
-    return xtrpl_trajs
+        trajs: Tensor,              # [*, T, 2]
+        obs_vel: Tensor,            # [*, T, 2]
+        last_obs_indices: Tensor    # [*]
+) -> Tensor:                        # [*, T, 2]
+    T = trajs.shape[-2]
+    last_pos = gather_timesteps(trajs=trajs, indices=last_obs_indices.unsqueeze(-1))        # [*, 1, 2]
+    last_vel = gather_timesteps(trajs=obs_vel, indices=last_obs_indices.unsqueeze(-1))      # [*, 1, 2]
+    steps = torch.arange(T, device=trajs.device) - last_obs_indices.unsqueeze(-1)          # [*, T]
+
+    extra_seq = last_pos + steps.unsqueeze(-1) * last_vel                                   # [*, T, 2]
+    return torch.where((steps >= 0).unsqueeze(-1), extra_seq, trajs)
 
 
 def impute_and_cv_predict(
-        trajs: Tensor,      # [N, T, 2]
-        obs_mask: Tensor,   # [N, T]
+        trajs: Tensor,      # [*, T, 2]
+        obs_mask: Tensor,   # [*, T]
         timesteps: Tensor   # [T]
-) -> Tensor:                # [N, T, 2]
-    imputed_trajs = torch.zeros_like(trajs)
-    for idx, (traj, mask) in enumerate(zip(trajs, obs_mask)):
-        # if none of the values are observed, then skip this trajectory altogether
-        if mask.sum() == 0:
-            continue
-        f = interp1d(timesteps[mask], traj[mask], axis=0, fill_value='extrapolate')
-        interptraj = f(timesteps)
-        imputed_trajs[idx, ...] = torch.from_numpy(interptraj)
-    return imputed_trajs
+) -> Tensor:                # [*, T, 2]
+    # masked linear interpolation / extrapolation, reproducing the computations of
+    # scipy.interpolate.interp1d(timesteps[mask], traj[mask], axis=0, fill_value='extrapolate')(timesteps).
+    # Trajectories without any observation are set to zero, and trajectories with a single observation are kept
+    # constant at that observation.
+    obs_mask = obs_mask.to(torch.bool)
+    T = trajs.shape[-2]
+    time_indices = torch.arange(T, device=trajs.device)
+    n_obs = obs_mask.sum(dim=-1, keepdim=True)                                              # [*, 1]
+
+    # observed timestep indices, sorted in increasing order and placed ahead of the unobserved ones
+    observed_indices = torch.argsort(torch.where(obs_mask, time_indices, time_indices + T), dim=-1)    # [*, T]
+
+    # equivalent to np.searchsorted(x, x_new).clip(1, len(x) - 1)
+    n_obs_before = torch.cumsum(obs_mask, dim=-1) - obs_mask.to(torch.int64)                # [*, T]
+    hi = torch.minimum(n_obs_before.clamp(min=1), (n_obs - 1).clamp(min=1))                 # [*, T]
+    idx_lo = torch.gather(observed_indices, dim=-1, index=hi - 1)                           # [*, T]
+    idx_hi = torch.gather(observed_indices, dim=-1, index=hi)                               # [*, T]
+
+    timesteps = timesteps.to(idx_lo.device)                                                 # [T]
+    x_lo, x_hi = timesteps[idx_lo], timesteps[idx_hi]                                       # [*, T]
+    y_lo = gather_timesteps(trajs=trajs, indices=idx_lo)                                    # [*, T, 2]
+    y_hi = gather_timesteps(trajs=trajs, indices=idx_hi)                                    # [*, T, 2]
+
+    # (interp1d computes the slope and interpolated values in double precision)
+    slope = (y_hi - y_lo).to(torch.float64) / (x_hi - x_lo).unsqueeze(-1).to(torch.float64)
+    imputed_trajs = (
+            slope * (timesteps - x_lo).unsqueeze(-1).to(torch.float64) + y_lo.to(torch.float64)
+    ).to(trajs.dtype)                                                                       # [*, T, 2]
+
+    imputed_trajs = torch.where((n_obs == 1).unsqueeze(-1), y_lo, imputed_trajs)
+    return torch.where((n_obs == 0).unsqueeze(-1), torch.zeros_like(imputed_trajs), imputed_trajs)
 
 
 def points_within_distance(
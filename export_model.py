@@ -0,0 +1,127 @@
+import os
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from data.sdd_dataloader import dataset_dict
+from model.export import ExportableAgentFormer, parity_errors
+from model.model_lib import model_dict
+from utils.config import Config, ModelConfig
+from utils.utils import prepare_seed, print_log, get_cuda_device
+
+from typing import Dict, Tuple
+
+
+def trace_inputs(model: torch.nn.Module, data: Dict, sample_num: int, device: torch.device) -> Tuple[torch.Tensor, ...]:
+    # the inputs of ExportableAgentFormer.forward for a dataset instance, with random latent noise
+    model.set_data(data)
+    eps = torch.randn([sample_num, model.data['agent_num'], model.future_decoder.nz], device=device)
+    return ExportableAgentFormer.example_inputs(
+        data=model.data, eps=eps, future_frames=model.future_decoder.future_frames
+    )
+
+
+def main(args: argparse.Namespace):
+    cfg = ModelConfig(cfg_id=args.cfg, tmp=args.tmp, create_dirs=False)
+    prepare_seed(cfg.seed)
+    torch.set_default_dtype(torch.float32)
+
+    # device
+    device = get_cuda_device(device_index=args.gpu)
+
+    # log
+    log = open(os.path.join(cfg.log_dir, 'log_export.txt'), 'w')
+
+    # dataloader (the instances are used as example inputs for tracing, and for the parity check)
+    dataset_cfg = Config(cfg_id=args.dataset_cfg)
+    dataset_cfg.__setattr__('with_rgb_map', False)
+    assert dataset_cfg.dataset == 'sdd'
+    dataset = dataset_dict[args.dataset_class](parser=dataset_cfg, split=args.data_split)
+    loader = DataLoader(dataset=dataset, shuffle=False, num_workers=0)
+
+    # model
+    assert cfg.get('model_id', 'agentformer') == 'agentformer', "only AgentFormer models can be exported"
+    for key in ['past_frames', 'future_frames', 'motion_dim', 'forecast_dim', 'traj_scale', 'global_map_resolution']:
+        assert key in dataset_cfg.yml_dict.keys()
+        cfg.yml_dict[key] = dataset_cfg.__getattribute__(key)
+
+    model = model_dict['agentformer'](cfg)
+    model.set_device(device)
+    dataset.set_required_fields(model.required_inputs())
+    model.eval()
+    if args.checkpoint_name == 'best_val':
+        args.checkpoint_name = cfg.get_best_val_checkpoint_name()
+        print(f"Best validation checkpoint name is: {args.checkpoint_name}")
+    cp_path = cfg.model_path % args.checkpoint_name
+    print_log(f'loading model from checkpoint: {cp_path}', log, display=True)
+    model_cp = torch.load(cp_path, map_location='cpu')
+    model.load_state_dict(model_cp['model_dict'])
+
+    exportable = ExportableAgentFormer(model=model, past_frames=int(cfg.past_frames)).eval()
+    sample_num = cfg.sample_k
+
+    # tracing, checked against a second instance with a different number of agents and decoding schedule length
+    # (inputs 5 and 8: valid_id [B, N] and schedule_agents [P])
+    data_iter = iter(loader)
+    with torch.no_grad():
+        example_inputs = trace_inputs(model=model, data=next(data_iter), sample_num=sample_num, device=device)
+        check_inputs = None
+        for data in data_iter:
+            inputs = trace_inputs(model=model, data=data, sample_num=sample_num, device=device)
+            if inputs[5].shape[1] != example_inputs[5].shape[1] and inputs[8].shape[0] != example_inputs[8].shape[0]:
+                check_inputs = [inputs]
+                break
+        assert check_inputs is not None, \
+            "no instance of the split differs from the first one in both its number of agents and schedule length"
+        traced = torch.jit.trace(exportable, example_inputs, check_inputs=check_inputs)
+
+    export_path = args.export_path or os.path.join(cfg.model_dir, f'exported_{args.checkpoint_name}.pt')
+    traced.save(export_path)
+    print_log(f'exported model saved under:\n{export_path}\n', log, display=True)
+
+    # parity check against AgentFormer.inference, with the saved module
+    exported = torch.jit.load(export_path, map_location=device)
+    max_error, mismatches = 0., 0
+    n_instances = min(args.parity_instances, len(dataset))
+    with torch.no_grad():
+        for i, data in enumerate(pbar := tqdm(loader, total=n_instances)):
+            if i >= n_instances:
+                break
+            pbar.set_description(f"Parity check: {data['instance_name'][0]}")
+            model.set_data(data)
+            errors = parity_errors(model=model, exported=exported, sample_num=sample_num, seed=cfg.seed + i)
+            max_error = max(max_error, errors['max_abs_error'])
+            mismatches += int(not (errors['same_agents'] and errors['same_timesteps']))
+
+    log_str = f"Parity check over {n_instances} instances:\n" \
+              f"maximum absolute prediction error: {max_error:.3e}\n" \
+              f"instances with mismatching agent / timestep sequences: {mismatches}\n"
+    print_log(log_str, log, display=True)
+    assert max_error <= args.tolerance and mismatches == 0, "The exported model does not match AgentFormer.inference"
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, required=True, default=None,
+                        help="Model config file (specified as either name or path")
+    parser.add_argument('--dataset_cfg', type=str, required=True, default=None,
+                        help="Dataset config file (specified as either name or path")
+    parser.add_argument('--data_split', type=str, default='test',
+                        help="\'train\' | \'val\' | \'test\'")
+    parser.add_argument('--checkpoint_name', type=str, default='best_val',
+                        help="name of the model checkpoint to export ('best_val' by default)")
+    parser.add_argument('--export_path', type=str, default=None,
+                        help="path of the exported TorchScript module (by default, in the model directory).")
+    parser.add_argument('--parity_instances', type=int, default=100,
+                        help="number of instances on which the exported module is compared with the model.")
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help="maximum absolute difference between the predictions of both [m].")
+    parser.add_argument('--tmp', action='store_true', default=False)
+    parser.add_argument('--gpu', type=int, default=None)
+    parser.add_argument('--dataset_class', type=str, default='hdf5', help="\'torch\' | \'hdf5\'")
+    args = parser.parse_args()
+
+    main(args=args)
+    print("Goodbye!")
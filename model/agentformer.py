@@ -1,8 +1,7 @@
-import matplotlib.axes
+import contextlib
 import torch
 import numpy as np
 from torch import nn
-import matplotlib.pyplot as plt
 from collections import defaultdict
 from typing import Tuple
 import model.decoder_out_submodels as decoder_out_submodels
@@ -11,11 +10,13 @@ from model.agentformer_loss import loss_func
 from model.common.dist import Normal, Categorical
 from model.attention_modules import \
     AgentFormerEncoder, AgentFormerDecoder, OcclusionFormerEncoder, OcclusionFormerDecoder
-from model.map_encoder import MapEncoder
-from utils.torch_ops import ExpParamAnnealer
-from utils.utils import initialize_weights
+from model.map_encoder import MapEncoder, LocalMapEncoder
+from data.map import map_pyramid_key
+from utils.torch_ops import ExpParamAnnealer, hand_over, hand_over_into, quantize_linear_layers, \
+    cast_submodules, PRECISIONS
+from utils.utils import initialize_weights, PhaseMemoryTracker
 
-from typing import Dict
+from typing import Dict, List
 Tensor = torch.Tensor
 
 
@@ -74,7 +75,33 @@ def mean_pooling(
     return single_mean_pooling(sequences[0, ...], identities[0, ...]).unsqueeze(0)
 
 
-def plot_tensor(ax: matplotlib.axes.Axes, tensor: torch.Tensor, cmap: str = 'Blues'):
+def map_features(
+        data: Dict,
+        identities: Tensor      # [B, L]
+) -> Tensor:                    # [B, model_dim] | [B, L, model_dim]
+    # the map features attended to by a sequence of agents <identities>: either the global map encoding, or the
+    # local map encoding of the agent of every sequence element
+    if data['agent_map_encoding'] is None:
+        return data['global_map_encoding']
+    agent_indices = (identities.unsqueeze(-1) == data['valid_id'].unsqueeze(1)).to(torch.int64).argmax(dim=-1)
+    return torch.gather(
+        data['agent_map_encoding'], dim=1,
+        index=agent_indices.unsqueeze(-1).expand(-1, -1, data['agent_map_encoding'].shape[-1])
+    )                           # [B, L, model_dim]
+
+
+def last_observed_headings(data: Dict) -> Tensor:      # [B, N]
+    # heading of every agent, from its velocity at its last observed timestep
+    last_obs_mask = (
+            (data['obs_identity_sequence'].unsqueeze(1) == data['valid_id'].unsqueeze(2)) &
+            (data['obs_timestep_sequence'].unsqueeze(1) == data['last_obs_timesteps'].unsqueeze(2))
+    )                                                                                   # [B, N, O]
+    velocities = last_obs_mask.to(data['obs_velocity_sequence']) @ data['obs_velocity_sequence']    # [B, N, 2]
+    return torch.atan2(velocities[..., 1], velocities[..., 0])
+
+
+def plot_tensor(ax: 'matplotlib.axes.Axes', tensor: torch.Tensor, cmap: str = 'Blues'):
+    import matplotlib.pyplot as plt
     assert tensor.dim() == 2
     img = tensor.detach().cpu().numpy()
 
@@ -141,12 +168,13 @@ class PositionalEncoding(nn.Module):
 
     @staticmethod
     def plot_positional_window(
-            ax: matplotlib.axes.Axes, tensor: torch.Tensor, offset: int = 0, cmap: str = "Blues"
+            ax: 'matplotlib.axes.Axes', tensor: torch.Tensor, offset: int = 0, cmap: str = "Blues"
     ) -> None:
         """
         # self.plot_positional_window(ax, tensor=self.pe, offset=int(self.timestep_window[0, 0]))
         # self.plot_positional_window(ax, tensor=pos_enc)
         """
+        import matplotlib.pyplot as plt
         img = tensor.T.cpu().numpy()
 
         ax.set_xlim(offset, img.shape[1] + offset)
@@ -182,6 +210,7 @@ class ContextEncoder(nn.Module):
         layer_params = {
             'd_model': self.model_dim,
             'n_head': self.n_head,
+            'head_dim': ctx['tf_head_dim'],
             'dim_feedforward': self.ff_dim,
             'dropout': self.dropout,
             'bias_self': self.bias_self,
@@ -193,10 +222,14 @@ class ContextEncoder(nn.Module):
             self.bias_map = ctx.get('bias_map', False)
             layer_params['bias_map'] = self.bias_map
 
-            self.tf_encoder = OcclusionFormerEncoder(layer_params=layer_params, num_layers=self.n_layer)
+            self.tf_encoder = OcclusionFormerEncoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
             self.tf_encoder_call = self.map_agent_encoder_call
         else:
-            self.tf_encoder = AgentFormerEncoder(layer_params=layer_params, num_layers=self.n_layer)
+            self.tf_encoder = AgentFormerEncoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
             self.tf_encoder_call = self.agent_encoder_call
 
         self.pos_encoder = PositionalEncoding(
@@ -234,9 +267,9 @@ class ContextEncoder(nn.Module):
         data['context_enc'], data['context_map'] = self.tf_encoder(
             src=tf_in_pos,
             src_self_other_mask=src_self_other_mask,
-            map_feature=data['global_map_encoding'],    # [B, model_dim]
+            map_feature=map_features(data, identities=data['obs_identity_sequence']),   # [B, (O), model_dim]
             src_mask=src_mask
-        )                                   # [B, O, model_dim], [B, model_dim]
+        )                                   # [B, O, model_dim], [B, (O), model_dim]
 
     def forward(self, data: Dict):
         # NOTE: This function does not work with batch sizes != 1
@@ -300,6 +333,7 @@ class FutureEncoder(nn.Module):
         layer_params = {
             'd_model': self.model_dim,
             'n_head': self.n_head,
+            'head_dim': ctx['tf_head_dim'],
             'dim_feedforward': self.ff_dim,
             'dropout': self.dropout,
             'bias_self': self.bias_self,
@@ -311,10 +345,14 @@ class FutureEncoder(nn.Module):
             self.bias_map = ctx.get('bias_map', False)
             layer_params['bias_map'] = self.bias_map
 
-            self.tf_decoder = OcclusionFormerDecoder(layer_params=layer_params, num_layers=self.n_layer)
+            self.tf_decoder = OcclusionFormerDecoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
             self.tf_decoder_call = self.map_agent_decoder_call
         else:
-            self.tf_decoder = AgentFormerDecoder(layer_params=layer_params, num_layers=self.n_layer)
+            self.tf_decoder = AgentFormerDecoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
             self.tf_decoder_call = self.agent_decoder_call
 
         self.pos_encoder = PositionalEncoding(
@@ -366,13 +404,14 @@ class FutureEncoder(nn.Module):
             tgt_mask: Tensor,                   # [B, P, P]
             mem_mask: Tensor                    # [B, P, O]
     ) -> Tensor:                                # [B, P, model_dim]
+        tgt_map = map_features(data, identities=data['pred_identity_sequence'])     # [B, (P), model_dim]
         tf_out, _, _ = self.tf_decoder(
             tgt=tf_in_pos,
             memory=data['context_enc'],             # [B, O, model_dim]
             tgt_tgt_self_other_mask=tgt_tgt_self_other_mask,
             tgt_mem_self_other_mask=tgt_mem_self_other_mask,
-            tgt_map=data['global_map_encoding'],    # [B, model_dim]
-            mem_map=data['context_map'],            # [B, model_dim]
+            tgt_map=tgt_map,
+            mem_map=data['context_map'] if tgt_map.dim() == 2 else tgt_map,
             tgt_mask=tgt_mask,
             memory_mask=mem_mask,
         )                                           # [B, P, model_dim], [B, model_dim]
@@ -453,6 +492,10 @@ class FutureDecoder(nn.Module):
         self.out_mlp_dim = ctx['future_decoder'].get('out_mlp_dim', None)
         self.learn_prior = ctx['learn_prior']
         self.global_map_attention = ctx['global_map_attention']
+        # the K samples are decoded in chunks of <sample_chunk_size> samples, or in chunks whose estimated memory
+        # footprint fits within <sample_memory_budget> [MB] (all at once if neither is provided)
+        self.sample_chunk_size = ctx['sample_chunk_size']
+        self.sample_memory_budget = ctx['sample_memory_budget']
 
         assert self.pred_mode in ["point"]
 
@@ -463,6 +506,7 @@ class FutureDecoder(nn.Module):
         layer_params = {
             'd_model': self.model_dim,
             'n_head': self.n_head,
+            'head_dim': ctx['tf_head_dim'],
             'dim_feedforward': self.ff_dim,
             'dropout': self.dropout,
             'bias_self': self.bias_self,
@@ -474,10 +518,14 @@ class FutureDecoder(nn.Module):
             self.bias_map = ctx.get('bias_map', False)
             layer_params['bias_map'] = self.bias_map
 
-            self.tf_decoder = OcclusionFormerDecoder(layer_params=layer_params, num_layers=self.n_layer)
+            self.tf_decoder = OcclusionFormerDecoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
             self.tf_decoder_call = self.map_agent_decoder_call
         else:
-            self.tf_decoder = AgentFormerDecoder(layer_params=layer_params, num_layers=self.n_layer)
+            self.tf_decoder = AgentFormerDecoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
             self.tf_decoder_call = self.agent_decoder_call
 
         self.pos_encoder = PositionalEncoding(
@@ -505,6 +553,7 @@ class FutureDecoder(nn.Module):
             tgt_mem_self_other_mask: Tensor,    # [B, M, O]
             tgt_mask: Tensor,                   # [B * K, M, M]
             mem_mask: Tensor,                   # [B * K, M, O]
+            agent_sequence: Tensor,             # [B, M]
             sample_num: int                     # K
     ) -> Tuple[Tensor, Dict]:                   # [B * K, M, model_dim], Dict
         tf_out, attn_weights = self.tf_decoder(
@@ -526,18 +575,22 @@ class FutureDecoder(nn.Module):
             tgt_mem_self_other_mask: Tensor,    # [B, M, O]
             tgt_mask: Tensor,                   # [B * K, M, M]
             mem_mask: Tensor,                   # [B * K, M, O]
+            agent_sequence: Tensor,             # [B, M]
             sample_num: int                     # K
     ) -> Tuple[Tensor, Dict]:                   # [B * K, M, model_dim], Dict
+        tgt_map = map_features(data, identities=agent_sequence)                         # [B, (M), model_dim]
+        mem_map = data['context_map'] if tgt_map.dim() == 2 else tgt_map               # [B, (M), model_dim]
+        map_repeats = [sample_num] + [1] * (tgt_map.dim() - 1)
         tf_out, map_out, attn_weights = self.tf_decoder(
             tgt=tf_in_pos,
             memory=context,
             tgt_tgt_self_other_mask=tgt_tgt_self_other_mask.repeat(sample_num, 1, 1),   # [B * K, M, M]
             tgt_mem_self_other_mask=tgt_mem_self_other_mask.repeat(sample_num, 1, 1),   # [B * K, M, O]
-            tgt_map=data['global_map_encoding'].repeat(sample_num, 1),                  # [B * K, model_dim]
-            mem_map=data['context_map'].repeat(sample_num, 1),                          # [B * K, model_dim]
+            tgt_map=tgt_map.repeat(map_repeats),                                        # [B * K, (M), model_dim]
+            mem_map=mem_map.repeat(map_repeats),                                        # [B * K, (M), model_dim]
             tgt_mask=tgt_mask,
             memory_mask=mem_mask
-        )       # [B * K, M, model_dim], [B * K, model_dim], Dict
+        )       # [B * K, M, model_dim], [B * K, (M), model_dim], Dict
         return tf_out, attn_weights
 
     def decode_next_timestep(
@@ -585,7 +638,7 @@ class FutureDecoder(nn.Module):
         tf_out, attn_weights = self.tf_decoder_call(
             data=data, tf_in_pos=tf_in_pos, context=context,
             tgt_tgt_self_other_mask=tgt_self_other_mask, tgt_mem_self_other_mask=mem_self_other_mask,
-            tgt_mask=tgt_mask, mem_mask=mem_mask, sample_num=sample_num
+            tgt_mask=tgt_mask, mem_mask=mem_mask, agent_sequence=agent_sequence, sample_num=sample_num
         )
 
         # Map back to physical space
@@ -725,8 +778,44 @@ class FutureDecoder(nn.Module):
         if need_weights:
             data['attn_weights'] = attn_weights
 
+    def chunk_size(self, data: Dict, sample_num: int) -> int:
+        if self.sample_memory_budget is None:
+            return min(self.sample_chunk_size or sample_num, sample_num)
+
+        # estimated size of the largest transient tensors of a decoding step (without autograd graph), per sample:
+        # attention weights over the decoded sequence and the context, feedforward and attention activations.
+        # the decoded sequence holds at most every agent at every timestep from the earliest last observation onwards
+        seq_len = data['agent_num'] * (self.future_frames - int(data['last_obs_timesteps'].min()))      # P
+        context_len = data['context_enc'].shape[1]                                                      # O
+        bytes_per_sample = data['context_enc'].shape[0] * data['context_enc'].element_size() * seq_len * (
+                self.n_head * (seq_len + context_len) + self.ff_dim + 4 * self.model_dim
+        )
+        chunk_size = int(self.sample_memory_budget * 1024 ** 2 // bytes_per_sample)
+        if self.sample_chunk_size is not None:
+            chunk_size = min(chunk_size, self.sample_chunk_size)
+        return max(1, min(chunk_size, sample_num))
+
+    def decode_traj_ar_chunked(self, data, mode, z, sample_num, chunk_size):
+        # z holds the latent codes of all K samples, which are decoded independently of each other:
+        # the decoded chunks are identical to the corresponding samples of a single decode_traj_ar call
+        batch_size = data['context_enc'].shape[0]
+        motions, agents = [], []
+        for start in range(0, sample_num, chunk_size):
+            chunk_num = min(chunk_size, sample_num - start)
+            self.decode_traj_ar(
+                data=data,
+                mode=mode,
+                context=data['context_enc'].repeat(chunk_num, 1, 1),        # [B * k, O, model_dim]
+                z=z[start * batch_size:(start + chunk_num) * batch_size],   # [B * k, N, nz]
+                sample_num=chunk_num
+            )
+            motions.append(data[f'{mode}_dec_motion'])
+            agents.append(data[f'{mode}_dec_agents'])
+        data[f'{mode}_dec_motion'] = torch.cat(motions, dim=0)              # [B * K, P, 2]
+        data[f'{mode}_dec_agents'] = torch.cat(agents, dim=0)               # [B * K, P]
+
     def forward(self, data, mode, sample_num=1, autoregress=True, z=None, need_weights=False):
-        context = data['context_enc'].repeat(sample_num, 1, 1)       # [B * K, O, model_dim], with sample_num <==> K
+        n_samples = data['context_enc'].shape[0] * sample_num      # B * K, with sample_num <==> K
 
         # p(z)
         prior_key = 'p_z_dist' + ('_infer' if mode == 'infer' else '')
@@ -740,12 +829,12 @@ class FutureDecoder(nn.Module):
         else:
             if self.z_type == 'gaussian':
                 data[prior_key] = Normal(
-                    mu=torch.zeros(context.shape[0], data['agent_num'], self.nz).to(data['context_enc'].device),
-                    logvar=torch.zeros(context.shape[0], data['agent_num'], self.nz).to(data['context_enc'].device)
+                    mu=torch.zeros(n_samples, data['agent_num'], self.nz).to(data['context_enc'].device),
+                    logvar=torch.zeros(n_samples, data['agent_num'], self.nz).to(data['context_enc'].device)
                 )
             else:
                 data[prior_key] = Categorical(
-                    logits=torch.zeros(context.shape[0], data['agent_num'], self.nz).to(data['context_enc'].device)
+                    logits=torch.zeros(n_samples, data['agent_num'], self.nz).to(data['context_enc'].device)
                 )
 
         if z is None:
@@ -757,10 +846,15 @@ class FutureDecoder(nn.Module):
                 raise ValueError('Unknown Mode!')
 
         if autoregress:
+            # (the attention weights are only available when decoding all samples at once)
+            chunk_size = sample_num if need_weights else self.chunk_size(data=data, sample_num=sample_num)
+            if chunk_size < sample_num:
+                self.decode_traj_ar_chunked(data=data, mode=mode, z=z, sample_num=sample_num, chunk_size=chunk_size)
+                return
             self.decode_traj_ar(
                 data=data,
                 mode=mode,
-                context=context,
+                context=data['context_enc'].repeat(sample_num, 1, 1),   # [B * K, O, model_dim]
                 z=z,
                 sample_num=sample_num,
                 need_weights=need_weights
@@ -769,6 +863,10 @@ class FutureDecoder(nn.Module):
 
 class AgentFormer(nn.Module):
     """ AgentFormer """
+
+    # entries of self.data holding the full resolution map inputs
+    map_input_keys = ['input_global_map', 'combined_map', 'scene_map', 'occlusion_map']
+
     def __init__(self, cfg):
         super().__init__()
 
@@ -781,7 +879,7 @@ class AgentFormer(nn.Module):
         fut_input_type = cfg.get('fut_input_type', input_type)
         dec_input_type = cfg.get('dec_input_type', [])
         ctx = {
-            'nz': cfg.nz,
+            'nz': cfg.get('nz', None),
             'z_type': cfg.get('z_type', 'gaussian'),
             'future_frames': cfg.future_frames,
             'motion_dim': cfg.motion_dim,
@@ -791,6 +889,7 @@ class AgentFormer(nn.Module):
             'dec_input_type': dec_input_type,
             'pred_type': pred_type,
             'tf_n_head': cfg.tf_n_head,
+            'tf_head_dim': cfg.get('tf_head_dim', None),
             'tf_model_dim': cfg.tf_model_dim,
             'tf_ff_dim': cfg.tf_ff_dim,
             'tf_dropout': cfg.tf_dropout,
@@ -805,8 +904,11 @@ class AgentFormer(nn.Module):
             'learn_prior': cfg.get('learn_prior', False),
             'global_map_attention': cfg.get('global_map_attention', False),
             'causal_attention': cfg.get('causal_attention', False),
+            'checkpoint_activations': cfg.get('checkpoint_activations', False),
+            'sample_chunk_size': cfg.get('sample_chunk_size', None),
+            'sample_memory_budget': cfg.get('sample_memory_budget', None),
             'context_encoder': cfg.context_encoder,
-            'future_encoder': cfg.future_encoder,
+            'future_encoder': cfg.get('future_encoder', None),
             'future_decoder': cfg.future_decoder
         }
         self.global_map_attention = cfg.get('global_map_attention', False)
@@ -831,18 +933,40 @@ class AgentFormer(nn.Module):
 
         # save all computed variables
         self.data = None
+        self.input_keys = []
+        # with <lean_memory>, the map inputs are released as soon as they are encoded, and the intermediate results
+        # of forward / inference passes are released at the end of the pass (see release_intermediates)
+        self.lean_memory = cfg.get('lean_memory', False)
+        self.memory_tracker = PhaseMemoryTracker() if cfg.get('report_memory', False) else None
 
         if self.global_map_attention:
-            map_enc_cfg = cfg.global_map_encoder
-            map_enc_cfg['map_resolution'] = cfg.global_map_resolution
-            self.global_map_encoder = MapEncoder(map_enc_cfg)
-            ctx['global_map_enc_dim'] = self.global_map_encoder.out_dim
+            # the map is either encoded as a whole into a single feature ('global'), or as one patch centered on
+            # every agent, each encoded into a feature attended to by the sequence elements of that agent ('local')
+            self.map_encoding = cfg.get('map_encoding', 'global')      # 'global' | 'local'
+            assert self.map_encoding in ['global', 'local']
+            map_enc_cfg = cfg.global_map_encoder if self.map_encoding == 'global' else cfg.local_map_encoder
+            # the map encoder can consume a downsampled level of the maps (of resolution global_map_resolution / 2 ** l)
+            self.map_pyramid_level = map_enc_cfg.get('pyramid_level', 0)
+            self.scene_map_key = map_pyramid_key('scene_map', level=self.map_pyramid_level)
+            self.occlusion_map_key = map_pyramid_key('dist_transformed_occlusion_map', level=self.map_pyramid_level)
+            map_enc_cfg['map_resolution'] = cfg.global_map_resolution // 2 ** self.map_pyramid_level
+            map_enc_cfg['checkpoint_activations'] = cfg.get('checkpoint_activations', False)
+            if self.map_encoding == 'global':
+                self.global_map_encoder = MapEncoder(map_enc_cfg)
+                ctx['global_map_enc_dim'] = self.global_map_encoder.out_dim
+            else:
+                self.local_map_encoder = LocalMapEncoder(map_enc_cfg)
+                ctx['global_map_enc_dim'] = self.local_map_encoder.out_dim
+                assert ctx['global_map_enc_dim'] == ctx['tf_model_dim'], "local map features must be of tf_model_dim"
             if map_enc_cfg.use_scene_map and map_enc_cfg.use_occlusion_map:
                 self.set_map_data = self.set_map_data_combined
+                self.map_inputs = [self.scene_map_key, self.occlusion_map_key]
             elif map_enc_cfg.use_scene_map and not map_enc_cfg.use_occlusion_map:
                 self.set_map_data = self.set_map_data_scene
+                self.map_inputs = [self.scene_map_key]
             elif not map_enc_cfg.use_scene_map and map_enc_cfg.use_occlusion_map:
                 self.set_map_data = self.set_map_data_occlusion
+                self.map_inputs = [self.occlusion_map_key]
             else:
                 raise NotImplementedError
 
@@ -852,6 +976,10 @@ class AgentFormer(nn.Module):
 
         # models
         self.context_encoder = ContextEncoder(ctx)
+        self.build_future_modules(cfg=cfg, ctx=ctx)
+
+    def build_future_modules(self, cfg, ctx: Dict) -> None:
+        # the modules encoding / decoding the future (see OneShotAgentFormer for a model with a different decoder)
         self.future_encoder = FutureEncoder(ctx)
         self.future_decoder = FutureDecoder(ctx)
 
@@ -859,84 +987,181 @@ class AgentFormer(nn.Module):
         self.device = device
         self.to(device)
 
+    def quantize(self) -> None:
+        # dynamic int8 quantization of the linear layers (attention projections, feed-forward layers, input / output
+        # networks and latent distribution networks), for CPU inference. The map encoder is kept in float.
+        assert torch.device(self.device).type == 'cpu', "quantized models can only be run on CPU"
+        quantize_linear_layers(self, excluded=('map_encoder',))
+
+    def set_precision(self, precision: str) -> None:
+        # runs the transformer encoder / decoders and the map CNN in the given precision ('fp32' | 'bf16'), while the
+        # input / output networks, latent distributions, homographies and losses remain in float32 (see cast_submodules)
+        assert precision in PRECISIONS
+        modules = [self.context_encoder.tf_encoder, self.future_encoder.tf_decoder, self.future_decoder.tf_decoder]
+        if self.global_map_attention:
+            modules.append(self.global_map_encoder if self.map_encoding == 'global' else self.local_map_encoder.encoder)
+        cast_submodules(modules, dtype=PRECISIONS[precision])
+
+    @staticmethod
+    def output_keys() -> List[str]:
+        # the entries of self.data produced by forward / inference passes which are retained until the next set_data
+        # (used by compute_loss, and by the scripts saving predictions)
+        keys = ['q_z_dist', 'p_z_dist', 'attn_weights']
+        for mode in ['train', 'recon', 'infer']:
+            keys.extend([f'{mode}_dec_motion', f'{mode}_dec_agents', f'{mode}_dec_past_mask', f'{mode}_dec_timesteps'])
+        return keys
+
+    def release(self, *keys: str) -> None:
+        for key in keys:
+            self.data.pop(key, None)
+
+    def release_intermediates(self) -> None:
+        # releases every entry of self.data which is neither an input (apart from the map inputs), the map
+        # encoding (from which the context can be encoded again), nor an output
+        if not self.lean_memory:
+            return
+        retained = {*self.input_keys, 'global_map_encoding', 'agent_map_encoding', *self.output_keys()}
+        self.release(*[key for key in self.data.keys() if key not in retained])
+
+    def memory_phase(self, name: str):
+        if self.memory_tracker is None:
+            return contextlib.nullcontext()
+        return self.memory_tracker.phase(name=name, device=self.device)
+
+    def required_inputs(self) -> List[str]:
+        # the dataset fields read by set_data
+        inputs = [
+            'identities', 'timesteps', 'scene_orig',
+            'obs_position_sequence', 'obs_velocity_sequence', 'obs_timestep_sequence', 'obs_identity_sequence',
+            'last_obs_positions', 'last_obs_timesteps',
+            'pred_position_sequence', 'pred_velocity_sequence', 'pred_timestep_sequence', 'pred_identity_sequence'
+        ]
+        if self.global_map_attention:
+            inputs.extend([*self.map_inputs, self.occl_loss_map_key, 'map_homography'])
+        if self.input_impute_markers:
+            inputs.append('imputation_mask')
+        return inputs
+
     def set_map_data_combined(self, data: Dict) -> None:
-        self.data['scene_map'] = data['scene_map'].detach().clone().to(self.device)  # [B, C, H, W]
-        self.data['occlusion_map'] = data['dist_transformed_occlusion_map'] \
-            .detach().clone().to(self.device).unsqueeze(1)  # [B, 1, H, W]
-        self.data['combined_map'] = torch.cat(
-            (self.data['scene_map'], self.data['occlusion_map']), dim=1
+        # the map channels are written straight into the combined map buffer, of which the scene and occlusion maps
+        # are views
+        scene_map = data[self.scene_map_key]                            # [B, C, H, W]
+        occlusion_map = data[self.occlusion_map_key]                    # [B, H, W]
+        n_channels = scene_map.shape[1]
+        combined_map = torch.empty(
+            [scene_map.shape[0], n_channels + 1, *scene_map.shape[2:]], dtype=scene_map.dtype, device=self.device
         )  # [B, (C) + (1), H, W]
+        hand_over_into(combined_map[:, :n_channels], scene_map)
+        hand_over_into(combined_map[:, n_channels], occlusion_map)
+        self.data['scene_map'] = combined_map[:, :n_channels]  # [B, C, H, W]
+        self.data['occlusion_map'] = combined_map[:, n_channels:]  # [B, 1, H, W]
+        self.data['combined_map'] = combined_map
         self.data['input_global_map'] = self.data['combined_map']
 
     def set_map_data_scene(self, data: Dict) -> None:
-        self.data['scene_map'] = data['scene_map'].detach().clone().to(self.device)  # [B, C, H, W]
+        self.data['scene_map'] = hand_over(data[self.scene_map_key], self.device)  # [B, C, H, W]
         self.data['input_global_map'] = self.data['scene_map']
 
     def set_map_data_occlusion(self, data: Dict) -> None:
-        self.data['occlusion_map'] = data['dist_transformed_occlusion_map'] \
-            .detach().clone().to(self.device).unsqueeze(1)  # [B, 1, H, W]
+        self.data['occlusion_map'] = hand_over(
+            data[self.occlusion_map_key], self.device
+        ).unsqueeze(1)  # [B, 1, H, W]
         self.data['input_global_map'] = self.data['occlusion_map']
 
     def set_data(self, data: Dict) -> None:
         # NOTE: in our case, batch size B is always 1
+        # the model takes ownership of the tensors of <data> (see hand_over): they are not copied if they already
+        # live on the model's device
         self.data = defaultdict(lambda: None)
 
-        self.data['valid_id'] = data['identities'].detach().clone().to(self.device)     # [B, N]
+        self.data['valid_id'] = hand_over(data['identities'], self.device)         # [B, N]
         self.data['T_total'] = data['timesteps'].shape[-1]
         self.data['agent_num'] = self.data['valid_id'].shape[-1]
-        self.data['timesteps'] = data['timesteps'].detach().clone().to(self.device)     # [B, T]
-        self.data['scene_orig'] = data['scene_orig'].detach().clone().to(self.device)   # [B, 2]
-
-        self.data['obs_position_sequence'] = data['obs_position_sequence'].detach().clone().to(self.device)     # [B, O, 2]
-        self.data['obs_velocity_sequence'] = data['obs_velocity_sequence'].detach().clone().to(self.device)     # [B, O, 2]
-        self.data['obs_timestep_sequence'] = data['obs_timestep_sequence'].detach().clone().to(self.device)     # [B, O]
-        self.data['obs_identity_sequence'] = data['obs_identity_sequence'].detach().clone().to(self.device)     # [B, O]
-        self.data['last_obs_positions'] = data['last_obs_positions'].detach().clone().to(self.device)               # [B, N, 2]
-        self.data['last_obs_timesteps'] = data['last_obs_timesteps'].detach().clone().to(self.device)               # [B, N]
-        self.data['agent_mask'] = torch.zeros([1, self.data['agent_num'], self.data['agent_num']]).to(self.device)  # [B, N, N]
-
-        self.data['pred_position_sequence'] = data['pred_position_sequence'].detach().clone().to(self.device)       # [B, P, 2]
-        self.data['pred_velocity_sequence'] = data['pred_velocity_sequence'].detach().clone().to(self.device)       # [B, P, 2]
-        self.data['pred_timestep_sequence'] = data['pred_timestep_sequence'].detach().clone().to(self.device)       # [B, P]
-        self.data['pred_identity_sequence'] = data['pred_identity_sequence'].detach().clone().to(self.device)       # [B, P]
+        self.data['timesteps'] = hand_over(data['timesteps'], self.device)         # [B, T]
+        self.data['scene_orig'] = hand_over(data['scene_orig'], self.device)       # [B, 2]
+
+        self.data['obs_position_sequence'] = hand_over(data['obs_position_sequence'], self.device)     # [B, O, 2]
+        self.data['obs_velocity_sequence'] = hand_over(data['obs_velocity_sequence'], self.device)     # [B, O, 2]
+        self.data['obs_timestep_sequence'] = hand_over(data['obs_timestep_sequence'], self.device)     # [B, O]
+        self.data['obs_identity_sequence'] = hand_over(data['obs_identity_sequence'], self.device)     # [B, O]
+        self.data['last_obs_positions'] = hand_over(data['last_obs_positions'], self.device)           # [B, N, 2]
+        self.data['last_obs_timesteps'] = hand_over(data['last_obs_timesteps'], self.device)           # [B, N]
+        self.data['agent_mask'] = torch.zeros(
+            [1, self.data['agent_num'], self.data['agent_num']], device=self.device
+        )  # [B, N, N]
+
+        self.data['pred_position_sequence'] = hand_over(data['pred_position_sequence'], self.device)   # [B, P, 2]
+        self.data['pred_velocity_sequence'] = hand_over(data['pred_velocity_sequence'], self.device)   # [B, P, 2]
+        self.data['pred_timestep_sequence'] = hand_over(data['pred_timestep_sequence'], self.device)   # [B, P]
+        self.data['pred_identity_sequence'] = hand_over(data['pred_identity_sequence'], self.device)   # [B, P]
 
         if self.global_map_attention:
             self.set_map_data(data=data)
 
-            self.data['occlusion_loss_map'] = data[self.occl_loss_map_key] \
-                .detach().clone().to(self.device)  # [B, H, W]
-            self.data['map_homography'] = data['map_homography'].detach().clone().to(self.device)  # [B, 3, 3]
+            self.data['occlusion_loss_map'] = hand_over(data[self.occl_loss_map_key], self.device)  # [B, H, W]
+            self.data['map_homography'] = hand_over(data['map_homography'], self.device)  # [B, 3, 3]
 
         if self.input_impute_markers:
-            self.data['obs_imputation_sequence'] = data['imputation_mask'] \
-                .detach().clone().unsqueeze(-1).to(torch.float32).to(self.device)      # [B, O, 1]
+            self.data['obs_imputation_sequence'] = hand_over(data['imputation_mask'], self.device) \
+                .unsqueeze(-1).to(torch.float32)      # [B, O, 1]
+
+        self.input_keys = [key for key in self.data.keys() if key not in self.map_input_keys]
 
     def step_annealer(self):
         for anl in self.param_annealers:
             anl.step()
 
+    def encode_map(self):
+        with self.memory_phase('map_encoding'):
+            if self.map_encoding == 'local':
+                # the homography relates to the full resolution maps
+                level_scaling = torch.diag(torch.tensor(
+                    [0.5 ** self.map_pyramid_level] * 2 + [1.], device=self.device
+                )).to(self.data['map_homography'])                  # [3, 3]
+                self.data['agent_map_encoding'] = self.local_map_encoder(
+                    maps=self.data['input_global_map'],             # [B, C, H, W]
+                    homography=level_scaling @ self.data['map_homography'],
+                    positions=self.data['last_obs_positions'],      # [B, N, 2]
+                    headings=last_observed_headings(self.data)      # [B, N]
+                )                                                   # [B, N, model_dim]
+            else:
+                self.data['global_map_encoding'] = self.global_map_encoder(self.data['input_global_map'])
+        if self.lean_memory:
+            self.release(*self.map_input_keys)
+
     def forward(self):
         if self.global_map_attention:
-            self.data['global_map_encoding'] = self.global_map_encoder(self.data['input_global_map'])
+            self.encode_map()
 
-        self.context_encoder(self.data)
-        self.future_encoder(self.data)
-        self.future_decoder(self.data, mode='train', autoregress=self.ar_train)
+        with self.memory_phase('context_encoding'):
+            self.context_encoder(self.data)
+        with self.memory_phase('future_encoding'):
+            self.future_encoder(self.data)
+        with self.memory_phase('train_decoding'):
+            self.future_decoder(self.data, mode='train', autoregress=self.ar_train)
 
         if self.compute_sample:
             self.inference(sample_num=self.loss_cfg['sample']['k'])
 
+        self.release_intermediates()
         return self.data
 
     def inference(self, mode='infer', sample_num=20, need_weights=False):
-        if self.global_map_attention:
-            self.data['global_map_encoding'] = self.global_map_encoder(self.data['input_global_map'])
+        # (the map inputs are only missing if they were released after having been encoded)
+        if self.global_map_attention and self.data['input_global_map'] is not None:
+            self.encode_map()
         if self.data['context_enc'] is None:
-            self.context_encoder(self.data)
+            with self.memory_phase('context_encoding'):
+                self.context_encoder(self.data)
         if mode == 'recon':
             sample_num = 1
-            self.future_encoder(self.data)
-        self.future_decoder(self.data, mode=mode, sample_num=sample_num, autoregress=True, need_weights=need_weights)
+            with self.memory_phase('future_encoding'):
+                self.future_encoder(self.data)
+        with self.memory_phase(f'{mode}_decoding'):
+            self.future_decoder(
+                self.data, mode=mode, sample_num=sample_num, autoregress=True, need_weights=need_weights
+            )
+        self.release_intermediates()
         return self.data[f'{mode}_dec_motion'], self.data       # [B * sample_num, P, 2], Dict
 
     def compute_loss(self):
@@ -61,14 +61,15 @@ class AgentAwareAttentionEncoderLayer(BaseAttentionEncoderLayer):
     def __init__(
             self, d_model: int, n_head: int,
             dim_feedforward: int = 2048, dropout: float = 0.1, activation: str = 'relu',
-            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True
+            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
+            head_dim: Optional[int] = None
     ):
         super().__init__(
             d_model=d_model, dim_feedforward=dim_feedforward, dropout=dropout, activation=activation
         )
         self.self_attn = AgentAwareAttention(
             traj_dim=d_model, v_dim=d_model, num_heads=n_head, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, head_dim=head_dim
         )
 
     def forward(
@@ -102,14 +103,15 @@ class MapAgentAwareAttentionEncoderLayer(BaseAttentionEncoderLayer):
             self, d_model: int, n_head: int,
             dim_feedforward: int = 2048, dropout: float = 0.1, activation: str = 'relu',
             bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
-            bias_map: bool = False
+            bias_map: bool = False, head_dim: Optional[int] = None
     ):
         super().__init__(
             d_model=d_model, dim_feedforward=dim_feedforward, dropout=dropout, activation=activation
         )
         self.self_attn = MapAgentAwareAttention(
             traj_dim=d_model, map_dim=d_model, v_dim=d_model, num_heads=n_head, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, bias_map=bias_map
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, bias_map=bias_map,
+            head_dim=head_dim
         )
 
     def forward(
@@ -180,7 +182,8 @@ class AgentAwareAttentionDecoderLayer(BaseAttentionDecoderLayer):
     def __init__(
             self, d_model: int, n_head: int,
             dim_feedforward: int = 2048, dropout: float = 0.1, activation: str = 'relu',
-            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True
+            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
+            head_dim: Optional[int] = None
     ):
         super().__init__(
             d_model=d_model, dim_feedforward=dim_feedforward, dropout=dropout, activation=activation
@@ -188,11 +191,11 @@ class AgentAwareAttentionDecoderLayer(BaseAttentionDecoderLayer):
 
         self.self_attn = AgentAwareAttention(
             traj_dim=d_model, v_dim=d_model, num_heads=n_head, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, head_dim=head_dim
         )
         self.cross_attn = AgentAwareAttention(
             traj_dim=d_model, v_dim=d_model, num_heads=n_head, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, head_dim=head_dim
         )
 
     def forward(
@@ -232,18 +235,20 @@ class MapAgentAwareAttentionDecoderLayer(BaseAttentionDecoderLayer):
             self, d_model: int, n_head: int,
             dim_feedforward: int = 2048, dropout: float = 0.1, activation: str = 'relu',
             bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
-            bias_map: bool = False
+            bias_map: bool = False, head_dim: Optional[int] = None
     ):
         super().__init__(
             d_model=d_model, dim_feedforward=dim_feedforward, dropout=dropout, activation=activation
         )
         self.self_attn = MapAgentAwareAttention(
             traj_dim=d_model, map_dim=d_model, v_dim=d_model, num_heads=n_head, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, bias_map=bias_map
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, bias_map=bias_map,
+            head_dim=head_dim
         )
         self.cross_attn = MapAgentAwareAttention(
             traj_dim=d_model, map_dim=d_model, v_dim=d_model, num_heads=n_head, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, bias_map=bias_map
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, bias_map=bias_map,
+            head_dim=head_dim
         )
 
     def forward(
@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 from torch.nn.modules.module import Module
 
-from typing import Tuple
+from typing import Optional, Tuple
 Tensor = torch.Tensor
 
 
@@ -13,7 +13,8 @@ class SelfOtherAwareAttention(Module):
 
     def __init__(
             self, qk_dim: int, v_dim: int, num_heads: int, dropout: float = 0.1,
-            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True
+            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
+            head_dim: Optional[int] = None
     ):
         super().__init__()
         self.qk_dim = qk_dim                    # T
@@ -24,23 +25,31 @@ class SelfOtherAwareAttention(Module):
         self.bias_other = bias_other
         self.bias_out = bias_out
 
-        self.qk_head_dim = qk_dim // num_heads          # t
-        assert self.qk_head_dim * self.num_heads == self.qk_dim, "traj_dim must be divisible by num_heads"
+        # the heads split the qk / v dimensions by default. Their dimension can also be set explicitly with <head_dim>
+        # (e.g., for models whose heads have been pruned, see prune_model.py): the H heads then span H * head_dim
+        # dimensions, which are projected back to V by the output MLP
+        if head_dim is None:
+            self.qk_head_dim = qk_dim // num_heads          # t
+            assert self.qk_head_dim * self.num_heads == self.qk_dim, "traj_dim must be divisible by num_heads"
 
-        self.v_head_dim = v_dim // num_heads            # v
-        assert self.v_head_dim * self.num_heads == self.v_dim, "vdim must be divisible by num_heads"
+            self.v_head_dim = v_dim // num_heads            # v
+            assert self.v_head_dim * self.num_heads == self.v_dim, "vdim must be divisible by num_heads"
+        else:
+            self.qk_head_dim = self.v_head_dim = head_dim
+        self.qk_heads_dim = self.num_heads * self.qk_head_dim      # H * t
+        self.v_heads_dim = self.num_heads * self.v_head_dim         # H * v
 
         self.qk_scaling = float(self.qk_head_dim ** -0.5)
 
         # MLP's for mapping trajectory sequences to keys, queries and values
-        self.w_q_self = torch.nn.Linear(self.qk_dim, self.qk_dim, bias=self.bias_self)
-        self.w_q_other = torch.nn.Linear(self.qk_dim, self.qk_dim, bias=self.bias_other)
-        self.w_k_self = torch.nn.Linear(self.qk_dim, self.qk_dim, bias=self.bias_self)
-        self.w_k_other = torch.nn.Linear(self.qk_dim, self.qk_dim, bias=self.bias_other)
-        self.w_v = torch.nn.Linear(self.qk_dim, self.v_dim, bias=self.bias_other)
+        self.w_q_self = torch.nn.Linear(self.qk_dim, self.qk_heads_dim, bias=self.bias_self)
+        self.w_q_other = torch.nn.Linear(self.qk_dim, self.qk_heads_dim, bias=self.bias_other)
+        self.w_k_self = torch.nn.Linear(self.qk_dim, self.qk_heads_dim, bias=self.bias_self)
+        self.w_k_other = torch.nn.Linear(self.qk_dim, self.qk_heads_dim, bias=self.bias_other)
+        self.w_v = torch.nn.Linear(self.qk_dim, self.v_heads_dim, bias=self.bias_other)
 
         # output MLP
-        self.fc = torch.nn.Linear(self.v_dim, self.v_dim, bias=self.bias_out)
+        self.fc = torch.nn.Linear(self.v_heads_dim, self.v_dim, bias=self.bias_out)
 
         # dropout layer
         self.dropout = torch.nn.Dropout(dropout)
@@ -76,10 +85,10 @@ class SelfOtherAwareAttention(Module):
         B, L, _ = q.size()
         _, S, _ = k.size()
 
-        q_self = self.w_q_self(q) * self.qk_scaling             # [B, L, T]
-        q_other = self.w_q_other(q) * self.qk_scaling           # [B, L, T]
-        k_self = self.w_k_self(k)                               # [B, S, T]
-        k_other = self.w_k_other(k)                             # [B, S, T]
+        q_self = self.w_q_self(q) * self.qk_scaling             # [B, L, H * t]
+        q_other = self.w_q_other(q) * self.qk_scaling           # [B, L, H * t]
+        k_self = self.w_k_self(k)                               # [B, S, H * t]
+        k_other = self.w_k_other(k)                             # [B, S, H * t]
 
         q_self = q_self.view(B, L, self.num_heads, self.qk_head_dim).transpose(1, 2)          # [B, H, L, t]
         q_other = q_other.view(B, L, self.num_heads, self.qk_head_dim).transpose(1, 2)        # [B, H, L, t]
@@ -101,11 +110,12 @@ class SelfOtherAwareAttention(Module):
 class AgentAwareAttention(SelfOtherAwareAttention):
     def __init__(
             self, traj_dim: int, v_dim: int, num_heads: int, dropout: float = 0.1,
-            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True
+            bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
+            head_dim: Optional[int] = None
     ):
         super().__init__(
             qk_dim=traj_dim, v_dim=v_dim, num_heads=num_heads, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, head_dim=head_dim
         )
 
     def forward(
@@ -121,7 +131,7 @@ class AgentAwareAttention(SelfOtherAwareAttention):
         _, S, _ = k.size()
 
         # mapping inputs to keys, queries and values
-        v = self.w_v(v)                                                         # [B, S, V]
+        v = self.w_v(v)                                                         # [B, S, H * v]
         v = v.view(B, S, self.num_heads, self.v_head_dim).transpose(1, 2)    # [B, H, S, v]
 
         attention = self.self_other_scaled_dot_product(
@@ -133,7 +143,7 @@ class AgentAwareAttention(SelfOtherAwareAttention):
 
         attention_output = attention @ v                # [B, H, L, S] @ [B, H, S, v] = [B, H, L, v]
 
-        attention_output = attention_output.transpose(1, 2).reshape(B, L, self.v_dim)       # [B, L, V]
+        attention_output = attention_output.transpose(1, 2).reshape(B, L, self.v_heads_dim)     # [B, L, H * v]
 
         attention_output = self.fc(attention_output)                                        # [B, L, V]
 
@@ -145,30 +155,33 @@ class MapAgentAwareAttention(SelfOtherAwareAttention):
     def __init__(
             self, traj_dim: int, map_dim: int, v_dim: int, num_heads: int, dropout: float = 0.1,
             bias_self: bool = False, bias_other: bool = False, bias_out: bool = True,
-            bias_map: bool = False
+            bias_map: bool = False, head_dim: Optional[int] = None
     ):
         super().__init__(
             qk_dim=traj_dim, v_dim=v_dim, num_heads=num_heads, dropout=dropout,
-            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out
+            bias_self=bias_self, bias_other=bias_other, bias_out=bias_out, head_dim=head_dim
         )
         self.qk_map_dim = map_dim                   # M
 
         self.bias_map = bias_map
 
-        self.qk_map_head_dim = map_dim // num_heads        # m
-        assert self.qk_map_head_dim * self.num_heads == self.qk_map_dim, "map_dim must be divisible by num_heads"
+        if head_dim is None:
+            self.qk_map_head_dim = map_dim // num_heads        # m
+            assert self.qk_map_head_dim * self.num_heads == self.qk_map_dim, "map_dim must be divisible by num_heads"
+        else:
+            self.qk_map_head_dim = head_dim
 
         self.qk_map_scaling = float(self.qk_map_head_dim ** -0.5)
 
         # MLP's for map keys to attend to trajectory sequence queries
-        self.w_q_traj_map = torch.nn.Linear(self.qk_dim, self.qk_dim, bias=self.bias_map)
-        self.w_k_map_agents = torch.nn.Linear(self.qk_map_dim, self.qk_dim, bias=self.bias_map)
+        self.w_q_traj_map = torch.nn.Linear(self.qk_dim, self.qk_heads_dim, bias=self.bias_map)
+        self.w_k_map_agents = torch.nn.Linear(self.qk_map_dim, self.qk_heads_dim, bias=self.bias_map)
 
         # MLP for map values
-        self.w_v_map = torch.nn.Linear(self.qk_map_dim, self.v_dim, bias=self.bias_map)
+        self.w_v_map = torch.nn.Linear(self.qk_map_dim, self.v_heads_dim, bias=self.bias_map)
 
         # output MLP for the map
-        self.fc_map = torch.nn.Linear(self.v_dim, self.v_dim, bias=self.bias_out)
+        self.fc_map = torch.nn.Linear(self.v_heads_dim, self.v_dim, bias=self.bias_out)
 
         self._reset_map_aware_parameters()
 
@@ -191,15 +204,22 @@ class MapAgentAwareAttention(SelfOtherAwareAttention):
             v: Tensor,                  # [B, S, T]
             self_other_mask: Tensor,    # [B, L, S]
             mask: Tensor,               # [B, L, S]
-            k_map: Tensor,              # [B, M]
-            v_map: Tensor               # [B, M]
+            k_map: Tensor,              # [B, M] | [B, L, M]
+            v_map: Tensor               # [B, M] | [B, L, M]
     ) -> Tuple[Tensor, Tensor]:         # [B, L, V], [B, L, S+1]
+        # the map is either a single feature attended to by every query, or one feature per query
+        # (e.g., the local map feature of the query's agent)
+        if k_map.dim() == 3:
+            return self.forward_query_maps(
+                q=q, k=k, v=v, self_other_mask=self_other_mask, mask=mask, k_map=k_map, v_map=v_map
+            )
+
         B, L, _ = q.size()
         _, S, _ = k.size()
 
         # map and trajectory values
-        v_map_ = self.w_v_map(v_map)    # [B, V]
-        v_traj = self.w_v(v)            # [B, S, V]
+        v_map_ = self.w_v_map(v_map)    # [B, H * v]
+        v_traj = self.w_v(v)            # [B, S, H * v]
         v_map_ = v_map_.view(B, self.num_heads, 1, self.v_head_dim)                     # [B, H, 1, v]
         v_traj = v_traj.view(B, S, self.num_heads, self.v_head_dim).transpose(1, 2)     # [B, H, S, v]
 
@@ -209,8 +229,8 @@ class MapAgentAwareAttention(SelfOtherAwareAttention):
         )       # [B, H, L, S]
 
         # trajectory queries, map keys and values
-        q_traj_map = self.w_q_traj_map(q) * self.qk_map_scaling     # [B, L, T]
-        k_map_agents = self.w_k_map_agents(k_map)                   # [B, T]
+        q_traj_map = self.w_q_traj_map(q) * self.qk_map_scaling     # [B, L, H * t]
+        k_map_agents = self.w_k_map_agents(k_map)                   # [B, H * t]
         q_traj_map = q_traj_map.view(B, L, self.num_heads, self.qk_map_head_dim).transpose(1, 2)    # [B, H, L, t]
         k_map_agents = k_map_agents.view(B, self.num_heads, self.qk_head_dim, 1)                    # [B, H, t, 1]
 
@@ -232,8 +252,54 @@ class MapAgentAwareAttention(SelfOtherAwareAttention):
         attention_output = attention @ combined_v      # [B, H, L, S+1] @ [B, H, S+1, v] = [B, H, L, v]
 
         # return output
-        attention_output = attention_output.transpose(1, 2).reshape(B, L, self.v_dim)       # [B, L, V]
+        attention_output = attention_output.transpose(1, 2).reshape(B, L, self.v_heads_dim)     # [B, L, H * v]
+
+        attention_output = self.fc(attention_output)                                        # [B, L, V]
+
+        return attention_output, attention.sum(dim=1) / self.num_heads
+
+    def forward_query_maps(
+            self,
+            q: Tensor,                  # [B, L, T]
+            k: Tensor,                  # [B, S, T]
+            v: Tensor,                  # [B, S, T]
+            self_other_mask: Tensor,    # [B, L, S]
+            mask: Tensor,               # [B, L, S]
+            k_map: Tensor,              # [B, L, M]
+            v_map: Tensor               # [B, L, M]
+    ) -> Tuple[Tensor, Tensor]:         # [B, L, V], [B, L, S+1]
+        B, L, _ = q.size()
+        _, S, _ = k.size()
+
+        # map and trajectory values
+        v_map_ = self.w_v_map(v_map)    # [B, L, H * v]
+        v_traj = self.w_v(v)            # [B, S, H * v]
+        v_map_ = v_map_.view(B, L, self.num_heads, self.v_head_dim).transpose(1, 2)     # [B, H, L, v]
+        v_traj = v_traj.view(B, S, self.num_heads, self.v_head_dim).transpose(1, 2)     # [B, H, S, v]
+
+        # cross agent attention
+        cross_agent_attention = self.self_other_scaled_dot_product(
+            q=q, k=k, self_other_mask=self_other_mask, mask=mask
+        )       # [B, H, L, S]
+
+        # trajectory queries, map keys and values
+        q_traj_map = self.w_q_traj_map(q) * self.qk_map_scaling     # [B, L, H * t]
+        k_map_agents = self.w_k_map_agents(k_map)                   # [B, L, H * t]
+        q_traj_map = q_traj_map.view(B, L, self.num_heads, self.qk_map_head_dim).transpose(1, 2)    # [B, H, L, t]
+        k_map_agents = k_map_agents.view(B, L, self.num_heads, self.qk_head_dim).transpose(1, 2)    # [B, H, L, t]
+
+        # agent map attention, every query attends to its own map feature
+        agent_map_attention = (q_traj_map * k_map_agents).sum(dim=-1, keepdim=True)     # [B, H, L, 1]
+
+        # Combine attention scores, softmax, dropout
+        attention = torch.cat([agent_map_attention, cross_agent_attention], dim=-1)     # [B, H, L, S+1]
+        attention = F.softmax(attention, dim=-1)                                        # [B, H, L, S+1]
+        attention = self.dropout(attention)                                             # [B, H, L, S+1]
+
+        # score multiply values: [B, H, L, 1] * [B, H, L, v] + [B, H, L, S] @ [B, H, S, v] = [B, H, L, v]
+        attention_output = attention[..., :1] * v_map_ + attention[..., 1:] @ v_traj
 
+        attention_output = attention_output.transpose(1, 2).reshape(B, L, self.v_heads_dim)     # [B, L, H * v]
         attention_output = self.fc(attention_output)                                        # [B, L, V]
 
         return attention_output, attention.sum(dim=1) / self.num_heads
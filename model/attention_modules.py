@@ -2,6 +2,7 @@ import torch
 import copy
 from torch.nn.modules.module import Module
 from torch.nn.modules.container import ModuleList
+from utils.torch_ops import checkpointed
 from model.attention_layers import \
     AgentAwareAttentionEncoderLayer, AgentAwareAttentionDecoderLayer,\
     MapAgentAwareAttentionEncoderLayer, MapAgentAwareAttentionDecoderLayer
@@ -14,15 +15,21 @@ def _get_clones(module, N):
     return ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
+# With <checkpointing>, the activations of every layer are recomputed during the backward pass instead of being kept
+# in memory (only while gradients are being computed). The attention weights are then not returned (None), and the map
+# features, which the map layers pass through unchanged, are only used as inputs of the checkpointed layers.
+
+
 # ENCODERS ############################################################################################################
 
 
 class AgentFormerEncoder(Module):
 
-    def __init__(self, layer_params: Dict, num_layers: int):
+    def __init__(self, layer_params: Dict, num_layers: int, checkpointing: bool = False):
         super().__init__()
         self.layer_params = layer_params
         self.num_layers = num_layers
+        self.checkpointing = checkpointing
         layer = AgentAwareAttentionEncoderLayer(**layer_params)
         self.layers = _get_clones(layer, num_layers)
 
@@ -34,6 +41,14 @@ class AgentFormerEncoder(Module):
         output = src
 
         for layer in self.layers:
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpointed(
+                    lambda src_, layer_=layer: layer_(
+                        src=src_, src_self_other_mask=src_self_other_mask, src_mask=src_mask
+                    ),
+                    output
+                )
+                continue
             output = layer(
                 src=output, src_self_other_mask=src_self_other_mask, src_mask=src_mask,
             )
@@ -43,10 +58,11 @@ class AgentFormerEncoder(Module):
 
 class OcclusionFormerEncoder(Module):
 
-    def __init__(self, layer_params: Dict, num_layers: int):
+    def __init__(self, layer_params: Dict, num_layers: int, checkpointing: bool = False):
         super().__init__()
         self.layer_params = layer_params
         self.num_layers = num_layers
+        self.checkpointing = checkpointing
         layer = MapAgentAwareAttentionEncoderLayer(**layer_params)
         self.layers = _get_clones(layer, num_layers)
 
@@ -59,6 +75,15 @@ class OcclusionFormerEncoder(Module):
         map_output = map_feature
 
         for layer in self.layers:
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpointed(
+                    lambda src_, map_feature_, layer_=layer: layer_(
+                        src=src_, src_self_other_mask=src_self_other_mask, map_feature=map_feature_,
+                        src_mask=src_mask
+                    )[0],
+                    output, map_output
+                )
+                continue
             output, map_output = layer(
                 src=output, src_self_other_mask=src_self_other_mask, map_feature=map_output, src_mask=src_mask,
             )
@@ -71,10 +96,11 @@ class OcclusionFormerEncoder(Module):
 
 class AgentFormerDecoder(Module):
 
-    def __init__(self, layer_params: Dict, num_layers: int):
+    def __init__(self, layer_params: Dict, num_layers: int, checkpointing: bool = False):
         super().__init__()
         self.layer_params = layer_params
         self.num_layers = num_layers
+        self.checkpointing = checkpointing
         layer = AgentAwareAttentionDecoderLayer(**layer_params)
         self.layers = _get_clones(layer, num_layers)
 
@@ -89,6 +115,17 @@ class AgentFormerDecoder(Module):
         cross_attn_weights = [None] * len(self.layers)
 
         for i, mod in enumerate(self.layers):
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpointed(
+                    lambda tgt_, memory_, mod_=mod: mod_(
+                        tgt=tgt_, memory=memory_,
+                        tgt_tgt_self_other_mask=tgt_tgt_self_other_mask,
+                        tgt_mem_self_other_mask=tgt_mem_self_other_mask,
+                        tgt_mask=tgt_mask, memory_mask=memory_mask
+                    )[0],
+                    output, memory
+                )
+                continue
             output, self_attn_weights[i], cross_attn_weights[i] = mod(
                 tgt=output, memory=memory,
                 tgt_tgt_self_other_mask=tgt_tgt_self_other_mask, tgt_mem_self_other_mask=tgt_mem_self_other_mask,
@@ -100,10 +137,11 @@ class AgentFormerDecoder(Module):
 
 class OcclusionFormerDecoder(Module):
 
-    def __init__(self, layer_params, num_layers):
+    def __init__(self, layer_params, num_layers, checkpointing: bool = False):
         super().__init__()
         self.layer_params = layer_params
         self.num_layers = num_layers
+        self.checkpointing = checkpointing
         layer = MapAgentAwareAttentionDecoderLayer(**layer_params)
         self.layers = _get_clones(layer, num_layers)
 
@@ -119,6 +157,18 @@ class OcclusionFormerDecoder(Module):
         self_attn_weights = [None] * len(self.layers)
         cross_attn_weights = [None] * len(self.layers)
         for i, mod in enumerate(self.layers):
+            if self.checkpointing and torch.is_grad_enabled():
+                output = checkpointed(
+                    lambda tgt_, memory_, tgt_map_, mem_map_, mod_=mod: mod_(
+                        tgt=tgt_, memory=memory_,
+                        tgt_tgt_self_other_mask=tgt_tgt_self_other_mask,
+                        tgt_mem_self_other_mask=tgt_mem_self_other_mask,
+                        tgt_map=tgt_map_, mem_map=mem_map_,
+                        tgt_mask=tgt_mask, memory_mask=memory_mask
+                    )[0],
+                    output, memory, map_output, mem_map
+                )
+                continue
             output, map_output, self_attn_weights[i], cross_attn_weights[i] = mod(
                 tgt=output, memory=memory,
                 tgt_tgt_self_other_mask=tgt_tgt_self_other_mask, tgt_mem_self_other_mask=tgt_mem_self_other_mask,
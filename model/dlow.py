@@ -7,6 +7,7 @@ from model.common.mlp import MLP
 from model.common.dist import Normal
 from model import model_lib
 from model.agentformer_loss import compute_occlusion_map_loss
+from utils.torch_ops import quantize_linear_layers
 
 
 def compute_z_kld(data, cfg):
@@ -125,6 +126,10 @@ class DLow(nn.Module):
         for key in ['future_frames', 'motion_dim', 'forecast_dim', 'global_map_resolution']:
             assert key in cfg.yml_dict.keys(), key
             pred_cfg.yml_dict[key] = cfg.__getattribute__(key)
+        for key in ['sample_chunk_size', 'sample_memory_budget']:
+            # chunking of the decoding of the DLow samples by the prediction model
+            if cfg.get(key, None) is not None:
+                pred_cfg.yml_dict[key] = cfg.__getattribute__(key)
 
         pred_model = model_lib.model_dict[pred_cfg.model_id](pred_cfg)
         self.pred_model_dim = pred_cfg.tf_model_dim
@@ -148,6 +153,18 @@ class DLow(nn.Module):
         self.to(device)
         self.pred_model[0].set_device(device)
 
+    def quantize(self):
+        # dynamic int8 quantization of the linear layers of the prediction model and of the Q net (see AgentFormer)
+        self.pred_model[0].quantize()
+        quantize_linear_layers(self)
+
+    def set_precision(self, precision: str):
+        # the transformers and map CNN of the prediction model are run in the given precision, the Q net in float32
+        self.pred_model[0].set_precision(precision)
+
+    def required_inputs(self):
+        return self.pred_model[0].required_inputs()
+
     def set_data(self, data):
         self.pred_model[0].set_data(data)
         self.data = self.pred_model[0].data
@@ -155,7 +172,7 @@ class DLow(nn.Module):
     def main(self, mean=False, need_weights=False):
         pred_model = self.pred_model[0]
         if pred_model.global_map_attention:
-            self.data['global_map_encoding'] = pred_model.global_map_encoder(self.data['input_global_map'])
+            pred_model.encode_map()
 
         pred_model.context_encoder(self.data)
 
@@ -0,0 +1,216 @@
+import torch
+from torch import nn
+from collections import defaultdict
+
+from model.agentformer import AgentFormer, self_other_aware_mask, causal_attention_mask, zeros_mask
+
+from typing import Dict, Tuple
+Tensor = torch.Tensor
+
+
+def decoding_schedule(
+        last_obs_timesteps: Tensor,     # [N]
+        future_frames: int
+) -> Tuple[Tensor, Tensor, Tensor]:     # [P], [P], [P]
+    # The sequence elements decoded by FutureDecoder.decode_traj_ar, in the order in which they are appended to the
+    # decoded sequence: for every element, the index of its agent, its (input) timestep, and the index of the element
+    # whose prediction it takes as input (-1 if it takes the agent's last observed position).
+    last_obs_timesteps = last_obs_timesteps.tolist()
+    t_min = int(min(last_obs_timesteps))
+    agents = [n for n, t in enumerate(last_obs_timesteps) if t == t_min]
+    timesteps = [t_min] * len(agents)
+    sources = [-1] * len(agents)
+    for t in range(t_min, future_frames - 1):
+        newest = [k for k, timestep in enumerate(timesteps) if timestep == t]
+        from_obs = [n for n, last_t in enumerate(last_obs_timesteps) if last_t == t + 1]
+        agents.extend([agents[k] for k in newest] + from_obs)
+        sources.extend(newest + [-1] * len(from_obs))
+        timesteps.extend([t + 1] * (len(newest) + len(from_obs)))
+    return torch.tensor(agents), torch.tensor(timesteps), torch.tensor(sources)
+
+
+class ExportableAgentFormer(nn.Module):
+    """
+    Inference pass of a trained AgentFormer / OcclusionFormer model, with tensor inputs and outputs only, which can
+    be traced with torch.jit.trace (see export_model.py).
+
+    The autoregressive decoding is performed over a fixed schedule of sequence elements (see decoding_schedule),
+    computed beforehand: every decoding pass processes the whole schedule, and the elements whose inputs are not
+    predicted yet cannot influence the others, as the decoder's attention is causal in time. The number of passes is
+    fixed as well (one per possible input timestep), so that the traced graph does not depend on the instance.
+    The latent codes are sampled from the prior with the standard normal noise <eps> provided as input.
+    """
+
+    def __init__(self, model: AgentFormer, past_frames: int):
+        super().__init__()
+        assert model.z_type == 'gaussian', "only gaussian latent codes are supported"
+        assert not model.input_impute_markers, "imputation markers are not supported"
+        assert set(model.context_encoder.input_type).issubset({'position', 'velocity'})
+        assert len(model.future_decoder.input_type) == 0, "decoder input types are not supported"
+        assert not model.global_map_attention or model.map_encoding == 'global', "only global map encodings"
+
+        self.global_map_attention = model.global_map_attention
+        self.future_frames = model.future_decoder.future_frames
+        self.first_timestep = 1 - past_frames
+        self.learn_prior = model.future_decoder.learn_prior
+        self.nz = model.future_decoder.nz
+        self.pred_type = model.future_decoder.pred_type
+        self.sn_out_type = model.future_decoder.sn_out_type
+
+        self.context_encoder = model.context_encoder
+        self.future_decoder = model.future_decoder
+        if self.global_map_attention:
+            self.global_map_encoder = model.global_map_encoder
+
+    @staticmethod
+    def example_inputs(data: Dict, eps: Tensor, future_frames: int) -> Tuple[Tensor, ...]:
+        # the inputs of forward, from the data of an AgentFormer model (see AgentFormer.set_data)
+        agents, timesteps, sources = decoding_schedule(
+            last_obs_timesteps=data['last_obs_timesteps'][0], future_frames=future_frames
+        )
+        device = data['valid_id'].device
+        global_map = data['input_global_map'] if data['input_global_map'] is not None else torch.zeros(0)
+        return (
+            data['obs_position_sequence'], data['obs_velocity_sequence'],
+            data['obs_timestep_sequence'], data['obs_identity_sequence'],
+            data['last_obs_positions'], data['valid_id'], data['scene_orig'], global_map.to(device),
+            agents.to(device), timesteps.to(device), sources.to(device), eps
+        )
+
+    def encode_context(
+            self,
+            obs_position_sequence: Tensor,      # [B, O, 2]
+            obs_velocity_sequence: Tensor,      # [B, O, 2]
+            obs_timestep_sequence: Tensor,      # [B, O]
+            obs_identity_sequence: Tensor,      # [B, O]
+            valid_id: Tensor,                   # [B, N]
+            global_map: Tensor                  # [B, C, H, W]
+    ) -> Dict:
+        data = defaultdict(lambda: None)
+        data['obs_position_sequence'] = obs_position_sequence
+        data['obs_velocity_sequence'] = obs_velocity_sequence
+        data['obs_timestep_sequence'] = obs_timestep_sequence
+        data['obs_identity_sequence'] = obs_identity_sequence
+        data['valid_id'] = valid_id
+        if self.global_map_attention:
+            data['global_map_encoding'] = self.global_map_encoder(global_map)       # [B, model_dim]
+        self.context_encoder(data)
+        return data
+
+    def sample_z(
+            self,
+            data: Dict,
+            eps: Tensor             # [B * K, N, nz]
+    ) -> Tensor:                    # [B * K, N, nz]
+        # same computations as Normal.rsample, for the prior p(z) of FutureDecoder.forward
+        if not self.learn_prior:
+            return eps
+        h = data['agent_context'].repeat(eps.shape[0] // data['agent_context'].shape[0], 1, 1)     # [B * K, N, D]
+        mu, logvar = torch.chunk(self.future_decoder.p_z_net(h), chunks=2, dim=-1)                # [B * K, N, nz]
+        return mu + eps * torch.exp(0.5 * logvar)
+
+    def decode(
+            self,
+            data: Dict,
+            positions: Tensor,          # [B * K, P, 2]
+            z: Tensor,                  # [B * K, P, nz]
+            origins: Tensor,            # [B * K, P, 2]
+            agent_sequence: Tensor,     # [B, P]
+            timesteps: Tensor,          # [P]
+            tgt_self_other_mask: Tensor,    # [B, P, P]
+            mem_self_other_mask: Tensor,    # [B, P, O]
+            sample_num: int
+    ) -> Tensor:                        # [B * K, P, 2]
+        decoder = self.future_decoder
+        tf_in = decoder.input_fc(torch.cat([positions, z], dim=-1))        # [B * K, P, model_dim]
+        tf_in_pos = decoder.pos_encoder(
+            x=tf_in, time_tensor=timesteps.unsqueeze(0).repeat(tf_in.shape[0], 1)
+        )                                                                   # [B * K, P, model_dim]
+        context = data['context_enc'].repeat(sample_num, 1, 1)             # [B * K, O, model_dim]
+        tgt_mask = causal_attention_mask(timestep_sequence=timesteps, batch_size=tf_in.shape[0]).to(tf_in)
+        mem_mask = zeros_mask(
+            tgt_sz=timesteps.shape[0], src_sz=context.shape[1], batch_size=tf_in.shape[0]
+        ).to(tf_in)
+        tf_out, _ = decoder.tf_decoder_call(
+            data=data, tf_in_pos=tf_in_pos, context=context,
+            tgt_tgt_self_other_mask=tgt_self_other_mask, tgt_mem_self_other_mask=mem_self_other_mask,
+            tgt_mask=tgt_mask, mem_mask=mem_mask, agent_sequence=agent_sequence, sample_num=sample_num
+        )
+        seq_out = decoder.out_module(tf_out)                                # [B * K, P, 2]
+        if self.pred_type == 'scene_norm' and self.sn_out_type == 'norm':
+            seq_out = seq_out + origins
+        return seq_out
+
+    def forward(
+            self,
+            obs_position_sequence: Tensor,      # [B, O, 2]
+            obs_velocity_sequence: Tensor,      # [B, O, 2]
+            obs_timestep_sequence: Tensor,      # [B, O]
+            obs_identity_sequence: Tensor,      # [B, O]
+            last_obs_positions: Tensor,         # [B, N, 2]
+            valid_id: Tensor,                   # [B, N]
+            scene_orig: Tensor,                 # [B, 2]
+            global_map: Tensor,                 # [B, C, H, W] (ignored by models without map attention)
+            schedule_agents: Tensor,            # [P]
+            schedule_timesteps: Tensor,         # [P]
+            schedule_sources: Tensor,           # [P]
+            eps: Tensor                         # [B * K, N, nz]
+    ) -> Tensor:                                # [B * K, P, 2]
+        sample_num = eps.shape[0] // valid_id.shape[0]
+        data = self.encode_context(
+            obs_position_sequence=obs_position_sequence, obs_velocity_sequence=obs_velocity_sequence,
+            obs_timestep_sequence=obs_timestep_sequence, obs_identity_sequence=obs_identity_sequence,
+            valid_id=valid_id, global_map=global_map
+        )
+        z = self.sample_z(data=data, eps=eps)[:, schedule_agents]                         # [B * K, P, nz]
+
+        agent_sequence = valid_id[:, schedule_agents]                                       # [B, P]
+        origins = last_obs_positions[:, schedule_agents].repeat(sample_num, 1, 1)          # [B * K, P, 2]
+        tgt_self_other_mask = self_other_aware_mask(
+            q_identities=agent_sequence[0], k_identities=agent_sequence[0]
+        ).unsqueeze(0)                                                                      # [B, P, P]
+        mem_self_other_mask = self_other_aware_mask(
+            q_identities=agent_sequence[0], k_identities=obs_identity_sequence[0]
+        ).unsqueeze(0)                                                                      # [B, P, O]
+        from_pred = (schedule_sources >= 0).view(1, -1, 1)                                 # [1, P, 1]
+        sources = schedule_sources.clamp(min=0)                                             # [P]
+
+        # every element starts from its agent's last observed position, and the elements taking a prediction as
+        # input are updated after the pass in which their source element was the most recent one
+        positions = origins                                                                 # [B * K, P, 2]
+        seq_out = positions
+        for t in range(self.first_timestep, self.future_frames):
+            seq_out = self.decode(
+                data=data, positions=positions, z=z, origins=origins, agent_sequence=agent_sequence,
+                timesteps=schedule_timesteps, tgt_self_other_mask=tgt_self_other_mask,
+                mem_self_other_mask=mem_self_other_mask, sample_num=sample_num
+            )                                                                               # [B * K, P, 2]
+            update = from_pred & (schedule_timesteps == t + 1).view(1, -1, 1)              # [1, P, 1]
+            positions = torch.where(update, seq_out[:, sources], positions)
+
+        return seq_out + scene_orig.repeat(sample_num, 1).unsqueeze(1)                     # [B * K, P, 2]
+
+
+def parity_errors(model: AgentFormer, exported: nn.Module, sample_num: int, seed: int) -> Dict[str, float]:
+    # compares the predictions of the exported module with those of AgentFormer.inference, on the data currently set
+    # in <model> (see AgentFormer.set_data). Both draw the same latent noise, with a single call from the same seed.
+    torch.manual_seed(seed)
+    eps = torch.randn(
+        [sample_num * model.data['valid_id'].shape[0], model.data['agent_num'], model.future_decoder.nz],
+        device=model.device
+    )                                                                                   # [B * K, N, nz]
+    inputs = ExportableAgentFormer.example_inputs(
+        data=model.data, eps=eps, future_frames=model.future_decoder.future_frames
+    )
+    motion = exported(*inputs)                                                          # [B * K, P, 2]
+    schedule_agents, schedule_timesteps = inputs[8], inputs[9]
+
+    torch.manual_seed(seed)
+    model.inference(mode='infer', sample_num=sample_num)
+    return {
+        'max_abs_error': float((motion - model.data['infer_dec_motion']).abs().max()),
+        'same_agents': torch.equal(
+            model.data['valid_id'][:, schedule_agents].repeat(sample_num, 1), model.data['infer_dec_agents']
+        ),
+        'same_timesteps': torch.equal(schedule_timesteps + 1, model.data['infer_dec_timesteps'])
+    }
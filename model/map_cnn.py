@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from utils.torch_ops import checkpointed
 
 from typing import Dict
 
@@ -68,6 +69,7 @@ class GlobalMapCNN(nn.Module):
         self.resolution = cfg.get('map_resolution', 800)            # [px], resolution of the scene maps
         self.map_size = [self.resolution] * 2
         self.output_dim = cfg.get('output_dim', 256)                # dimension of the produced compressed state
+        self.checkpointing = cfg.get('checkpoint_activations', False)   # recompute the layer activations in backward
         self.input_shape = (self.input_channels, *self.map_size)
 
         x_dummy = torch.randn(self.input_shape).unsqueeze(0)        # [B, C, H, W]
@@ -94,6 +96,9 @@ class GlobalMapCNN(nn.Module):
 
     def forward(self, x):
         for layer in self.layers:
+            if self.checkpointing and torch.is_grad_enabled():
+                x = checkpointed(lambda x_, layer_=layer: F.leaky_relu(layer_(x_), 0.2), x)
+                continue
             x = F.leaky_relu(layer(x), 0.2)
         x = torch.flatten(x, start_dim=1)
         x = self.fc(x)
@@ -1,7 +1,11 @@
+import torch
 import torch.nn as nn
-from torchvision import models
+from data.map import warp_affine_patches
 from model.map_cnn import MapCNN, GlobalMapCNN
 
+from typing import Dict, Optional
+Tensor = torch.Tensor
+
 
 class MapEncoder(nn.Module):
     def __init__(self, cfg):
@@ -14,6 +18,7 @@ class MapEncoder(nn.Module):
             self.model = MapCNN(cfg)
             self.out_dim = self.model.out_dim
         elif 'resnet' in model_id:
+            from torchvision import models
             model_dict = {
                 'resnet18': models.resnet18,
                 'resnet34': models.resnet34,
@@ -34,3 +39,72 @@ class MapEncoder(nn.Module):
         x = self.model(x)
         x = self.dropout(x)
         return x
+
+
+class LocalMapEncoder(nn.Module):
+    """
+    Encodes a square map patch centered on every agent (optionally rotated along the agent's heading).
+    The patches of all agents are sampled from the global map in a single batched warp, and encoded by a MapCNN.
+    """
+    # example of a cfg dict to provide to the class
+    # cfg = {
+    #     'use_scene_map': False,
+    #     'map_channels': 3,
+    #     'use_occlusion_map': True,
+    #     'normalize': False,
+    #     'patch_size': [32, 32],       # [px], resolution of the patches
+    #     'patch_side': 8.0,            # side length of the patches, in trajectory coordinates
+    #     'rotate': True,
+    #     'hdim': [16, 16],
+    #     'kernels': [5, 3],
+    #     'strides': [2, 2],
+    #     'out_dim': 256
+    # }
+
+    def __init__(self, cfg: Dict):
+        super().__init__()
+        self.patch_size = cfg.get('patch_size', [32, 32])
+        assert self.patch_size[0] == self.patch_size[1]
+        self.patch_side = cfg.get('patch_side', 8.0)
+        self.rotate = cfg.get('rotate', True)
+        # the patches hold the same channels as the global map (see GlobalMapCNN)
+        input_channels = cfg.get('map_channels', 3) * int(cfg.get('use_scene_map', False)) +\
+            int(cfg.get('use_occlusion_map', False))
+        self.encoder = MapEncoder({**cfg, 'model_id': 'map_cnn', 'map_channels': input_channels})
+        self.out_dim = self.encoder.out_dim
+
+    def patch_to_scene(
+            self,
+            positions: Tensor,                  # [B, N, 2]
+            headings: Optional[Tensor] = None   # [B, N]
+    ) -> Tensor:                                # [B, N, 3, 3]
+        # maps patch pixel coordinates onto scene coordinates, with the patch centered on <positions>
+        # (and its x axis aligned with <headings>)
+        if headings is None or not self.rotate:
+            headings = torch.zeros(positions.shape[:-1], dtype=positions.dtype, device=positions.device)
+        scale = self.patch_side / self.patch_size[0]
+        cos, sin = torch.cos(headings) * scale, torch.sin(headings) * scale     # [B, N]
+        half = self.patch_size[0] / 2
+        transform = torch.zeros([*positions.shape[:-1], 3, 3], dtype=positions.dtype, device=positions.device)
+        transform[..., 0, 0], transform[..., 0, 1] = cos, -sin
+        transform[..., 1, 0], transform[..., 1, 1] = sin, cos
+        transform[..., 0, 2] = positions[..., 0] - half * (cos - sin)
+        transform[..., 1, 2] = positions[..., 1] - half * (sin + cos)
+        transform[..., 2, 2] = 1.
+        return transform
+
+    def forward(
+            self,
+            maps: Tensor,                       # [B, C, H, W]
+            homography: Tensor,                 # [B, 3, 3], scene coordinates --> map pixel coordinates
+            positions: Tensor,                  # [B, N, 2]
+            headings: Optional[Tensor] = None   # [B, N]
+    ) -> Tensor:                                # [B, N, out_dim]
+        B, N = positions.shape[:2]
+        patch_to_image = homography.unsqueeze(1).to(positions) @ self.patch_to_scene(
+            positions=positions, headings=headings
+        )                                                                           # [B, N, 3, 3]
+        patches = warp_affine_patches(
+            images=maps, patch_to_image=patch_to_image, resolution=self.patch_size[0], padding_mode='zeros'
+        )                                                                           # [B, N, C, R, R]
+        return self.encoder(patches.reshape(B * N, *patches.shape[2:])).view(B, N, self.out_dim)
@@ -1,15 +1,27 @@
 from model.agentformer import AgentFormer
 from model.dlow import DLow
-from model.original_agentformer import OrigModelWrapper
-from model.original_dlow import OrigDLowWrapper
+from model.oneshot import OneShotAgentFormer
 from model.untrained_models import Oracle, ConstantVelocityPredictor
 
 
+# the wrappers of the original AgentFormer implementation import the whole OriginalAgentFormer package:
+# they are only imported when one of them gets instantiated
+def orig_agentformer(cfg):
+    from model.original_agentformer import OrigModelWrapper
+    return OrigModelWrapper(cfg)
+
+
+def orig_dlow(cfg):
+    from model.original_dlow import OrigDLowWrapper
+    return OrigDLowWrapper(cfg)
+
+
 model_dict = {
     'agentformer': AgentFormer,
     'dlow': DLow,
-    'orig_agentformer': OrigModelWrapper,
-    'orig_dlow': OrigDLowWrapper,
+    'oneshot': OneShotAgentFormer,
+    'orig_agentformer': orig_agentformer,
+    'orig_dlow': orig_dlow,
     'oracle': Oracle,
     'const_velocity': ConstantVelocityPredictor
 }
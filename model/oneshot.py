@@ -0,0 +1,286 @@
+import torch
+from torch import nn
+
+import model.decoder_out_submodels as decoder_out_submodels
+from model import model_lib
+from model.agentformer import AgentFormer, FutureDecoder, PositionalEncoding, \
+    self_other_aware_mask, non_causal_attention_mask, zeros_mask
+from model.agentformer_loss import index_mapping_gt_seq_pred_seq
+from model.attention_modules import AgentFormerDecoder, OcclusionFormerDecoder
+from model.dlow import recon_loss, diversity_loss, compute_infer_occlusion_map_loss
+from model.export import decoding_schedule
+from utils.config import ModelConfig
+from utils.utils import initialize_weights
+
+from typing import Dict, List
+
+
+def distillation_loss(data: Dict, cfg: Dict):
+    # matches the set of K predictions of the student with the set of K predictions of the teacher, agent by agent:
+    # every teacher prediction is pulled towards the nearest student prediction, and every student prediction towards
+    # the nearest teacher prediction (bidirectional Chamfer distance, the samples of both models being unordered)
+    agent_masks = (
+            data['valid_id'][0].unsqueeze(1) == data['infer_dec_agents'][0].unsqueeze(0)
+    ).to(data['infer_dec_motion'])                                                              # [N, P]
+    diff = data['infer_dec_motion'].unsqueeze(1) - data['teacher_dec_motion'].unsqueeze(0)     # [K, K, P, 2]
+    dist = diff.pow(2).sum(-1) @ agent_masks.T                                                  # [K, K, N]
+    if cfg.get('normalize', True):
+        dist = dist / agent_masks.sum(dim=-1)               # mean over the sequence elements of every agent
+    loss_unweighted = dist.min(dim=0).values.mean() + dist.min(dim=1).values.mean()
+    loss = loss_unweighted * cfg['weight']
+    return loss, loss_unweighted
+
+
+loss_func = {
+    'distill': distillation_loss,
+    'recon': recon_loss,
+    'diverse': diversity_loss,
+    'infer_occl_map': compute_infer_occlusion_map_loss
+}
+
+
+class OneShotDecoder(nn.Module):
+    """
+    Non-autoregressive Future Decoder: the K predictions of every sequence element (agent, timestep) are decoded in
+    a single pass, over the same sequence of elements as FutureDecoder (see decoding_schedule). Every element is
+    embedded from the context of its agent and from a learned embedding of the sample it belongs to.
+    """
+    def __init__(self, ctx):
+        super().__init__()
+        self.forecast_dim = ctx['forecast_dim']
+        self.pred_type = ctx['pred_type']
+        self.sn_out_type = ctx['sn_out_type']
+        self.future_frames = ctx['future_frames']
+        self.sample_k = ctx['sample_k']
+        self.model_dim = ctx['tf_model_dim']
+        self.ff_dim = ctx['tf_ff_dim']
+        self.n_head = ctx['tf_n_head']
+        self.dropout = ctx['tf_dropout']
+        self.bias_self = ctx.get('bias_self', False)
+        self.bias_other = ctx.get('bias_other', False)
+        self.bias_out = ctx.get('bias_out', True)
+        self.n_layer = ctx['future_decoder'].get('n_layer', 2)
+        self.out_mlp_dim = ctx['future_decoder'].get('out_mlp_dim', None)
+        self.global_map_attention = ctx['global_map_attention']
+
+        assert self.pred_type == 'scene_norm' and self.sn_out_type == 'norm', \
+            "the one-shot decoder predicts offsets from the last observed positions"
+
+        # networks
+        self.sample_embedding = nn.Embedding(self.sample_k, self.model_dim)
+        self.input_fc = nn.Linear(2 * self.model_dim, self.model_dim)
+
+        layer_params = {
+            'd_model': self.model_dim,
+            'n_head': self.n_head,
+            'head_dim': ctx['tf_head_dim'],
+            'dim_feedforward': self.ff_dim,
+            'dropout': self.dropout,
+            'bias_self': self.bias_self,
+            'bias_other': self.bias_other,
+            'bias_out': self.bias_out
+        }
+
+        if self.global_map_attention:
+            self.bias_map = ctx.get('bias_map', False)
+            layer_params['bias_map'] = self.bias_map
+
+            self.tf_decoder = OcclusionFormerDecoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
+            self.tf_decoder_call = self.map_agent_decoder_call
+        else:
+            self.tf_decoder = AgentFormerDecoder(
+                layer_params=layer_params, num_layers=self.n_layer, checkpointing=ctx['checkpoint_activations']
+            )
+            self.tf_decoder_call = self.agent_decoder_call
+
+        self.pos_encoder = PositionalEncoding(
+            self.model_dim, dropout=self.dropout,
+            concat=ctx['pos_concat'], t_zero_index=ctx['t_zero_index']
+        )
+
+        out_module_kwargs = {"hidden_dims": self.out_mlp_dim}
+        self.out_module = decoder_out_submodels.point_out_module(
+            model_dim=self.model_dim, forecast_dim=self.forecast_dim, **out_module_kwargs
+        )
+        initialize_weights(self.out_module.modules())
+
+    # same calls of the transformer decoder as those of FutureDecoder
+    agent_decoder_call = FutureDecoder.agent_decoder_call
+    map_agent_decoder_call = FutureDecoder.map_agent_decoder_call
+
+    def forward(self, data: Dict, mode: str = 'infer', need_weights: bool = False) -> None:
+        sample_num = self.sample_k
+        batch_size = data['agent_context'].shape[0]
+        device = data['agent_context'].device
+
+        # the sequence elements, in the order in which FutureDecoder.decode_traj_ar predicts them (the timesteps are
+        # those of its input elements, the predicted timesteps are shifted by one)
+        agents, timesteps, _ = decoding_schedule(
+            last_obs_timesteps=data['last_obs_timesteps'][0], future_frames=self.future_frames
+        )
+        agents, timesteps = agents.to(device), timesteps.to(device)                     # [P], [P]
+        agent_sequence = data['valid_id'][:, agents]                                    # [B, P]
+
+        agent_context = data['agent_context'][:, agents].repeat(sample_num, 1, 1)      # [B * K, P, model_dim]
+        sample_context = self.sample_embedding.weight.repeat_interleave(batch_size, dim=0).unsqueeze(1).expand(
+            -1, agents.shape[0], -1
+        )                                                                               # [B * K, P, model_dim]
+        tf_in = self.input_fc(torch.cat([agent_context, sample_context], dim=-1))      # [B * K, P, model_dim]
+        tf_in_pos = self.pos_encoder(
+            x=tf_in,
+            time_tensor=timesteps.unsqueeze(0).repeat(tf_in.shape[0], 1)               # [B * K, P]
+        )                                                                               # [B * K, P, model_dim]
+
+        tgt_self_other_mask = self_other_aware_mask(
+            q_identities=agent_sequence[0], k_identities=agent_sequence[0]
+        ).unsqueeze(0)      # [B, P, P]
+        mem_self_other_mask = self_other_aware_mask(
+            q_identities=agent_sequence[0], k_identities=data['obs_identity_sequence'][0]
+        ).unsqueeze(0)      # [B, P, O]
+        tgt_mask = non_causal_attention_mask(
+            timestep_sequence=timesteps, batch_size=tf_in.shape[0]
+        ).to(device)        # [B * K, P, P]
+        context = data['context_enc'].repeat(sample_num, 1, 1)                          # [B * K, O, model_dim]
+        mem_mask = zeros_mask(
+            tgt_sz=timesteps.shape[0], src_sz=context.shape[1], batch_size=tf_in.shape[0]
+        ).to(device)        # [B * K, P, O]
+
+        tf_out, attn_weights = self.tf_decoder_call(
+            data=data, tf_in_pos=tf_in_pos, context=context,
+            tgt_tgt_self_other_mask=tgt_self_other_mask, tgt_mem_self_other_mask=mem_self_other_mask,
+            tgt_mask=tgt_mask, mem_mask=mem_mask, agent_sequence=agent_sequence, sample_num=sample_num
+        )
+
+        # offsets from the last observed positions of the agents
+        seq_out = self.out_module(tf_out)                                               # [B * K, P, 2]
+        seq_out = seq_out + data['last_obs_positions'][:, agents].repeat(sample_num, 1, 1)     # [B * K, P, 2]
+        seq_out = seq_out + data['scene_orig'].repeat(sample_num, 1).unsqueeze(1)              # [B * K, P, 2]
+
+        pred_timestep_sequence = timesteps + 1                                  # [P]
+        data[f'{mode}_dec_motion'] = seq_out                                    # [B * K, P, 2]
+        data[f'{mode}_dec_agents'] = agent_sequence.repeat(sample_num, 1)      # [B * K, P]
+        data[f'{mode}_dec_past_mask'] = (pred_timestep_sequence <= 0)          # [P]
+        data[f'{mode}_dec_timesteps'] = pred_timestep_sequence                  # [P]
+        if need_weights:
+            data['attn_weights'] = attn_weights
+
+
+class OneShotAgentFormer(AgentFormer):
+    """
+    AgentFormer / OcclusionFormer with a non-autoregressive decoder (see OneShotDecoder), producing a fixed number
+    (sample_k) of predictions per agent. It is meant to be distilled from a trained (teacher) model: the teacher
+    (<teacher_cfg>, <teacher_checkpoint_name>) predicts the targets of the 'distill' loss during the training and
+    validation passes. It is only loaded by load_teacher (called by train.py), so that inference passes neither
+    build nor require it.
+    """
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.sample_k = cfg.sample_k
+        assert set(self.loss_names).issubset(loss_func.keys()), f"available losses: {list(loss_func.keys())}"
+
+        self.cfg = cfg
+
+        # the teacher is kept out of the submodules (and of the state dict) of the model
+        self.teacher = []
+
+    def build_future_modules(self, cfg, ctx: Dict) -> None:
+        ctx['sample_k'] = cfg.sample_k
+        self.future_decoder = OneShotDecoder(ctx)
+
+    def load_teacher(self) -> None:
+        # loads the teacher predicting the targets of the 'distill' loss (only needed for training)
+        if len(self.teacher) != 0 or 'distill' not in self.loss_names:
+            return
+        cfg = self.cfg
+        assert cfg.get('teacher_cfg', None) is not None, "the 'distill' loss requires a teacher model (teacher_cfg)"
+        teacher_cfg = ModelConfig(cfg_id=cfg.teacher_cfg, tmp=False, create_dirs=False)
+        for key in ['future_frames', 'motion_dim', 'forecast_dim', 'global_map_resolution']:
+            assert key in cfg.yml_dict.keys(), key
+            teacher_cfg.yml_dict[key] = cfg.__getattribute__(key)
+        teacher = model_lib.model_dict[teacher_cfg.model_id](teacher_cfg)
+
+        checkpoint_name = cfg.get('teacher_checkpoint_name', 'best_val')
+        if checkpoint_name == 'best_val':
+            checkpoint_name = teacher_cfg.get_best_val_checkpoint_name()
+        cp_path = teacher_cfg.model_path % checkpoint_name
+        print('loading teacher model from checkpoint: %s' % cp_path)
+        model_cp = torch.load(cp_path, map_location='cpu')
+        teacher.load_state_dict(model_cp['model_dict'])
+        teacher.set_device(self.device)
+        teacher.eval()
+        self.teacher.append(teacher)
+
+    def set_device(self, device):
+        super().set_device(device)
+        for teacher in self.teacher:
+            teacher.set_device(device)
+
+    @staticmethod
+    def output_keys() -> List[str]:
+        return AgentFormer.output_keys() + ['teacher_dec_motion']
+
+    def required_inputs(self) -> List[str]:
+        inputs = super().required_inputs()
+        for teacher in self.teacher:
+            inputs.extend([key for key in teacher.required_inputs() if key not in inputs])
+        return inputs
+
+    def set_data(self, data: Dict) -> None:
+        super().set_data(data)
+        for teacher in self.teacher:
+            teacher.set_data(data)
+
+    def teacher_predictions(self) -> None:
+        # the K predictions of the teacher, in the order of the sequence elements of the student
+        assert len(self.teacher) != 0, "the 'distill' loss requires the teacher model (see load_teacher)"
+        with torch.no_grad():
+            teacher_motion, teacher_data = self.teacher[0].inference(mode='infer', sample_num=self.sample_k)
+        assert teacher_motion.shape[0] == self.data['infer_dec_motion'].shape[0], \
+            "the teacher and the student must predict the same number of samples"
+        idx_map = index_mapping_gt_seq_pred_seq(
+            ag_gt=teacher_data['infer_dec_agents'][0],
+            tsteps_gt=teacher_data['infer_dec_timesteps'],
+            ag_pred=self.data['infer_dec_agents'][0],
+            tsteps_pred=self.data['infer_dec_timesteps']
+        )
+        self.data['teacher_dec_motion'] = teacher_motion[:, idx_map].detach()     # [B * K, P, 2]
+
+    def decode(self, need_weights: bool = False) -> None:
+        if self.global_map_attention and self.data['input_global_map'] is not None:
+            self.encode_map()
+        if self.data['context_enc'] is None:
+            with self.memory_phase('context_encoding'):
+                self.context_encoder(self.data)
+        with self.memory_phase('infer_decoding'):
+            self.future_decoder(self.data, mode='infer', need_weights=need_weights)
+
+    def forward(self):
+        self.decode()
+        if 'distill' in self.loss_names:
+            self.teacher_predictions()
+
+        self.release_intermediates()
+        return self.data
+
+    def inference(self, mode='infer', sample_num=20, need_weights=False):
+        assert mode == 'infer', "one-shot models only perform inference passes"
+        assert sample_num == self.sample_k, f"one-shot models predict exactly {self.sample_k} samples"
+        self.decode(need_weights=need_weights)
+        self.release_intermediates()
+        return self.data['infer_dec_motion'], self.data         # [B * sample_num, P, 2], Dict
+
+    def compute_loss(self):
+        total_loss = 0
+        loss_dict = {}
+        loss_unweighted_dict = {}
+
+        for loss_name in self.loss_names:
+            loss, loss_unweighted = loss_func[loss_name](self.data, self.loss_cfg[loss_name])
+            total_loss += loss
+            loss_dict[loss_name] = loss.item()
+            loss_unweighted_dict[loss_name] = loss_unweighted.item()
+
+        return total_loss, loss_dict, loss_unweighted_dict
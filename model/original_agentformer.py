@@ -13,6 +13,7 @@ from torch import nn
 from collections import defaultdict
 
 from OriginalAgentFormer.model.agentformer import AgentFormer
+from utils.torch_ops import hand_over
 
 
 class OrigModelWrapper(nn.Module):
@@ -36,6 +37,13 @@ class OrigModelWrapper(nn.Module):
         self.orig_model.set_device(device)
         self.device = self.orig_model.device
 
+    def required_inputs(self):
+        # the dataset fields read by set_data
+        return [
+            'identities', 'trajectories', 'last_obs_positions', 'last_obs_timesteps',
+            'pred_position_sequence', 'pred_velocity_sequence', 'pred_timestep_sequence', 'pred_identity_sequence'
+        ]
+
     def set_data(self, data):
 
         trajs = data['trajectories'].squeeze(0)     # [N, T_total, 2]
@@ -54,15 +62,15 @@ class OrigModelWrapper(nn.Module):
 
         self.data = self.orig_model.data
 
-        self.data['valid_id'] = data['identities'].detach().clone().to(self.device)     # [B, N]
+        self.data['valid_id'] = hand_over(data['identities'], self.device)     # [B, N]
 
-        self.data['last_obs_positions'] = data['last_obs_positions'].detach().clone().to(self.device)   # [B, N, 2]
-        self.data['last_obs_timesteps'] = data['last_obs_timesteps'].detach().clone().to(self.device)   # [B, N]
+        self.data['last_obs_positions'] = hand_over(data['last_obs_positions'], self.device)   # [B, N, 2]
+        self.data['last_obs_timesteps'] = hand_over(data['last_obs_timesteps'], self.device)   # [B, N]
 
-        self.data['pred_position_sequence'] = data['pred_position_sequence'].detach().clone().to(self.device)   # [B, P, 2]
-        self.data['pred_velocity_sequence'] = data['pred_velocity_sequence'].detach().clone().to(self.device)   # [B, P, 2]
-        self.data['pred_timestep_sequence'] = data['pred_timestep_sequence'].detach().clone().to(self.device)   # [B, P]
-        self.data['pred_identity_sequence'] = data['pred_identity_sequence'].detach().clone().to(self.device)   # [B, P]
+        self.data['pred_position_sequence'] = hand_over(data['pred_position_sequence'], self.device)   # [B, P, 2]
+        self.data['pred_velocity_sequence'] = hand_over(data['pred_velocity_sequence'], self.device)   # [B, P, 2]
+        self.data['pred_timestep_sequence'] = hand_over(data['pred_timestep_sequence'], self.device)   # [B, P]
+        self.data['pred_identity_sequence'] = hand_over(data['pred_identity_sequence'], self.device)   # [B, P]
 
     def step_annealer(self):
         self.orig_model.step_annealer()
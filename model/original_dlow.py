@@ -64,6 +64,9 @@ class OrigDLowWrapper(nn.Module):
         self.to(device)
         self.pred_model[0].set_device(device)
 
+    def required_inputs(self):
+        return self.pred_model[0].required_inputs()
+
     def set_data(self, data):
         self.pred_model[0].set_data(data)
         self.data = self.pred_model[0].data
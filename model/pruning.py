@@ -0,0 +1,131 @@
+import torch
+from torch import nn
+
+from model.attention_mechanisms import SelfOtherAwareAttention, MapAgentAwareAttention
+from model.attention_layers import BaseAttentionEncoderLayer, BaseAttentionDecoderLayer
+
+from typing import Dict, List
+Tensor = torch.Tensor
+
+
+# projections of the attention mechanisms whose output features are split across heads, and output projections whose
+# input features are split across heads (see SelfOtherAwareAttention)
+QK_PROJECTIONS = ['w_q_self', 'w_q_other', 'w_k_self', 'w_k_other', 'w_q_traj_map', 'w_k_map_agents']
+V_PROJECTIONS = ['w_v', 'w_v_map']
+OUT_PROJECTIONS = ['fc', 'fc_map']
+
+
+def attention_mechanisms(model: nn.Module) -> Dict[str, SelfOtherAwareAttention]:
+    return {name: module for name, module in model.named_modules() if isinstance(module, SelfOtherAwareAttention)}
+
+
+def feedforward_layers(model: nn.Module) -> Dict[str, nn.Module]:
+    return {
+        name: module for name, module in model.named_modules()
+        if isinstance(module, (BaseAttentionEncoderLayer, BaseAttentionDecoderLayer))
+    }
+
+
+def projections(attention: SelfOtherAwareAttention, names: List[str]) -> Dict[str, nn.Linear]:
+    return {name: getattr(attention, name) for name in names if hasattr(attention, name)}
+
+
+def row_contributions(linear: nn.Linear, n_groups: int) -> Tensor:      # [n_groups]
+    # first order (Taylor) estimate of the change of the loss if groups of output features of <linear> were removed
+    if linear.weight.grad is None:
+        return torch.zeros(n_groups, device=linear.weight.device)
+    contribution = (linear.weight * linear.weight.grad).sum(dim=1)     # [out]
+    if linear.bias is not None:
+        contribution = contribution + linear.bias * linear.bias.grad
+    return contribution.view(n_groups, -1).sum(dim=-1)
+
+
+def column_contributions(linear: nn.Linear, n_groups: int) -> Tensor:   # [n_groups]
+    # same as row_contributions, for groups of input features of <linear>
+    if linear.weight.grad is None:
+        return torch.zeros(n_groups, device=linear.weight.device)
+    return (linear.weight * linear.weight.grad).sum(dim=0).view(n_groups, -1).sum(dim=-1)
+
+
+class ImportanceScores:
+    """
+    Importance scores of the attention heads and feedforward channels of the transformer layers of a model, accumulated
+    over calibration batches (see prune_model.py). After every backward pass, the score of a head (resp. channel) is
+    increased by the absolute value of the first order estimate of the change of the loss if it were removed, i.e.,
+    |sum(w * dL/dw)| over every parameter of the head (resp. channel) [Molchanov et al., 2019].
+    """
+
+    def __init__(self, model: nn.Module):
+        self.attentions = attention_mechanisms(model)
+        self.layers = feedforward_layers(model)
+        self.head_scores = {name: torch.zeros(attn.num_heads) for name, attn in self.attentions.items()}
+        self.channel_scores = {name: torch.zeros(layer.linear1.out_features) for name, layer in self.layers.items()}
+        self.n_batches = 0
+
+    def accumulate(self) -> None:
+        with torch.no_grad():
+            for name, attn in self.attentions.items():
+                n_heads = attn.num_heads
+                contribution = sum(
+                    [row_contributions(linear, n_heads)
+                     for linear in projections(attn, QK_PROJECTIONS + V_PROJECTIONS).values()] +
+                    [column_contributions(linear, n_heads) for linear in projections(attn, OUT_PROJECTIONS).values()]
+                )                                                               # [H]
+                self.head_scores[name] += contribution.abs().cpu()
+            for name, layer in self.layers.items():
+                n_channels = layer.linear1.out_features
+                contribution = row_contributions(layer.linear1, n_channels) + \
+                    column_contributions(layer.linear2, n_channels)            # [F]
+                self.channel_scores[name] += contribution.abs().cpu()
+        self.n_batches += 1
+
+    def kept_heads(self, n_heads: int) -> Dict[str, Tensor]:
+        # the indices of the <n_heads> highest scoring heads of every attention mechanism
+        return {name: highest_scores(scores, k=n_heads) for name, scores in self.head_scores.items()}
+
+    def kept_channels(self, ff_dim: int) -> Dict[str, Tensor]:
+        # the indices of the <ff_dim> highest scoring feedforward channels of every layer
+        return {name: highest_scores(scores, k=ff_dim) for name, scores in self.channel_scores.items()}
+
+
+def highest_scores(scores: Tensor, k: int) -> Tensor:      # [k]
+    # the indices of the k highest scores, in their original order
+    return torch.sort(torch.topk(scores, k=k).indices).values
+
+
+def head_feature_indices(heads: Tensor, head_dim: int) -> Tensor:      # [h * head_dim]
+    return (heads.unsqueeze(1) * head_dim + torch.arange(head_dim).unsqueeze(0)).view(-1)
+
+
+def pruned_state_dict(
+        model: nn.Module, kept_heads: Dict[str, Tensor], kept_channels: Dict[str, Tensor]
+) -> Dict[str, Tensor]:
+    # the state dict of <model>, with the parameters of the removed heads and feedforward channels sliced away. It can
+    # be loaded into the same model, built with tf_n_head, tf_ff_dim and tf_head_dim set to the kept dimensions
+    state_dict = {key: value.detach().cpu().clone() for key, value in model.state_dict().items()}
+
+    def slice_rows(prefix: str, indices: Tensor) -> None:
+        for key in [f'{prefix}.weight', f'{prefix}.bias']:
+            if key in state_dict:
+                state_dict[key] = state_dict[key][indices]
+
+    def slice_columns(prefix: str, indices: Tensor) -> None:
+        state_dict[f'{prefix}.weight'] = state_dict[f'{prefix}.weight'][:, indices]
+
+    for name, attn in attention_mechanisms(model).items():
+        if isinstance(attn, MapAgentAwareAttention):
+            assert attn.qk_map_head_dim == attn.qk_head_dim
+        qk_features = head_feature_indices(kept_heads[name], attn.qk_head_dim)
+        v_features = head_feature_indices(kept_heads[name], attn.v_head_dim)
+        for projection in projections(attn, QK_PROJECTIONS):
+            slice_rows(f'{name}.{projection}', qk_features)
+        for projection in projections(attn, V_PROJECTIONS):
+            slice_rows(f'{name}.{projection}', v_features)
+        for projection in projections(attn, OUT_PROJECTIONS):
+            slice_columns(f'{name}.{projection}', v_features)
+
+    for name, layer in feedforward_layers(model).items():
+        slice_rows(f'{name}.linear1', kept_channels[name])
+        slice_columns(f'{name}.linear2', kept_channels[name])
+
+    return state_dict
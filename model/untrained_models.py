@@ -2,7 +2,9 @@ import torch
 from torch import nn
 from collections import defaultdict
 
-from typing import Dict
+from utils.torch_ops import hand_over
+
+from typing import Dict, List
 
 
 class BasePredictorClass(nn.Module):
@@ -16,28 +18,39 @@ class BasePredictorClass(nn.Module):
         self.device = device
         self.to(device)
 
+    def required_inputs(self) -> List[str]:
+        # the dataset fields read by set_data
+        return [
+            'identities', 'timesteps', 'scene_orig',
+            'obs_position_sequence', 'obs_velocity_sequence', 'obs_timestep_sequence', 'obs_identity_sequence',
+            'last_obs_positions', 'last_obs_timesteps',
+            'pred_position_sequence', 'pred_velocity_sequence', 'pred_timestep_sequence', 'pred_identity_sequence'
+        ]
+
     def set_data(self, data: Dict):
         # NOTE: in our case, batch size B is always 1
         self.data = defaultdict(lambda: None)
 
-        self.data['valid_id'] = data['identities'].detach().clone().to(self.device)     # [B, N]
+        self.data['valid_id'] = hand_over(data['identities'], self.device)     # [B, N]
         self.data['T_total'] = data['timesteps'].shape[-1]
         self.data['agent_num'] = self.data['valid_id'].shape[-1]
-        self.data['timesteps'] = data['timesteps'].detach().clone().to(self.device)     # [B, T]
-        self.data['scene_orig'] = data['scene_orig'].detach().clone().to(self.device)   # [B, 2]
-
-        self.data['obs_position_sequence'] = data['obs_position_sequence'].detach().clone().to(self.device)     # [B, O, 2]
-        self.data['obs_velocity_sequence'] = data['obs_velocity_sequence'].detach().clone().to(self.device)     # [B, O, 2]
-        self.data['obs_timestep_sequence'] = data['obs_timestep_sequence'].detach().clone().to(self.device)     # [B, O]
-        self.data['obs_identity_sequence'] = data['obs_identity_sequence'].detach().clone().to(self.device)     # [B, O]
-        self.data['last_obs_positions'] = data['last_obs_positions'].detach().clone().to(self.device)               # [B, N, 2]
-        self.data['last_obs_timesteps'] = data['last_obs_timesteps'].detach().clone().to(self.device)               # [B, N]
-        self.data['agent_mask'] = torch.zeros([1, self.data['agent_num'], self.data['agent_num']]).to(self.device)  # [B, N, N]
-
-        self.data['pred_position_sequence'] = data['pred_position_sequence'].detach().clone().to(self.device)       # [B, P, 2]
-        self.data['pred_velocity_sequence'] = data['pred_velocity_sequence'].detach().clone().to(self.device)       # [B, P, 2]
-        self.data['pred_timestep_sequence'] = data['pred_timestep_sequence'].detach().clone().to(self.device)       # [B, P]
-        self.data['pred_identity_sequence'] = data['pred_identity_sequence'].detach().clone().to(self.device)       # [B, P]
+        self.data['timesteps'] = hand_over(data['timesteps'], self.device)     # [B, T]
+        self.data['scene_orig'] = hand_over(data['scene_orig'], self.device)   # [B, 2]
+
+        self.data['obs_position_sequence'] = hand_over(data['obs_position_sequence'], self.device)     # [B, O, 2]
+        self.data['obs_velocity_sequence'] = hand_over(data['obs_velocity_sequence'], self.device)     # [B, O, 2]
+        self.data['obs_timestep_sequence'] = hand_over(data['obs_timestep_sequence'], self.device)     # [B, O]
+        self.data['obs_identity_sequence'] = hand_over(data['obs_identity_sequence'], self.device)     # [B, O]
+        self.data['last_obs_positions'] = hand_over(data['last_obs_positions'], self.device)           # [B, N, 2]
+        self.data['last_obs_timesteps'] = hand_over(data['last_obs_timesteps'], self.device)           # [B, N]
+        self.data['agent_mask'] = torch.zeros(
+            [1, self.data['agent_num'], self.data['agent_num']], device=self.device
+        )  # [B, N, N]
+
+        self.data['pred_position_sequence'] = hand_over(data['pred_position_sequence'], self.device)   # [B, P, 2]
+        self.data['pred_velocity_sequence'] = hand_over(data['pred_velocity_sequence'], self.device)   # [B, P, 2]
+        self.data['pred_timestep_sequence'] = hand_over(data['pred_timestep_sequence'], self.device)   # [B, P]
+        self.data['pred_identity_sequence'] = hand_over(data['pred_identity_sequence'], self.device)   # [B, P]
 
     def inference(self, mode='infer', *args, **kwargs):
         raise NotImplementedError
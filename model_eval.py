@@ -8,7 +8,7 @@ import torch
 from torch.utils.data import DataLoader
 
 from utils.config import Config, ModelConfig, REPO_ROOT
-from utils.utils import prepare_seed, print_log, get_cuda_device
+from utils.utils import prepare_seed, print_log, get_cuda_device, results_name
 from utils.performance_metrics import \
     compute_samples_ADE,\
     compute_samples_FDE,\
@@ -21,6 +21,13 @@ from model.agentformer_loss import index_mapping_gt_seq_pred_seq
 from model.model_lib import model_dict
 
 
+# dataset fields used for evaluation (alongside the saved model predictions)
+EVALUATION_INPUTS = [
+    'trajectories', 'observation_mask', 'true_trajectories', 'true_observation_mask',
+    'dist_transformed_occlusion_map'
+]
+
+
 def main(args: argparse.Namespace):
     if args.legacy:
         assert args.dataset_class == 'hdf5', "Legacy mode is only available with presaved HDF5 datasets" \
@@ -40,12 +47,15 @@ def main(args: argparse.Namespace):
     dataset_class = dataset_dict[args.dataset_class]
     dataset_cfg = Config(cfg_id=args.dataset_cfg)
     dataset_cfg.__setattr__('with_rgb_map', False)
+    if args.custom_dataset_size is not None:
+        dataset_cfg.__setattr__('custom_dataset_size', args.custom_dataset_size)
     dataset_kwargs = dict(parser=dataset_cfg, split=args.data_split)
     if args.legacy:
         dataset_kwargs.update(legacy_mode=True)
     assert dataset_cfg.dataset == 'sdd'
     if dataset_cfg.dataset == 'sdd':
         sdd_test_set = dataset_class(**dataset_kwargs)
+        sdd_test_set.set_required_fields(EVALUATION_INPUTS)
         test_loader = DataLoader(dataset=sdd_test_set, shuffle=False, num_workers=0)
 
     # model
@@ -70,7 +80,10 @@ def main(args: argparse.Namespace):
         model.load_state_dict(model_cp['model_dict'])
 
     # loading model predictions
-    saved_preds_dir = os.path.join(cfg.result_dir, sdd_test_set.dataset_name, checkpoint_name, args.data_split)
+    saved_preds_dir = os.path.join(
+        cfg.result_dir, sdd_test_set.dataset_name,
+        results_name(checkpoint_name, quantize=args.quantize, precision=args.precision), args.data_split
+    )
     assert os.path.exists(saved_preds_dir)
     log_str = f'loading predictions from the following directory:\n{saved_preds_dir}\n\n'
     print_log(log_str, log=log)
@@ -375,6 +388,12 @@ if __name__ == '__main__':
     parser.add_argument('--gpu', type=int, default=None)
     parser.add_argument('--dataset_class', type=str, default='hdf5', help="\'torch\' | \'hdf5\'")
     parser.add_argument('--legacy', action='store_true', default=False)
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help="evaluate the predictions saved by save_predictions.py --quantize.")
+    parser.add_argument('--precision', type=str, default='fp32',
+                        help="evaluate the predictions saved by save_predictions.py --precision <precision>.")
+    parser.add_argument('--custom_dataset_size', type=int, default=None,
+                        help="evaluate the predictions over the same subset as save_predictions.py.")
     args = parser.parse_args()
 
     main(args=args)
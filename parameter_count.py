@@ -7,6 +7,19 @@ from utils.config import ModelConfig
 from utils.utils import prepare_seed, get_cuda_device
 
 
+def parameter_counts(model: torch.nn.Module) -> pd.DataFrame:
+    # the number of trainable weights of every parameter of the model
+    param_df = pd.DataFrame(columns=['module', 'params'])
+
+    for i, (name, param) in enumerate(model.named_parameters()):
+        if not param.requires_grad:
+            continue
+
+        param_count = param.numel()
+        param_df.loc[i] = {'module': name, 'params': param_count}
+    return param_df
+
+
 def main(args: argparse.Namespace):
     cfg = ModelConfig(cfg_id=args.cfg, tmp=False, create_dirs=False)
     prepare_seed(cfg.seed)
@@ -31,14 +44,7 @@ def main(args: argparse.Namespace):
         model.load_state_dict(model_cp['model_dict'])
 
     # providing a summary of model parameters
-    param_df = pd.DataFrame(columns=['module', 'params'])
-
-    for i, (name, param) in enumerate(model.named_parameters()):
-        if not param.requires_grad:
-            continue
-
-        param_count = param.numel()
-        param_df.loc[i] = {'module': name, 'params': param_count}
+    param_df = parameter_counts(model)
 
     with pd.option_context(
             'display.max_rows', None,
@@ -0,0 +1,67 @@
+import argparse
+import os.path
+import pandas as pd
+
+from utils.performance_analysis import \
+    SCORES_CSV_FILENAME, \
+    MIN_SCORES, \
+    get_df_from_csv, \
+    get_experiment_dict
+
+
+pd.set_option('display.max_columns', 500)
+pd.set_option('display.width', 200)
+pd.set_option('display.max_colwidth', 75)
+
+OCCLUSION_MAP_SCORES = ['OAO', 'OAC']
+
+
+def main(args: argparse.Namespace):
+    # compares the accuracy of inference variants of a model (e.g., quantized, bf16) with a reference
+    # (e.g., the float model), from the 'prediction_scores.csv' files produced by model_eval.py
+    reference, variants = args.reference, args.variants
+    for file in [reference, *variants]:
+        assert file.endswith(SCORES_CSV_FILENAME), f"Error, incorrect file:\n{file}"
+        assert os.path.exists(file), f"Error, file does not exist:\n{file}"
+
+    metric_names = MIN_SCORES + OCCLUSION_MAP_SCORES
+    perf_df = pd.DataFrame(columns=['model_name', 'dataset_used', 'n_measurements'] + metric_names)
+    for file in [reference, *variants]:
+        scores_df = get_df_from_csv(file_path=file)
+        exp_dict = get_experiment_dict(file_path=file)
+        scores_dict = {name: scores_df[name].mean() if name in scores_df.columns else pd.NA for name in metric_names}
+        scores_dict.update(
+            model_name=exp_dict['model_name'], dataset_used=exp_dict['dataset_used'], n_measurements=len(scores_df)
+        )
+        perf_df.loc[len(perf_df)] = scores_dict
+    print("Performance of the inference variants (mean):")
+    print(perf_df)
+
+    scores = perf_df[metric_names].astype(float)
+    diff_df = scores.iloc[1:] - scores.iloc[0]
+    diff_df.insert(0, 'model_name', perf_df['model_name'].iloc[1:])
+    print(f"\nDifference with the reference ({perf_df['model_name'].iloc[0]}):")
+    print(diff_df)
+
+    if args.save_file:
+        assert os.path.exists(os.path.dirname(args.save_file))
+        assert not os.path.isfile(args.save_file)
+
+        print(f"saving dataframe to:\n{args.save_file}\n")
+        pd.concat([perf_df, diff_df.add_prefix('delta_')], axis=1).to_csv(args.save_file)
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reference', type=os.path.abspath, required=True,
+                        help="path to the 'prediction_scores.csv' file of the reference model.")
+    parser.add_argument('--variants', nargs='+', type=os.path.abspath, required=True,
+                        help="paths to the 'prediction_scores.csv' files of the inference variants of the model, "
+                             "on the same dataset split (e.g., .../<checkpoint_name>_int8/<split>/).")
+    parser.add_argument('--save_file', type=os.path.abspath, default=None,
+                        help="path of a \'.csv\' file to save the comparison table.")
+    args = parser.parse_args()
+
+    main(args=args)
+    print("Goodbye!")
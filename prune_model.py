@@ -0,0 +1,195 @@
+import os
+import argparse
+import json
+import time
+import yaml
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from data.sdd_dataloader import dataset_dict
+from model.agentformer_loss import index_mapping_gt_seq_pred_seq
+from model.model_lib import model_dict
+from model.pruning import ImportanceScores, pruned_state_dict
+from parameter_count import parameter_counts
+from utils.config import Config, ModelConfig, search_for_config_yaml_file
+from utils.performance_metrics import compute_samples_ADE, compute_samples_FDE
+from utils.utils import prepare_seed, print_log, get_cuda_device
+
+from typing import Dict
+
+
+def build_model(cfg: ModelConfig, dataset_cfg: Config, state_dict: Dict, device: torch.device) -> torch.nn.Module:
+    for key in ['past_frames', 'future_frames', 'motion_dim', 'forecast_dim', 'traj_scale', 'global_map_resolution']:
+        assert key in dataset_cfg.yml_dict.keys()
+        cfg.yml_dict[key] = dataset_cfg.__getattribute__(key)
+    model = model_dict['agentformer'](cfg)
+    model.load_state_dict(state_dict)
+    model.set_device(device)
+    model.eval()
+    return model
+
+
+def calibrate(model: torch.nn.Module, loader: DataLoader, n_instances: int) -> ImportanceScores:
+    # accumulates the importance scores of the heads / channels of the model over the training losses of the first
+    # <n_instances> instances of the loader (without dropout)
+    scores = ImportanceScores(model)
+    for i, data in enumerate(pbar := tqdm(loader, total=n_instances)):
+        if i >= n_instances:
+            break
+        pbar.set_description(f"Calibration: {data['instance_name'][0]}")
+        model.set_data(data)
+        model.zero_grad(set_to_none=True)
+        model()
+        total_loss, _, _ = model.compute_loss()
+        total_loss.backward()
+        scores.accumulate()
+    model.zero_grad(set_to_none=True)
+    return scores
+
+
+def evaluate(model: torch.nn.Module, loader: DataLoader, sample_num: int, n_instances: int, seed: int) -> Dict:
+    # mean minADE / minFDE [m] of the agents of the first <n_instances> instances of the loader, and mean latency [ms]
+    # of the inference passes (see model_eval.py for the complete evaluation)
+    prepare_seed(seed)
+    min_ades, min_fdes, latencies = [], [], []
+    with torch.no_grad():
+        for i, data in enumerate(pbar := tqdm(loader, total=n_instances)):
+            if i >= n_instances:
+                break
+            pbar.set_description(f"Evaluation: {data['instance_name'][0]}")
+            model.set_data(data)
+            start = time.perf_counter()
+            model.inference(mode='infer', sample_num=sample_num)
+            if torch.device(model.device).type == 'cuda':
+                torch.cuda.synchronize(model.device)
+            latencies.append(time.perf_counter() - start)
+
+            pred_agents = model.data['infer_dec_agents'][0]                         # [P]
+            pred_timesteps = model.data['infer_dec_timesteps']                      # [P]
+            idx_map = index_mapping_gt_seq_pred_seq(
+                ag_gt=model.data['pred_identity_sequence'][0], tsteps_gt=model.data['pred_timestep_sequence'][0],
+                ag_pred=pred_agents, tsteps_pred=pred_timesteps
+            )
+            gt_positions = model.data['pred_position_sequence'][0, idx_map]        # [P, 2]
+            identity_mask = torch.logical_and(
+                model.data['valid_id'][0].unsqueeze(1) == pred_agents.unsqueeze(0), (pred_timesteps > 0).unsqueeze(0)
+            )                                                                       # [N, P]
+            scores_kwargs = dict(
+                pred_positions=model.data['infer_dec_motion'], gt_positions=gt_positions, identity_mask=identity_mask
+            )
+            min_ades.append(compute_samples_ADE(**scores_kwargs).min(dim=-1).values)     # [N]
+            min_fdes.append(compute_samples_FDE(**scores_kwargs).min(dim=-1).values)     # [N]
+    return {
+        'params': int(parameter_counts(model)['params'].sum()),
+        'min_ADE': float(torch.cat(min_ades).mean()),
+        'min_FDE': float(torch.cat(min_fdes).mean()),
+        'latency_ms': float(torch.tensor(latencies).mean()) * 1e3
+    }
+
+
+def main(args: argparse.Namespace):
+    cfg = ModelConfig(cfg_id=args.cfg, tmp=False, create_dirs=False)
+    prepare_seed(cfg.seed)
+    torch.set_default_dtype(torch.float32)
+    assert cfg.get('model_id', 'agentformer') == 'agentformer', "only AgentFormer models can be pruned"
+
+    n_head, ff_dim = int(cfg.tf_n_head), int(cfg.tf_ff_dim)
+    head_dim = cfg.get('tf_head_dim', None) or cfg.tf_model_dim // n_head
+    assert 0 < args.n_head <= n_head and 0 < args.ff_dim <= ff_dim
+
+    # device
+    device = get_cuda_device(device_index=args.gpu)
+
+    # log
+    log = open(os.path.join(cfg.log_dir, 'log_pruning.txt'), 'w')
+
+    # dataloaders
+    dataset_cfg = Config(cfg_id=args.dataset_cfg or cfg.dataset_cfg)
+    dataset_cfg.__setattr__('with_rgb_map', False)
+    assert dataset_cfg.dataset == 'sdd'
+    calibration_set = dataset_dict[args.dataset_class](parser=dataset_cfg, split=args.calibration_split)
+    evaluation_set = dataset_dict[args.dataset_class](parser=dataset_cfg, split=args.eval_split)
+    calibration_loader = DataLoader(dataset=calibration_set, shuffle=False, num_workers=0)
+    evaluation_loader = DataLoader(dataset=evaluation_set, shuffle=False, num_workers=0)
+
+    # model
+    if args.checkpoint_name == 'best_val':
+        args.checkpoint_name = cfg.get_best_val_checkpoint_name()
+        print(f"Best validation checkpoint name is: {args.checkpoint_name}")
+    cp_path = cfg.model_path % args.checkpoint_name
+    print_log(f'loading model from checkpoint: {cp_path}', log, display=True)
+    model_cp = torch.load(cp_path, map_location='cpu')
+    model = build_model(cfg=cfg, dataset_cfg=dataset_cfg, state_dict=model_cp['model_dict'], device=device)
+    calibration_set.set_required_fields(model.required_inputs())
+    evaluation_set.set_required_fields(model.required_inputs())
+
+    n_eval = min(args.n_eval, len(evaluation_set))
+    before = evaluate(model, evaluation_loader, sample_num=cfg.sample_k, n_instances=n_eval, seed=cfg.seed)
+
+    # scoring the heads and feedforward channels, and removing the lowest scoring ones
+    scores = calibrate(model, calibration_loader, n_instances=min(args.n_calibration, len(calibration_set)))
+    state_dict = pruned_state_dict(
+        model, kept_heads=scores.kept_heads(args.n_head), kept_channels=scores.kept_channels(args.ff_dim)
+    )
+
+    # the config of the pruned model, next to that of the original model
+    cfg_path = os.path.abspath(args.cfg) if os.path.isfile(args.cfg) else search_for_config_yaml_file(args.cfg)
+    pruned_id = args.pruned_cfg or f'{cfg.id}_pruned_h{args.n_head}_ff{args.ff_dim}'
+    pruned_cfg_path = os.path.join(os.path.dirname(cfg_path), f'{pruned_id}.yml')
+    assert not os.path.exists(pruned_cfg_path), f"config file already exists:\n{pruned_cfg_path}"
+    yml_dict = json.loads(json.dumps(Config(cfg_id=cfg_path).yml_dict))
+    yml_dict.update(tf_n_head=args.n_head, tf_head_dim=int(head_dim), tf_ff_dim=args.ff_dim)
+    yml_dict['description'] = f"{yml_dict.get('description', cfg.id)} (pruned: {args.n_head}/{n_head} heads, " \
+                              f"{args.ff_dim}/{ff_dim} feedforward channels)"
+    with open(pruned_cfg_path, 'w') as f:
+        yaml.safe_dump(yml_dict, f, sort_keys=False)
+    print_log(f'pruned model config saved under:\n{pruned_cfg_path}', log, display=True)
+
+    pruned_cfg = ModelConfig(cfg_id=pruned_cfg_path, tmp=False, create_dirs=False)
+    pruned_model = build_model(cfg=pruned_cfg, dataset_cfg=dataset_cfg, state_dict=state_dict, device=device)
+    pruned_cp_path = pruned_cfg.model_path % 'pruned'
+    torch.save({'model_dict': pruned_model.state_dict(), 'pruned_from': cp_path}, pruned_cp_path)
+    print_log(f'pruned model checkpoint saved under:\n{pruned_cp_path}', log, display=True)
+
+    after = evaluate(pruned_model, evaluation_loader, sample_num=cfg.sample_k, n_instances=n_eval, seed=cfg.seed)
+
+    log_str = f"\nPruning report ({n_eval} instances of the {args.eval_split} split, " \
+              f"calibration over {scores.n_batches} instances of the {args.calibration_split} split):\n" \
+              f"{'':<12}{'params':>12}{'min_ADE':>12}{'min_FDE':>12}{'latency_ms':>12}\n"
+    for name, report in [('original', before), ('pruned', after)]:
+        log_str += f"{name:<12}{report['params']:>12}{report['min_ADE']:>12.4f}{report['min_FDE']:>12.4f}" \
+                   f"{report['latency_ms']:>12.2f}\n"
+    print_log(log_str, log, display=True)
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, required=True, default=None,
+                        help="Model config file (specified as either name or path)")
+    parser.add_argument('--checkpoint_name', type=str, default='best_val',
+                        help="\'best_val\' | <model_id>")
+    parser.add_argument('--n_head', type=int, required=True,
+                        help="number of attention heads kept in every attention mechanism.")
+    parser.add_argument('--ff_dim', type=int, required=True,
+                        help="number of feedforward channels kept in every transformer layer.")
+    parser.add_argument('--pruned_cfg', type=str, default=None,
+                        help="name of the config file of the pruned model "
+                             "(by default: <cfg>_pruned_h<n_head>_ff<ff_dim>).")
+    parser.add_argument('--dataset_cfg', type=str, default=None,
+                        help="Dataset config file (by default, the dataset_cfg of the model config file)")
+    parser.add_argument('--calibration_split', type=str, default='val',
+                        help="split whose instances are used to score the heads and channels.")
+    parser.add_argument('--n_calibration', type=int, default=500,
+                        help="number of calibration instances.")
+    parser.add_argument('--eval_split', type=str, default='test',
+                        help="split whose instances are used to report the accuracy and latency of the models.")
+    parser.add_argument('--n_eval', type=int, default=500,
+                        help="number of evaluation instances.")
+    parser.add_argument('--gpu', type=int, default=None)
+    parser.add_argument('--dataset_class', type=str, default='hdf5', help="\'torch\' | \'hdf5\'")
+    args = parser.parse_args()
+
+    main(args=args)
+    print("Goodbye!")
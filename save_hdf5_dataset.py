@@ -4,9 +4,12 @@ import numpy as np
 import os.path
 import struct
 import torch
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
-from data.sdd_dataloader import TorchDataGeneratorSDD
+from data.map import encode_scene_map, IMAGE_ENCODINGS
+from data.sdd_dataloader import TorchDataGeneratorSDD, HDF5PresavedDatasetSDD
+from data.trajectory_operations import flat_sequence_indices
 from utils.config import Config, REPO_ROOT
 from utils.utils import prepare_seed
 
@@ -16,13 +19,31 @@ Tensor = torch.Tensor
 
 DEFAULT_DATASETS_DIR = os.path.join(REPO_ROOT, 'datasets', 'SDD', 'pre_saved_datasets')
 DEFAULT_FILENAME = 'dataset_v2.h5'
-
-
-def prepare_dataset_setup_dict(dataset: TorchDataGeneratorSDD, save_size: Optional[int] = None) -> Dict:
+FORMAT_VERSION = 3
+
+# datasets which can be saved in half precision (their values are all expressed in meters, and remain small)
+FLOAT16_DATASETS = ['trajectories', 'true_trajectories', 'observed_velocities', 'velocities']
+COMPRESSION_FILTERS = [None, 'gzip', 'lzf']
+# datasets whose content is already compressed (HDF5 compression filters are not applied to them)
+ENCODED_DATASETS = ['scene_map']
+
+
+def prepare_dataset_setup_dict(
+        dataset: TorchDataGeneratorSDD,
+        save_size: Optional[int] = None,
+        format_version: int = FORMAT_VERSION,
+        storage_options: Optional[Dict] = None,
+        occlusion_map_storage: str = 'bitmask',
+        trajectory_storage: str = 'instance',
+        scene_map_storage: str = 'none'
+) -> Dict:
     if save_size is None:
         save_size = len(dataset)
 
     assert dataset.map_resolution % 8 == 0
+    assert occlusion_map_storage in ['bitmask', 'polygon']
+    assert trajectory_storage in ['instance', 'track']
+    assert scene_map_storage in ['none', *IMAGE_ENCODINGS.keys()]
     t_len, map_res = dataset.T_total, dataset.map_resolution
 
     # prepare the setup dictionary for instantiation of the HDF5 dataset file
@@ -53,20 +74,208 @@ def prepare_dataset_setup_dict(dataset: TorchDataGeneratorSDD, save_size: Option
                               'chunks': (16, t_len, 2), 'dtype': 'f4'},
     }
 
+    polygon_setup_dict = {
+        'visibility_polygon': {'shape': (0, 2), 'maxshape': (None, 2), 'chunks': (256, 2), 'dtype': 'f4'},
+        'visibility_polygon_lookup_indices': {'shape': (save_size, 2), 'chunks': (128, 2), 'dtype': 'i4'},
+    }
+    if occlusion_map_storage == 'polygon':
+        occlusion_setup_dict.pop('occlusion_map')
+        occlusion_setup_dict.update(polygon_setup_dict)
+
     setup_dict = {**basic_setup_dict}
     if dataset.occlusion_process == 'occlusion_simulation':
         setup_dict = {**basic_setup_dict, **occlusion_setup_dict}
         if dataset.impute:
             setup_dict = {**basic_setup_dict, **occlusion_setup_dict, **impute_setup_dict}
+    if format_version >= 3:
+        setup_dict.update(prepare_sequence_setup_dict(save_size=save_size))
+    if trajectory_storage == 'track':
+        # trajectories and velocities are recomputed from the tracks when loading instances
+        [setup_dict.pop(key, None) for key in TrackCollector.replaced_datasets]
+        setup_dict.update(TrackCollector.prepare_setup_dict(save_size=save_size))
+    if scene_map_storage != 'none':
+        # encoded images are stored as flat byte sequences, in chunks of 64kB
+        setup_dict.update({
+            'scene_map': {'shape': (0,), 'maxshape': (None,), 'chunks': (65536,), 'dtype': 'u1'},
+            'scene_map_lookup_indices': {'shape': (save_size, 2), 'chunks': (128, 2), 'dtype': 'i8'},
+        })
+    if storage_options is not None:
+        setup_dict = apply_storage_options(setup_dict=setup_dict, storage_options=storage_options)
     return setup_dict
 
 
-def instantiate_hdf5_dataset(save_path, setup_dict: Dict):
+def apply_storage_options(setup_dict: Dict, storage_options: Dict) -> Dict:
+    """
+    <storage_options> may contain the following keys:
+        - 'chunks': dict, dataset name --> chunk length along the first dimension
+        - 'compression': None | 'gzip' | 'lzf'
+        - 'compression_opts': int, gzip compression level (0-9)
+        - 'shuffle': bool, whether to apply the byte shuffle filter
+        - 'float16': bool, whether to save the datasets in FLOAT16_DATASETS in half precision
+    String datasets are left untouched, and compression filters are not applied to ENCODED_DATASETS.
+    """
+    compression = storage_options.get('compression', None)
+    assert compression in COMPRESSION_FILTERS
+    chunks = storage_options.get('chunks', dict())
+    assert all(key in setup_dict.keys() for key in chunks.keys()), f"Unknown datasets in: {[*chunks.keys()]}"
+
+    new_setup_dict = dict()
+    for key, value in setup_dict.items():
+        value = {**value}
+        if key in chunks.keys():
+            value['chunks'] = (int(chunks[key]), *value['chunks'][1:])
+        if storage_options.get('float16', False) and key in FLOAT16_DATASETS:
+            value['dtype'] = 'f2'
+        if h5py.check_string_dtype(np.dtype(value['dtype'])) is None and key not in ENCODED_DATASETS:
+            if compression is not None:
+                value['compression'] = compression
+                if compression == 'gzip' and storage_options.get('compression_opts', None) is not None:
+                    value['compression_opts'] = int(storage_options['compression_opts'])
+            if storage_options.get('shuffle', False):
+                value['shuffle'] = True
+        new_setup_dict[key] = value
+    return new_setup_dict
+
+
+def parse_storage_options(args: argparse.Namespace) -> Dict:
+    return {
+        'chunks': {name: int(length) for name, length in (chunk.split('=') for chunk in args.chunks)},
+        'compression': None if args.compression == 'none' else args.compression,
+        'compression_opts': args.compression_level,
+        'shuffle': args.shuffle,
+        'float16': args.float16,
+    }
+
+
+def prepare_sequence_setup_dict(save_size: int) -> Dict:
+    # datasets introduced with format version 3
+    return {
+        'last_obs_indices': {'shape': (0,), 'maxshape': (None,), 'chunks': (512,), 'dtype': 'i1'},
+        'obs_lookup_indices': {'shape': (save_size, 2), 'chunks': (128, 2), 'dtype': 'i4'},
+        'pred_lookup_indices': {'shape': (save_size, 2), 'chunks': (128, 2), 'dtype': 'i4'},
+        'obs_sequence_indices': {'shape': (0,), 'maxshape': (None,), 'chunks': (1024,), 'dtype': 'i2'},
+        'pred_sequence_indices': {'shape': (0,), 'maxshape': (None,), 'chunks': (1024,), 'dtype': 'i2'},
+    }
+
+
+def sequence_fields(observation_mask: Tensor) -> Dict:
+    obs_indices, pred_indices, last_obs_indices = flat_sequence_indices(obs_mask=observation_mask)
+    return {
+        'obs_sequence_indices': obs_indices.numpy().astype(np.int16),
+        'pred_sequence_indices': pred_indices.numpy().astype(np.int16),
+        'last_obs_indices': last_obs_indices.numpy().astype(np.int8),
+    }
+
+
+def unbatched_collate(batch):
+    # instances are generated by DataLoader workers one at a time, and written as they are
+    return batch[0]
+
+
+class TrackCollector:
+    """
+    Gathers the trajectories of every agent across the saved instances, as tracks sampled at the dataset's frame rate.
+    Tracks are identified by (scene, video, agent id, frame phase), with frame phase the remainder of the frames
+    of the track by the dataset's frame skip. Tracks are expressed in the annotation coordinates of the scene.
+    Only the tracks of the current scene video are held in memory: they are appended to the file (along with the
+    track rows of the agents of their instances) as soon as an instance of another video is added. Videos whose
+    instances are not consecutive therefore have their tracks written in several parts.
+    """
+
+    replaced_datasets = ['trajectories', 'true_trajectories', 'observed_velocities', 'velocities']
+    written_datasets = ['tracks', 'track_view_start']
+
+    def __init__(self, frame_skip: int):
+        self.frame_skip = frame_skip
+        self.scene_video = None         # (scene, video) of the held tracks
+        self.tracks = dict()            # track key --> dict(track timestep --> [2])
+        self.agent_views = []           # (track key, track timestep of the first row of the view), in saving order
+        self.n_tracks = 0               # number of tracks written to the file
+
+    @staticmethod
+    def prepare_setup_dict(save_size: int) -> Dict:
+        return {
+            'trajectory_homography': {'shape': (save_size, 3, 3), 'chunks': (128, 3, 3), 'dtype': 'f8'},
+            'track_view_start': {'shape': (0,), 'maxshape': (None,), 'chunks': (512,), 'dtype': 'i4'},
+            'tracks': {'shape': (0, 2), 'maxshape': (None, 2), 'chunks': (1024, 2), 'dtype': 'f4'},
+        }
+
+    def add_instance(self, instance_dict: Dict, hdf5_file: h5py.File) -> None:
+        scene_video = (instance_dict['scene'], instance_dict['video'])
+        if scene_video != self.scene_video:
+            self.flush(hdf5_file=hdf5_file)
+            self.scene_video = scene_video
+
+        # recovering the annotation coordinates of the (non imputed) trajectories
+        homography = instance_dict['trajectory_homography'].to(torch.float64)         # [3, 3]
+        trajs = instance_dict.get('true_trajectories', instance_dict['trajectories']).to(torch.float64)
+        annotation_trajs = (trajs - homography[:2, 2]) @ torch.inverse(homography[:2, :2]).T  # [N, T, 2]
+
+        frame = int(instance_dict['frame'])
+        phase, first_timestep = frame % self.frame_skip, frame // self.frame_skip
+        for agent_id, agent_traj in zip(instance_dict['identities'].tolist(), annotation_trajs.numpy()):
+            key = (instance_dict['scene'], instance_dict['video'], int(agent_id), phase)
+            track = self.tracks.setdefault(key, dict())
+            for t, position in enumerate(agent_traj, start=first_timestep):
+                track.setdefault(t, position)
+            self.agent_views.append((key, first_timestep))
+
+    def flush(self, hdf5_file: h5py.File) -> None:
+        # appends the held tracks to the file, along with the track rows of the agents added since the last flush
+        if len(self.agent_views) == 0:
+            return
+        n_rows = hdf5_file['tracks'].shape[0]
+        track_start = dict()                # track key --> (row of the track's first timestep, first timestep)
+        track_arrays = []
+        for key in sorted(self.tracks.keys()):
+            timesteps = self.tracks[key]
+            first_timestep, last_timestep = min(timesteps.keys()), max(timesteps.keys())
+            # timesteps which are not covered by any instance are filled with NaNs
+            track_array = np.full([last_timestep - first_timestep + 1, 2], np.nan, dtype=np.float32)
+            for t, position in timesteps.items():
+                track_array[t - first_timestep] = position
+            track_start[key] = (n_rows, first_timestep)
+            track_arrays.append(track_array)
+            n_rows += track_array.shape[0]
+
+        tracks_dset = hdf5_file['tracks']
+        tracks_start = tracks_dset.shape[0]
+        tracks_dset.resize(n_rows, axis=0)
+        tracks_dset[tracks_start:] = np.concatenate(track_arrays, axis=0)
+
+        view_start = np.array(
+            [track_start[key][0] + timestep - track_start[key][1] for key, timestep in self.agent_views],
+            dtype=np.int32
+        )
+        view_dset = hdf5_file['track_view_start']
+        views_start = view_dset.shape[0]
+        view_dset.resize(views_start + view_start.shape[0], axis=0)
+        view_dset[views_start:] = view_start
+
+        self.n_tracks += len(self.tracks)
+        self.tracks, self.agent_views = dict(), []
+
+    def write(self, hdf5_file: h5py.File) -> None:
+        # flushes the remaining tracks, once all instances have been added
+        self.flush(hdf5_file=hdf5_file)
+        assert hdf5_file['track_view_start'].shape[0] == hdf5_file['identities'].shape[0]
+
+
+def instantiate_hdf5_dataset(
+        save_path,
+        setup_dict: Dict,
+        format_version: int = FORMAT_VERSION,
+        attributes: Optional[Dict] = None
+):
     assert os.path.exists(os.path.dirname(save_path))
     assert 'identities' in setup_dict.keys()
     assert 'lookup_indices' in setup_dict.keys()
 
     with h5py.File(save_path, 'w') as hdf5_file:
+        if format_version >= 3:
+            hdf5_file.attrs['format_version'] = format_version
+        for k, v in (attributes or dict()).items():
+            hdf5_file.attrs[k] = v
 
         # creating separate datasets for instance elements which do not change shapes
         for k, v in setup_dict.items():
@@ -86,14 +295,28 @@ def write_instance_to_hdf5_dataset(
 
     hdf5_file['lookup_indices'][instance_idx, ...] = (orig_index, orig_index + n_agents)
 
+    if 'obs_sequence_indices' in setup_dict.keys():
+        instance_dict = {**instance_dict, **sequence_fields(observation_mask=instance_dict['observation_mask'])}
+
     for key, value in setup_dict.items():
 
-        if key == 'lookup_indices':
+        if key in ['lookup_indices', *HDF5PresavedDatasetSDD.indexed_datasets.values()]:
+            continue
+        if key in TrackCollector.written_datasets:
             continue
 
         dset = hdf5_file[key]
         data = instance_dict[key]
 
+        if key == 'scene_map':
+            # the encoding parameters are stored as attributes of the file (see main)
+            data = encode_scene_map(
+                scene_map=data,
+                encoding=str(hdf5_file.attrs['scene_map_encoding']),
+                resolution=int(hdf5_file.attrs['scene_map_resolution']),
+                jpeg_quality=int(hdf5_file.attrs['scene_map_jpeg_quality'])
+            )
+
         if verbose:
             description = f"{data.shape, data.dtype}" if isinstance(data, torch.Tensor) else f"{data}"
             print(f"Writing to hdf5 dataset: {key}, {description}")
@@ -109,6 +332,14 @@ def write_instance_to_hdf5_dataset(
 
             dset[instance_idx] = np.void(bytes_occl_map)
 
+        elif key in HDF5PresavedDatasetSDD.indexed_datasets.keys():
+            # sequence, polygon and encoded image datasets are indexed by their own lookup indices
+            lookup_key = HDF5PresavedDatasetSDD.indexed_datasets[key]
+            seq_index, seq_len = dset.shape[0], data.shape[0]
+            hdf5_file[lookup_key][instance_idx, ...] = (seq_index, seq_index + seq_len)
+            dset.resize(seq_index + seq_len, axis=0)
+            dset[seq_index:seq_index + seq_len] = data
+
         elif data is not None:
             if None in dset.maxshape:
                 dset.resize(dset.shape[0] + n_agents, axis=0)
@@ -120,12 +351,86 @@ def write_instance_to_hdf5_dataset(
                 print(f"Skipped:                 {key}")
 
 
+def upgrade_hdf5_dataset(save_path: os.PathLike) -> None:
+    # adds the format version 3 datasets to an existing (format version 2) HDF5 dataset file
+    with h5py.File(save_path, 'a') as hdf5_file:
+        assert int(hdf5_file.attrs.get('format_version', 2)) < 3, "Dataset file is already up to date"
+
+        save_size = hdf5_file['lookup_indices'].shape[0]
+        n_agents_total = hdf5_file['identities'].shape[0]
+        for k, v in prepare_sequence_setup_dict(save_size=save_size).items():
+            hdf5_file.create_dataset(k, **v)
+        hdf5_file['last_obs_indices'].resize(n_agents_total, axis=0)
+
+        for instance_idx in tqdm(range(save_size)):
+            lookup_start, lookup_end = hdf5_file['lookup_indices'][instance_idx]
+            fields = sequence_fields(
+                observation_mask=torch.from_numpy(hdf5_file['observation_mask'][lookup_start:lookup_end])
+            )
+            hdf5_file['last_obs_indices'][lookup_start:lookup_end] = fields['last_obs_indices']
+
+            for key, lookup_key in HDF5PresavedDatasetSDD.sequence_datasets.items():
+                dset, data = hdf5_file[key], fields[key]
+                seq_index, seq_len = dset.shape[0], data.shape[0]
+                hdf5_file[lookup_key][instance_idx, ...] = (seq_index, seq_index + seq_len)
+                dset.resize(seq_index + seq_len, axis=0)
+                dset[seq_index:seq_index + seq_len] = data
+
+        hdf5_file.attrs['format_version'] = FORMAT_VERSION
+
+
+def rows_within_bytes(dset: h5py.Dataset, n_bytes: int) -> int:
+    # number of rows of <dset> fitting within <n_bytes> bytes (at least one), rounded down to a multiple of its chunk
+    # length if it is chunked (variable length rows are counted by the size of their reference)
+    row_bytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+    n_rows = max(n_bytes // max(row_bytes, 1), 1)
+    if dset.chunks is not None:
+        n_rows = max(n_rows // dset.chunks[0], 1) * dset.chunks[0]
+    return n_rows
+
+
+def rewrite_hdf5_dataset(
+        source_path: os.PathLike,
+        save_path: os.PathLike,
+        storage_options: Dict,
+        block_bytes: int = 64 * 2 ** 20,
+        chunk_bytes: int = 2 ** 20
+) -> None:
+    # copies an existing HDF5 dataset file, using a different storage layout.
+    # datasets are copied by blocks of about <block_bytes> bytes, and contiguous source datasets are given chunks of
+    # about <chunk_bytes> bytes.
+    assert os.path.abspath(source_path) != os.path.abspath(save_path)
+    with h5py.File(source_path, 'r') as source_file:
+        setup_dict = dict()
+        for key, dset in source_file.items():
+            chunks = dset.chunks
+            if chunks is None:
+                chunks = (max(min(dset.shape[0], rows_within_bytes(dset, chunk_bytes)), 1), *dset.shape[1:])
+            setup_dict[key] = {'shape': dset.shape, 'maxshape': dset.maxshape, 'chunks': chunks, 'dtype': dset.dtype}
+        storage_options = {
+            **storage_options,
+            'chunks': {k: v for k, v in storage_options.get('chunks', dict()).items() if k in setup_dict.keys()}
+        }
+        setup_dict = apply_storage_options(setup_dict=setup_dict, storage_options=storage_options)
+
+        with h5py.File(save_path, 'w') as hdf5_file:
+            for key, value in source_file.attrs.items():
+                hdf5_file.attrs[key] = value
+            for key, value in setup_dict.items():
+                source_dset = source_file[key]
+                dset = hdf5_file.create_dataset(key, **value)
+                block_size = rows_within_bytes(source_dset, block_bytes)
+                for start in tqdm(range(0, source_dset.shape[0], block_size), desc=key, leave=False):
+                    dset[start:start + block_size] = source_dset[start:start + block_size]
+
+
 def main(args: argparse.Namespace):
     assert args.split in ['train', 'val', 'test']
     assert args.size_setting in ['generator', 'indices']
 
     cfg = Config(cfg_id=args.cfg)
-    cfg.__setattr__('with_rgb_map', args.process_rgb_map)
+    # the RGB scene map is processed if it is to be stored
+    cfg.__setattr__('with_rgb_map', args.process_rgb_map or args.scene_map_storage != 'none')
 
     if args.save_path is None:
         # Assign default save path
@@ -137,6 +442,19 @@ def main(args: argparse.Namespace):
         )
     assert args.save_path.endswith('.h5')
 
+    if args.upgrade:
+        print(f"Upgrading the dataset file to format version {FORMAT_VERSION}:\n{args.save_path}\n")
+        upgrade_hdf5_dataset(save_path=args.save_path)
+        return
+
+    if args.relayout_from is not None:
+        print(f"Rewriting the dataset file:\n{args.relayout_from}\nwith a different storage layout, under:\n"
+              f"{args.save_path}\n")
+        rewrite_hdf5_dataset(
+            source_path=args.relayout_from, save_path=args.save_path, storage_options=parse_storage_options(args)
+        )
+        return
+
     print(f"Presaving a dataset from the \'{args.cfg}\' file (\'{args.split}\' split).\n")
     print(f"Dataset will be saved under:\n{args.save_path}\n")
 
@@ -153,26 +471,59 @@ def main(args: argparse.Namespace):
 
     hdf5_setup_dict = prepare_dataset_setup_dict(
         dataset=generator,
-        save_size=len(generator) if args.size_setting == 'generator' else args.end_idx - args.start_idx
+        save_size=len(generator) if args.size_setting == 'generator' else args.end_idx - args.start_idx,
+        format_version=args.format_version,
+        storage_options=parse_storage_options(args),
+        occlusion_map_storage=args.occlusion_map_storage,
+        trajectory_storage=args.trajectory_storage,
+        scene_map_storage=args.scene_map_storage
     )
+    file_attributes = dict()
+    if args.scene_map_storage != 'none':
+        file_attributes = {
+            'scene_map_encoding': args.scene_map_storage,
+            'scene_map_resolution': args.scene_map_resolution or generator.map_resolution,
+            'scene_map_jpeg_quality': args.jpeg_quality,
+        }
 
     print(f"Target HDF5 file has the following characteristics:")
     [print(f"{k}: {v}") for k, v in hdf5_setup_dict.items()]
     print()
 
-    if not os.path.exists(args.save_path):
+    hdf5_file_is_new = not os.path.exists(args.save_path)
+    if hdf5_file_is_new:
         print("Dataset file does not exist, creating a new file\n")
-        instantiate_hdf5_dataset(save_path=args.save_path, setup_dict=hdf5_setup_dict)
+        instantiate_hdf5_dataset(
+            save_path=args.save_path, setup_dict=hdf5_setup_dict, format_version=args.format_version,
+            attributes=file_attributes
+        )
     else:
         print("Dataset file already exists, continuing from there...\n")
+        with h5py.File(args.save_path, 'r') as hdf5_file:
+            assert (args.scene_map_storage != 'none') == ('scene_map' in hdf5_file), \
+                "--scene_map_storage does not match the existing dataset file"
 
     indices = range(args.start_idx, args.end_idx, 1)
     print(f"Saving Dataset instances between the range [{args.start_idx}-{args.end_idx}].")
 
+    # instances are written in order, their content does not depend on the number of workers generating them
+    # (random draws are keyed by instance index, see TorchDataGeneratorSDD)
+    if args.num_workers > 0:
+        assert generator.per_instance_rng, "parallel generation requires per instance random number generators"
+    loader = DataLoader(
+        dataset=Subset(generator, indices), shuffle=False, num_workers=args.num_workers, collate_fn=unbatched_collate
+    )
+
+    track_collector = None
+    if args.trajectory_storage == 'track':
+        # the tracks of the last scene video are only written once all instances have been processed:
+        # the file cannot be saved in parts
+        assert hdf5_file_is_new, "Track storage datasets must be saved in a single run"
+        track_collector = TrackCollector(frame_skip=generator.frame_skip)
+
     with h5py.File(args.save_path, 'a') as hdf5_file:
 
-        for i, idx in enumerate(tqdm(indices)):
-            data_dict = generator.__getitem__(idx)
+        for idx, data_dict in zip(indices, tqdm(loader)):
 
             write_instance_to_hdf5_dataset(
                 hdf5_file=hdf5_file,
@@ -181,6 +532,12 @@ def main(args: argparse.Namespace):
                 instance_dict=data_dict,
                 verbose=False
             )
+            if track_collector is not None:
+                track_collector.add_instance(instance_dict=data_dict, hdf5_file=hdf5_file)
+
+        if track_collector is not None:
+            track_collector.write(hdf5_file=hdf5_file)
+            print(f"Wrote {track_collector.n_tracks} tracks")
 
 
 if __name__ == '__main__':
@@ -203,7 +560,48 @@ if __name__ == '__main__':
                         help="Whether to have the <TorchDataGeneratorSDD> class process the RGB scene map."
                              "This significantly increases the program's running time and memory usage."
                              "The saving process does not use the RGB scene map, setting this flag to True will not"
-                             "modify the program's output in any way (so it should be kept as False).")
+                             "modify the program's output in any way (so it should be kept as False). "
+                             "The RGB scene map is always processed if --scene_map_storage is set.")
+    parser.add_argument('--format_version', type=int, default=FORMAT_VERSION,
+                        help="2: store trajectory data only.\n"
+                             "3: additionally store the flattened observed/prediction sequence indices.")
+    parser.add_argument('--occlusion_map_storage', type=str, default='bitmask',
+                        help="\'bitmask\': store the occlusion maps as bit-packed masks.\n"
+                             "\'polygon\': store the vertices of the visibility polygons instead (rasterized at "
+                             "loading time, at the resolution of the dataset config file).")
+    parser.add_argument('--trajectory_storage', type=str, default='instance',
+                        help="\'instance\': store the trajectories and velocities of every instance.\n"
+                             "\'track\': store every agent track once, instances then refer to their section of the "
+                             "tracks (trajectories and velocities are recomputed at loading time).")
+    parser.add_argument('--scene_map_storage', type=str, default='none',
+                        help="\'none\': do not store the RGB scene map.\n"
+                             "\'jpeg\' | \'png\': store the final (cropped and rotated) RGB scene map window of "
+                             "every instance as a compressed image (decoded at loading time).")
+    parser.add_argument('--scene_map_resolution', type=int, default=None,
+                        help="resolution [px] of the stored scene map windows (by default, the map resolution of "
+                             "the dataset config file). Windows are resized to the configured map resolution "
+                             "when loaded.")
+    parser.add_argument('--jpeg_quality', type=int, default=90,
+                        help="JPEG quality (0-100) of the stored scene map windows.")
+    parser.add_argument('--chunks', nargs='*', default=[],
+                        help="chunk lengths along the first dimension of specific datasets, "
+                             "e.g.: --chunks trajectories=64 occlusion_map=16")
+    parser.add_argument('--compression', type=str, default='none',
+                        help="\'none\' | \'gzip\' | \'lzf\'")
+    parser.add_argument('--compression_level', type=int, default=None,
+                        help="gzip compression level (0-9).")
+    parser.add_argument('--shuffle', action='store_true', default=False,
+                        help="apply the byte shuffle filter (improves the compression ratio of numerical data).")
+    parser.add_argument('--float16', action='store_true', default=False,
+                        help=f"save the following datasets in half precision: {FLOAT16_DATASETS}")
+    parser.add_argument('--relayout_from', type=os.path.abspath, default=None,
+                        help="copy an existing dataset file to --save_path, with the storage layout specified by "
+                             "--chunks, --compression, --compression_level, --shuffle and --float16.")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="number of worker processes generating the dataset instances.")
+    parser.add_argument('--upgrade', action='store_true', default=False,
+                        help="Upgrade the existing dataset file found under --save_path to the latest format version,"
+                             " instead of saving a new dataset.")
     args = parser.parse_args()
 
     main(args=args)
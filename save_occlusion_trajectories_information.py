@@ -6,6 +6,7 @@ from torch.utils.data import DataLoader
 
 from tqdm import tqdm
 from data.sdd_dataloader import dataset_dict
+from data.trajectory_operations import observed_velocity
 from utils.config import Config, REPO_ROOT
 
 
@@ -64,11 +65,7 @@ def main(args: argparse.Namespace):
         return (trajectories[..., 1:, :] - trajectories[..., :-1, :]).pow(2).sum(dim=-1).pow(0.5).sum(dim=-1)
 
     def travl(trajs, obs_mask):
-        vel = torch.zeros_like(trajs)  # [N, T, 2]
-        for traj, mask, v in zip(trajs, obs_mask, vel):
-            obs_indices = torch.nonzero(mask)  # [Z, 1]
-            motion_diff = traj[obs_indices[1:, 0], :] - traj[obs_indices[:-1, 0], :]  # [Z - 1, 2]
-            v[obs_indices[1:].squeeze(), :] = motion_diff / (obs_indices[1:, :] - obs_indices[:-1, :])  # [Z - 1, 2]
+        vel = observed_velocity(trajs=trajs, obs_mask=obs_mask)     # [N, T, 2]
         return vel.pow(2).sum(dim=-1).pow(0.5).sum(-1)
 
     for i, data in enumerate(pbar := tqdm(test_loader)):
@@ -1,6 +1,7 @@
 import os
 import argparse
 import pickle
+import time
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -8,7 +9,7 @@ from tqdm import tqdm
 from data.sdd_dataloader import dataset_dict
 from model.model_lib import model_dict
 from utils.config import Config, ModelConfig
-from utils.utils import prepare_seed, print_log, mkdir_if_missing, get_cuda_device
+from utils.utils import prepare_seed, print_log, mkdir_if_missing, get_cuda_device, results_name
 
 
 def main(args: argparse.Namespace):
@@ -22,6 +23,8 @@ def main(args: argparse.Namespace):
 
     # device
     device = get_cuda_device(device_index=args.gpu)
+    if args.quantize:
+        assert torch.device(device).type == 'cpu', "quantized inference is only available on CPU"
 
     # log
     log = open(os.path.join(cfg.log_dir, 'log_test.txt'), 'w')
@@ -30,22 +33,32 @@ def main(args: argparse.Namespace):
     dataset_class = dataset_dict[args.dataset_class]
     dataset_cfg = Config(cfg_id=args.dataset_cfg)
     dataset_cfg.__setattr__('with_rgb_map', False)
+    if args.custom_dataset_size is not None:
+        dataset_cfg.__setattr__('custom_dataset_size', args.custom_dataset_size)
     dataset_kwargs = dict(parser=dataset_cfg, split=args.data_split)
     if args.legacy:
         dataset_kwargs.update(legacy_mode=True)
     assert dataset_cfg.dataset == 'sdd'
     if dataset_cfg.dataset == 'sdd':
         sdd_test_set = dataset_class(**dataset_kwargs)
-        test_loader = DataLoader(dataset=sdd_test_set, shuffle=False, num_workers=0)
+        test_loader = DataLoader(
+            dataset=sdd_test_set, shuffle=False, num_workers=args.num_workers,
+            pin_memory=torch.device(device).type == 'cuda'
+        )
 
     # model
     model_id = cfg.get('model_id', 'agentformer')
     for key in ['past_frames', 'future_frames', 'motion_dim', 'forecast_dim', 'traj_scale', 'global_map_resolution']:
         assert key in dataset_cfg.yml_dict.keys()
         cfg.yml_dict[key] = dataset_cfg.__getattribute__(key)
+    if args.sample_chunk_size is not None:
+        cfg.yml_dict['sample_chunk_size'] = args.sample_chunk_size
+    if args.sample_memory_budget is not None:
+        cfg.yml_dict['sample_memory_budget'] = args.sample_memory_budget
 
     model = model_dict[model_id](cfg)
     model.set_device(device)
+    sdd_test_set.set_required_fields(model.required_inputs())
     model.eval()
     if model_id in ['const_velocity', 'oracle']:
         args.checkpoint_name = 'untrained'
@@ -57,13 +70,26 @@ def main(args: argparse.Namespace):
         print_log(f'loading model from checkpoint: {cp_path}', log, display=True)
         model_cp = torch.load(cp_path, map_location='cpu')
         model.load_state_dict(model_cp['model_dict'])
+    if args.quantize:
+        assert hasattr(model, 'quantize'), f"{model_id} models cannot be quantized"
+        model.quantize()
+        print_log('dynamic int8 quantization of the linear layers of the model', log, display=True)
+    if args.precision != 'fp32':
+        assert not args.quantize, "quantized models are run in fp32"
+        assert hasattr(model, 'set_precision'), f"{model_id} models can only be run in fp32"
+        model.set_precision(args.precision)
+        print_log(f'{args.precision} transformers and map CNN', log, display=True)
 
     # saving model predictions
-    save_dir = os.path.join(cfg.result_dir, sdd_test_set.dataset_name, args.checkpoint_name, args.data_split)
+    save_dir = os.path.join(
+        cfg.result_dir, sdd_test_set.dataset_name,
+        results_name(args.checkpoint_name, quantize=args.quantize, precision=args.precision), args.data_split
+    )
     log_str = f'saving predictions under the following directory:\n{save_dir}\n\n'
     print_log(log_str, log=log)
     mkdir_if_missing(save_dir)
 
+    inference_time = 0.
     for i, data in enumerate(pbar := tqdm(test_loader)):
         filename = data['instance_name'][0]
         pbar.set_description(f"Saving: {filename}")
@@ -72,9 +98,11 @@ def main(args: argparse.Namespace):
         with torch.no_grad():
             model.set_data(data)
             # recon_pred, _ = model.inference(mode='recon', sample_num=1)         # [B, P, 2]   # unused
+            start = time.perf_counter()
             samples_pred, model_data = model.inference(
                 mode='infer', sample_num=cfg.sample_k, need_weights=False
             )  # [B * sample_k, P, 2]
+            inference_time += time.perf_counter() - start
 
         for key, value in model_data.items():
             if key == 'valid_id' or 'last_obs_' in key or 'pred_' in key or '_dec_' in key:
@@ -83,6 +111,13 @@ def main(args: argparse.Namespace):
         with open(os.path.join(save_dir, filename), 'wb') as f:
             pickle.dump(out_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
 
+    log_str = f"Inference time: {inference_time:.2f}s over {len(sdd_test_set)} instances " \
+              f"({len(sdd_test_set) / inference_time:.2f} instances/s)"
+    print_log(log_str, log=log)
+
+    if getattr(model, 'memory_tracker', None) is not None:
+        print_log(f"Memory used per phase: {model.memory_tracker.report()}", log=log)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -98,6 +133,20 @@ if __name__ == '__main__':
     parser.add_argument('--gpu', type=int, default=None)
     parser.add_argument('--dataset_class', type=str, default='hdf5', help="\'torch\' | \'hdf5\'")
     parser.add_argument('--legacy', action='store_true', default=False)
+    parser.add_argument('--sample_chunk_size', type=int, default=None,
+                        help="decode the sample_k samples in chunks of <sample_chunk_size> samples.")
+    parser.add_argument('--sample_memory_budget', type=float, default=None,
+                        help="memory budget [MB] from which the size of the sample chunks is determined.")
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help="CPU inference with dynamic int8 quantization of the linear layers of the model "
+                             "(predictions are saved under <checkpoint_name>_int8).")
+    parser.add_argument('--precision', type=str, default='fp32',
+                        help="\'fp32\' | \'bf16\': precision of the transformers and map CNN of the model "
+                             "(predictions are saved under <checkpoint_name>_bf16).")
+    parser.add_argument('--custom_dataset_size', type=int, default=None,
+                        help="only run the model on a fixed subset of <custom_dataset_size> instances of the split.")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="number of DataLoader worker processes (e.g., decoding presaved scene maps).")
     args = parser.parse_args()
 
     main(args=args)
@@ -0,0 +1,119 @@
+import argparse
+import h5py
+import numpy as np
+import os
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from data.map import apply_homography
+from data.sdd_dataloader import HDF5PresavedDatasetSDD
+from data.trajectory_operations import last_observed_indices
+from utils.config import Config
+from utils.performance_metrics import compute_points_out_of_map, compute_points_in_occlusion_zone
+
+Tensor = torch.Tensor
+
+
+# subset name --> description
+SUBSETS = {
+    'fully_observed': "instances whose agents are all observed at t=0",
+    'occluded': "instances containing at least one agent which is not observed at t=0",
+    'difficult': "instances containing at least one occluded agent whose Constant Velocity prediction at t=0 lies "
+                 "outside of the occlusion zone (equivalent to the CV predictor's OAC_t0 == 0)",
+    'idle': "instances whose agents all travel less than 0.5 [m] over the past",
+    'moving': "instances containing at least one agent which travels 0.5 [m] or more over the past",
+}
+IDLE_DISTANCE_THRESHOLD = 0.5       # [m], same threshold as in utils/performance_analysis.py
+
+
+def travelled_distance(
+        trajs: Tensor       # [N, T, 2]
+) -> Tensor:                # [N]
+    return (trajs[:, 1:, :] - trajs[:, :-1, :]).pow(2).sum(dim=-1).pow(0.5).sum(dim=-1)
+
+
+def cv_positions_in_visible_area(
+        data: dict,
+        last_obs_indices: Tensor    # [N]
+) -> Tensor:                        # [N]
+    # returns a bool mask, True for the agents whose constant velocity prediction at t=0 lies inside the map,
+    # and outside of the occlusion zone
+    last_obs_positions = data['last_obs_positions'][0]                                              # [N, 2]
+    last_obs_velocities = data['observed_velocities'][0][
+        torch.arange(last_obs_indices.shape[0]), last_obs_indices
+    ]                                                                                               # [N, 2]
+    positions_t0 = last_obs_positions - data['last_obs_timesteps'][0].unsqueeze(-1) * last_obs_velocities  # [N, 2]
+
+    occlusion_map = data['dist_transformed_occlusion_map'][0]                                       # [H, W]
+    map_positions_t0 = apply_homography(points=positions_t0, homography=data['map_homography'][0])  # [N, 2]
+    in_map = ~compute_points_out_of_map(map_dims=occlusion_map.shape, points=map_positions_t0)
+    in_occlusion_zone = compute_points_in_occlusion_zone(occlusion_map=occlusion_map, points=map_positions_t0)
+    return torch.logical_and(in_map, ~in_occlusion_zone)
+
+
+def main(args: argparse.Namespace):
+    data_cfg = Config(cfg_id=args.cfg)
+    data_cfg.__setattr__('with_rgb_map', False)
+    # the subsets are computed over the entire dataset
+    data_cfg.__setattr__('difficult', False)
+    data_cfg.__setattr__('subset', None)
+    data_cfg.__setattr__('custom_dataset_size', None)
+
+    dataset = HDF5PresavedDatasetSDD(parser=data_cfg, split=args.split, legacy_mode=args.legacy)
+    loader = DataLoader(dataset=dataset, shuffle=False, num_workers=args.num_workers)
+
+    if args.save_path is None:
+        args.save_path = dataset.subsets_file
+    assert args.save_path.endswith('.h5')
+
+    subset_names = ['fully_observed', 'occluded', 'idle', 'moving']
+    with_difficult = dataset.occlusion_process == 'occlusion_simulation' and not dataset.impute
+    if with_difficult:
+        subset_names.append('difficult')
+    subsets = {name: [] for name in subset_names}
+
+    true_key = 'true_' if dataset.impute else ''
+    for i, data in enumerate(tqdm(loader)):
+        instance_idx = int(dataset.indices[i])
+
+        obs_mask = data[f'{true_key}observation_mask'][0]                   # [N, T]
+        trajs = data[f'{true_key}trajectories'][0]                          # [N, T, 2]
+        last_obs_indices = last_observed_indices(obs_mask=obs_mask.to(torch.int16))       # [N]
+
+        occluded_agents = last_obs_indices < dataset.T_obs - 1              # [N]
+        idle_agents = travelled_distance(trajs[:, :dataset.T_obs, :]) < IDLE_DISTANCE_THRESHOLD     # [N]
+
+        subsets['occluded' if torch.any(occluded_agents) else 'fully_observed'].append(instance_idx)
+        subsets['idle' if torch.all(idle_agents) else 'moving'].append(instance_idx)
+        if with_difficult:
+            difficult_agents = torch.logical_and(
+                occluded_agents, cv_positions_in_visible_area(data=data, last_obs_indices=last_obs_indices)
+            )
+            if torch.any(difficult_agents):
+                subsets['difficult'].append(instance_idx)
+
+    print(f"Saving subset indices under:\n{args.save_path}")
+    with h5py.File(args.save_path, 'w') as subsets_file:
+        for name, indices in subsets.items():
+            dset = subsets_file.create_dataset(name, data=np.array(indices, dtype=np.int64))
+            dset.attrs['description'] = SUBSETS[name]
+            print(f"{name}: {len(indices)} instances")
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, required=True, default=None,
+                        help="Dataset config file (specified as either name or path")
+    parser.add_argument('--split', type=str, default='test',
+                        help="\'train\' | \'val\' | \'test\'")
+    parser.add_argument('--save_path', type=os.path.abspath, default=None,
+                        help="location of the subset indices file (by default, next to the HDF5 dataset file).")
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--legacy', action='store_true', default=False)
+    args = parser.parse_args()
+
+    main(args=args)
+
+    print("Goodbye!")
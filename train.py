@@ -11,9 +11,10 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from csv import DictWriter
 
+from data.augmentation import BatchedRandomRotation
 from data.sdd_dataloader import dataset_dict
 from model.model_lib import model_dict
-from utils.torch_ops import get_scheduler
+from utils.torch_ops import get_scheduler, float32_state_dict
 from utils.config import Config, ModelConfig
 from utils.utils import prepare_seed, print_log, AverageMeter, convert_secs2time, get_timestring, get_cuda_device
 
@@ -101,7 +102,8 @@ def save_model(
 ) -> None:
     save_name = f"epoch_{epoch_idx}_batch_{batch_idx}"
     cp_path = cfg.model_path % save_name
-    model_cp = {'model_dict': model.state_dict(), 'opt_dict': optimizer.state_dict(),
+    # (the parameters are saved in float32, whatever the precision of the model, see set_precision)
+    model_cp = {'model_dict': float32_state_dict(model), 'opt_dict': optimizer.state_dict(),
                 'scheduler_dict': scheduler.state_dict(),
                 'epoch_idx': epoch_idx, 'batch_idx': batch_idx,
                 'train_loss': train_loss_avg,
@@ -130,7 +132,7 @@ def train(
         training_loader: DataLoader, validation_loader: DataLoader,
         csv_models_field_names: List[str], csv_field_names: List[str],
         csv_models: str, csv_train_logfile: str, csv_val_logfile: str, log: TextIO, tb_logger: SummaryWriter,
-        epoch_index: int, batch_idx: int = 0
+        epoch_index: int, batch_idx: int = 0, augmentation: Optional[BatchedRandomRotation] = None
 ) -> None:
     since_train = time.time()
     log_str = f"In train function, Starting at {get_timestring()}"
@@ -158,6 +160,10 @@ def train(
 
     for i, data in enumerate(data_iter, start=batch_idx):
 
+        # batched augmentation of the collated training instances
+        if augmentation is not None:
+            data = augmentation(data)
+
         # training
         total_loss, loss_dict, loss_unweighted_dict = train_one_batch(model=model, data=data, optimizer=optimizer)
 
@@ -185,6 +191,8 @@ def train(
                 batch_idx=i,
                 split='train'
             )
+            if getattr(model, 'memory_tracker', None) is not None:
+                print_log(f"Memory used per phase: {model.memory_tracker.report()}", log=log)
 
         # every <validation_freq> step:
         #   advance the scheduler, perform validation, report validation losses, and save the model
@@ -280,6 +288,7 @@ def main(args: argparse.Namespace):
     print_log("python version : {}".format(sys.version.replace('\n', ' ')), log)
     print_log("torch version : {}".format(torch.__version__), log)
     print_log("cudnn version : {}".format(torch.backends.cudnn.version()), log)
+    print_log("precision : {}".format(args.precision), log)
     tb_logger = SummaryWriter(cfg.tb_dir)
     csv_train_logfile = os.path.join(cfg.log_dir, "train_losses.csv")
     csv_val_logfile = os.path.join(cfg.log_dir, "val_losses.csv")
@@ -310,15 +319,27 @@ def main(args: argparse.Namespace):
         dataset_kwargs_train.update(legacy_mode=True)
         dataset_kwargs_val.update(legacy_mode=True)
 
+    # batches are placed in pinned memory, so that they can be transferred to the GPU asynchronously (see set_data)
+    pin_memory = torch.device(device).type == 'cuda'
+
     assert data_cfg_train.dataset == "sdd"
     if data_cfg_train.dataset == "sdd":
         sdd_train_set = dataset_class(**dataset_kwargs_train)
-        training_loader = DataLoader(dataset=sdd_train_set, shuffle=True, num_workers=0)
+        training_loader = DataLoader(
+            dataset=sdd_train_set, shuffle=True, num_workers=args.num_workers, pin_memory=pin_memory
+        )
 
     assert data_cfg_val.dataset == "sdd"
     if data_cfg_val.dataset == "sdd":
         sdd_val_set = dataset_class(**dataset_kwargs_val)
-        validation_loader = DataLoader(dataset=sdd_val_set, shuffle=False, num_workers=0)
+        validation_loader = DataLoader(
+            dataset=sdd_val_set, shuffle=False, num_workers=args.num_workers, pin_memory=pin_memory
+        )
+
+    augmentation = None
+    if data_cfg_train.get('batch_rand_rot', False):
+        print_log(f"Applying batched random rotations to the training instances", log)
+        augmentation = BatchedRandomRotation(max_angle=float(data_cfg_train.get('batch_rand_rot_max_angle', 360.)))
 
     for key in ['future_frames', 'motion_dim', 'forecast_dim', 'global_map_resolution']:
         assert key in data_cfg_train.yml_dict.keys()
@@ -328,6 +349,17 @@ def main(args: argparse.Namespace):
     """ model """
     model_id = cfg.get('model_id', 'agentformer')
     model = model_dict[model_id](cfg)
+    if hasattr(model, 'load_teacher'):
+        # models distilled from a teacher model only load it for training (it reads its own dataset fields)
+        model.load_teacher()
+    if args.precision != 'fp32':
+        assert hasattr(model, 'set_precision'), f"{model_id} models can only be trained in fp32"
+        model.set_precision(args.precision)
+
+    # the datasets only read and compute the fields used by the model
+    sdd_train_set.set_required_fields(model.required_inputs())
+    sdd_val_set.set_required_fields(model.required_inputs())
+
     optimizer = optim.Adam(model.parameters(), lr=cfg.lr)
     scheduler_type = cfg.get('lr_scheduler', 'linear')
     if scheduler_type == 'linear':
@@ -389,7 +421,7 @@ def main(args: argparse.Namespace):
             scheduler=scheduler, training_loader=training_loader, validation_loader=validation_loader,
             csv_models_field_names=csv_models_field_names, csv_field_names=csv_field_names, csv_models=csv_models,
             csv_train_logfile=csv_train_logfile, csv_val_logfile=csv_val_logfile, log=log, tb_logger=tb_logger,
-            epoch_index=epoch_i, batch_idx=start_batch_idx
+            epoch_index=epoch_i, batch_idx=start_batch_idx, augmentation=augmentation
         )
 
 
@@ -404,6 +436,11 @@ if __name__ == '__main__':
     parser.add_argument('--dataset_class', type=str, default='hdf5',
                         help="\'torch\' | \'hdf5\'")
     parser.add_argument('--legacy', action='store_true', default=False)
+    parser.add_argument('--precision', type=str, default='fp32',
+                        help="\'fp32\' | \'bf16\': precision of the transformers and map CNN of the model (the rest of "
+                             "the model, and the losses, remain in fp32).")
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help="number of DataLoader worker processes (e.g., decoding presaved scene maps).")
     args = parser.parse_args()
 
     main(args=args)
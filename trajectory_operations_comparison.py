@@ -0,0 +1,159 @@
+import argparse
+import torch
+from tqdm import tqdm
+
+from data.trajectory_operations import last_observed_indices, observed_velocity, cv_extrapolate, \
+    impute_and_cv_predict
+from utils.utils import prepare_seed, get_cuda_device
+
+from typing import Dict, Tuple
+Tensor = torch.Tensor
+
+
+# reference implementations: the per-agent loops (and scipy's interp1d) replaced by the vectorized trajectory
+# operations of data/trajectory_operations.py
+def reference_observed_velocity(
+        trajs: Tensor,      # [N, T, 2]
+        obs_mask: Tensor    # [N, T]
+) -> Tensor:                # [N, T, 2]
+    vel = torch.zeros_like(trajs)
+    for traj, mask, v in zip(trajs, obs_mask, vel):
+        obs_indices = torch.nonzero(mask)  # [Z, 1]
+        motion_diff = traj[obs_indices[1:, 0], :] - traj[obs_indices[:-1, 0], :]  # [Z - 1, 2]
+        v[obs_indices[1:].squeeze(), :] = motion_diff / (obs_indices[1:, :] - obs_indices[:-1, :])  # [Z - 1, 2]
+    return vel
+
+
+def reference_cv_extrapolate(
+        trajs: Tensor,              # [N, T, 2]
+        obs_vel: Tensor,            # [N, T, 2]
+        last_obs_indices: Tensor    # [N]
+) -> Tensor:                        # [N, T, 2]
+    xtrpl_trajs = trajs.detach().clone()
+    for traj, vel, obs_idx in zip(xtrpl_trajs, obs_vel, last_obs_indices):
+        last_pos = traj[obs_idx]
+        last_vel = vel[obs_idx]
+        extra_seq = last_pos + torch.arange(traj.shape[0] - obs_idx).unsqueeze(1) * last_vel
+        traj[obs_idx:] = extra_seq
+    return xtrpl_trajs
+
+
+def reference_impute_and_cv_predict(
+        trajs: Tensor,      # [N, T, 2]
+        obs_mask: Tensor,   # [N, T]
+        timesteps: Tensor   # [T]
+) -> Tensor:                # [N, T, 2]
+    from scipy.interpolate import interp1d
+    imputed_trajs = torch.zeros_like(trajs)
+    for idx, (traj, mask) in enumerate(zip(trajs, obs_mask)):
+        # if none of the values are observed, then skip this trajectory altogether
+        if mask.sum() == 0:
+            continue
+        # (interp1d raises with a single observation: the vectorized operation keeps the trajectory constant)
+        if mask.sum() == 1:
+            imputed_trajs[idx, ...] = traj[mask]
+            continue
+        f = interp1d(timesteps[mask], traj[mask], axis=0, fill_value='extrapolate')
+        interptraj = f(timesteps)
+        imputed_trajs[idx, ...] = torch.from_numpy(interptraj)
+    return imputed_trajs
+
+
+def random_instance(
+        n_agents: int, n_timesteps: int, obs_probability: float
+) -> Tuple[Tensor, Tensor]:         # [N, T, 2], [N, T]
+    # random walks, with random observation masks. The first agents cover the edge cases: no observation, a single
+    # observation, a fully observed trajectory, and a trajectory observed over its first half only.
+    trajs = torch.cumsum(torch.randn([n_agents, n_timesteps, 2]), dim=1) + 20. * torch.randn([n_agents, 1, 2])
+    obs_mask = torch.rand([n_agents, n_timesteps]) < obs_probability
+    obs_mask[0] = False
+    obs_mask[1] = False
+    obs_mask[1, torch.randint(n_timesteps, [1])] = True
+    obs_mask[2] = True
+    obs_mask[3] = torch.arange(n_timesteps) < n_timesteps // 2
+    return trajs, obs_mask
+
+
+def max_error(tensor_1: Tensor, tensor_2: Tensor) -> float:
+    return float(torch.max(torch.abs(tensor_1.cpu() - tensor_2.cpu())))
+
+
+def compare_instance(
+        trajs: Tensor,          # [N, T, 2]
+        obs_mask: Tensor,       # [N, T]
+        timesteps: Tensor,      # [T]
+        device: torch.device
+) -> Dict[str, float]:
+    # the vectorized operations run on <device>, with the timesteps left on CPU
+    last_obs_idx = last_observed_indices(obs_mask=obs_mask.to(torch.int16))                # [N]
+    ref_vel = reference_observed_velocity(trajs=trajs, obs_mask=obs_mask)
+    ref_xtrpl = reference_cv_extrapolate(trajs=trajs, obs_vel=ref_vel, last_obs_indices=last_obs_idx)
+    ref_imputed = reference_impute_and_cv_predict(trajs=trajs, obs_mask=obs_mask, timesteps=timesteps)
+
+    trajs, obs_mask = trajs.to(device), obs_mask.to(device)
+    vel = observed_velocity(trajs=trajs, obs_mask=obs_mask)
+    xtrpl = cv_extrapolate(trajs=trajs, obs_vel=vel, last_obs_indices=last_obs_idx.to(device))
+    imputed = impute_and_cv_predict(trajs=trajs, obs_mask=obs_mask, timesteps=timesteps)
+
+    # imputed instances, as prepared by the datasets: the velocities of the imputed trajectories
+    ref_imputed_vel = reference_observed_velocity(trajs=ref_imputed, obs_mask=torch.ones_like(obs_mask.cpu()))
+    imputed_vel = observed_velocity(trajs=imputed, obs_mask=torch.ones_like(obs_mask))
+    return {
+        'observed_velocity': max_error(vel, ref_vel),
+        'cv_extrapolate': max_error(xtrpl, ref_xtrpl),
+        'impute_and_cv_predict': max_error(imputed, ref_imputed),
+        'imputed_velocity': max_error(imputed_vel, ref_imputed_vel)
+    }
+
+
+def main(args: argparse.Namespace):
+    prepare_seed(args.seed)
+    device = get_cuda_device(device_index=args.gpu) if args.gpu is not None else torch.device('cpu')
+    timesteps = torch.arange(-args.past_frames, args.future_frames) + 1        # [T]
+
+    errors = None
+    batch_trajs, batch_masks, batch_imputed = [], [], []
+    for _ in tqdm(range(args.n_instances)):
+        trajs, obs_mask = random_instance(
+            n_agents=args.n_agents, n_timesteps=timesteps.shape[0], obs_probability=args.obs_probability
+        )
+        instance_errors = compare_instance(trajs=trajs, obs_mask=obs_mask, timesteps=timesteps, device=device)
+        errors = instance_errors if errors is None else {
+            key: max(errors[key], value) for key, value in instance_errors.items()
+        }
+        batch_trajs.append(trajs)
+        batch_masks.append(obs_mask)
+        batch_imputed.append(reference_impute_and_cv_predict(trajs=trajs, obs_mask=obs_mask, timesteps=timesteps))
+
+    # the same instances, processed as a single [B, N, T] batch
+    batched = impute_and_cv_predict(
+        trajs=torch.stack(batch_trajs).to(device), obs_mask=torch.stack(batch_masks).to(device), timesteps=timesteps
+    )
+    errors['impute_and_cv_predict (batched)'] = max_error(batched, torch.stack(batch_imputed))
+
+    print(f"\nMaximum absolute differences with the reference implementations ({args.n_instances} instances):")
+    for key, value in errors.items():
+        print(f"{key:<40}{value:.3e}")
+    assert all(value <= args.tolerance for value in errors.values()), \
+        "The vectorized trajectory operations do not match the reference implementations"
+    print("\nAll the trajectory operations match the reference implementations.")
+
+
+if __name__ == '__main__':
+    print("Hello!")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_instances', type=int, default=200)
+    parser.add_argument('--n_agents', type=int, default=16)
+    parser.add_argument('--past_frames', type=int, default=8)
+    parser.add_argument('--future_frames', type=int, default=12)
+    parser.add_argument('--obs_probability', type=float, default=0.5,
+                        help="probability of every timestep of the random trajectories to be observed.")
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help="maximum absolute difference with the reference implementations [m].")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--gpu', type=int, default=None,
+                        help="run the vectorized operations on a GPU (the timesteps are left on CPU).")
+    args = parser.parse_args()
+
+    main(args=args)
+    print("Goodbye!")
@@ -3,7 +3,6 @@ import os
 import os.path
 import glob
 from easydict import EasyDict
-import pandas as pd
 
 from utils.utils import recreate_dirs
 
@@ -84,6 +83,7 @@ class ModelConfig(Config):
 
         val_csv_path = os.path.join(self.model_dir, 'models.csv')
         assert os.path.exists(val_csv_path)
+        import pandas as pd
         val_csv = pd.read_csv(val_csv_path)
         val_csv = val_csv[~(val_csv == val_csv.columns).all(axis=1)]
         val_csv['val_loss'] = val_csv['val_loss'].astype(float)
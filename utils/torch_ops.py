@@ -1,8 +1,11 @@
+import copy
 import torch
 import numpy as np
 from torch.optim import lr_scheduler
 from torch import nn
 
+from typing import Dict, Iterable, Tuple
+
 tensor = torch.tensor
 DoubleTensor = torch.DoubleTensor
 FloatTensor = torch.FloatTensor
@@ -95,6 +98,91 @@ def batch_to(dst, *args):
     return [x.to(dst) if x is not None else None for x in args]
 
 
+def hand_over(x: torch.Tensor, device: torch.device) -> torch.Tensor:
+    # Hands a (DataLoader) tensor over to a model: the tensor is returned as is (without any copy) if it already lives
+    # on <device>, and is copied otherwise (asynchronously, if it resides in pinned memory).
+    # The caller gives up ownership of the tensor, and must therefore not modify it in place afterwards.
+    x = x.detach()
+    if x.device == torch.device(device):
+        return x
+    return x.to(device, non_blocking=x.is_pinned())
+
+
+def hand_over_into(buffer: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    # writes <x> into a slice of a preallocated <buffer> (asynchronously, if <x> resides in pinned memory)
+    return buffer.copy_(x.detach(), non_blocking=x.is_pinned())
+
+
+def checkpointed(function, *args):
+    # Activation checkpointing of function(*args): the intermediate activations of <function> are not kept in memory,
+    # and are instead recomputed during the backward pass.
+    # torch.utils.checkpoint (torch 1.8) only accepts positional arguments, which must contain every tensor whose
+    # gradient is needed (tensors captured by <function> do not receive any). Its outputs do not require grad unless
+    # one of its inputs does, which would silently discard the gradients of the parameters used by <function>:
+    # an empty tensor requiring grad is therefore passed along. Every output of <function> must require grad.
+    from torch.utils.checkpoint import checkpoint
+    grad_anchor = torch.empty(0, requires_grad=True)
+    return checkpoint(lambda _, *inputs: function(*inputs), grad_anchor, *args)
+
+
+def quantize_linear_layers(model: nn.Module, excluded: Tuple[str, ...] = ()) -> nn.Module:
+    # Dynamic int8 quantization of the nn.Linear layers of <model> (in place), apart from those of the submodules whose
+    # name contains any of the <excluded> strings. The weights are quantized once, and the activations on the fly, from
+    # their observed range. Quantized layers only run on CPU, and cannot be trained.
+    from torch.quantization import quantize_dynamic, default_dynamic_qconfig
+    qconfig_spec = {
+        name: default_dynamic_qconfig for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and not any(key in name for key in excluded)
+    }
+    return quantize_dynamic(model, qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+# numerical precisions in which the transformers and map CNNs of the models can be run (see cast_submodules)
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+
+
+def cast_floating_tensors(obj, dtype: torch.dtype):
+    # casts the floating point tensors of <obj> (a tensor, or nested tuples / lists / dicts of tensors) to <dtype>
+    if isinstance(obj, torch.Tensor):
+        return obj.to(dtype) if obj.is_floating_point() else obj
+    if isinstance(obj, (tuple, list)):
+        return type(obj)([cast_floating_tensors(item, dtype) for item in obj])
+    if isinstance(obj, dict):
+        cast_obj = copy.copy(obj)
+        for key, value in obj.items():
+            cast_obj[key] = cast_floating_tensors(value, dtype)
+        return cast_obj
+    return obj
+
+
+def cast_submodules(modules: Iterable[nn.Module], dtype: torch.dtype) -> None:
+    # Runs <modules> in <dtype> (in place), without autocast (torch.cpu.amp requires torch >= 1.10): their parameters
+    # and buffers are cast to <dtype>, and their forward passes cast their floating point inputs to <dtype> and their
+    # floating point outputs back to float32. The rest of the model (losses, latent distributions, homographies) thus
+    # keeps computing in float32.
+    if dtype == torch.float32:
+        return
+    for module in modules:
+        module.to(dtype)
+        module.forward = cast_forward(module.forward, dtype=dtype)
+
+
+def cast_forward(forward, dtype: torch.dtype):
+    def forward_in_dtype(*args, **kwargs):
+        output = forward(*cast_floating_tensors(args, dtype), **cast_floating_tensors(kwargs, dtype))
+        return cast_floating_tensors(output, torch.float32)
+    return forward_in_dtype
+
+
+def float32_state_dict(model: nn.Module) -> Dict:
+    # state dict of <model>, with its floating point entries in float32 (checkpoints of models run in a lower precision,
+    # see cast_submodules, can then be loaded in any precision)
+    state_dict = model.state_dict()
+    for key, value in state_dict.items():
+        state_dict[key] = cast_floating_tensors(value, torch.float32)
+    return state_dict
+
+
 def get_flat_params_from(models):
     if not hasattr(models, '__iter__'):
         models = (models, )
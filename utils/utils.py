@@ -5,11 +5,13 @@ Code borrowed from Xinshuo_PyToolbox: https://github.com/xinshuoweng/Xinshuo_PyT
 import os
 import psutil
 import shutil
+import threading
 import torch
 import numpy as np
 import random
 import time
 import copy
+import contextlib
 import glob, glob2
 from torch import nn
 
@@ -210,6 +212,16 @@ def prepare_seed(rand_seed):
     torch.cuda.manual_seed_all(rand_seed)
 
 
+SPLIT_CODES = {'train': 0, 'val': 1, 'test': 2}
+
+
+def instance_rng(rand_seed: int, split: str, index: int) -> np.random.Generator:
+    # counter-based generator, whose stream only depends on (seed, split, index):
+    # the random draws of an instance do not depend on the iteration order or on the number of worker processes.
+    seed_sequence = np.random.SeedSequence([int(rand_seed), SPLIT_CODES[split], int(index)])
+    return np.random.Generator(np.random.Philox(seed_sequence))
+
+
 def get_rand_states():
     return {'numpy': np.random.get_state(),
             'random': random.getstate(),
@@ -254,6 +266,12 @@ def print_log(print_str: str, log: TextIO, display: bool = True):
     log.flush()
 
 
+def results_name(checkpoint_name: str, quantize: bool = False, precision: str = 'fp32') -> str:
+    # name of the directory holding the predictions of a model checkpoint, run with a given inference variant
+    # (dynamic int8 quantization, or a lower precision of the transformers and map CNN)
+    return checkpoint_name + ('_int8' if quantize else '') + (f'_{precision}' if precision != 'fp32' else '')
+
+
 def memory_report(message: str, msg_len: int = 50):
     print(f"{message.ljust(msg_len)} | ", end="")
     # CPU
@@ -274,6 +292,75 @@ def memory_report(message: str, msg_len: int = 50):
         print('\tGPU: {:5.2f}/{:5.2f} GB are available'.format(gpu_total - gpu_reserved, gpu_total))
 
 
+class ResidentMemorySampler:
+    """
+    Samples the resident memory (RSS) of the process from a background thread, every <interval> seconds, and keeps
+    the peak reached between __enter__ and __exit__ (including both ends).
+    """
+
+    def __init__(self, interval: float = 1e-3):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rss(self) -> int:
+        return self.process.memory_info().rss
+
+    def sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.start = self.peak = self.rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+class PhaseMemoryTracker:
+    """
+    Records the peak memory used by the successive phases of a model's forward / inference passes, relative to the
+    memory in use when entering the phase.
+    On CUDA devices, this is the peak allocated memory of the phase minus the memory allocated at its entry.
+    On CPU (which has no allocator statistics), this is the peak resident memory of the process during the phase,
+    sampled by a background thread (see ResidentMemorySampler), minus its resident memory at the entry of the phase.
+    Values are the maxima over every call, in bytes.
+    """
+
+    def __init__(self, sampling_interval: float = 1e-3):
+        self.sampling_interval = sampling_interval      # [s]
+        self.peaks = dict()     # phase name --> bytes
+
+    @contextlib.contextmanager
+    def phase(self, name: str, device: torch.device):
+        device = torch.device(device)
+        if device.type == 'cuda':
+            start = torch.cuda.memory_allocated(device=device)
+            torch.cuda.reset_peak_memory_stats(device=device)
+            yield
+            used = torch.cuda.max_memory_allocated(device=device) - start
+        else:
+            with ResidentMemorySampler(interval=self.sampling_interval) as sampler:
+                yield
+            used = sampler.peak - sampler.start
+        self.peaks[name] = max(self.peaks.get(name, 0), used)
+
+    def report(self) -> str:
+        return ' | '.join([f'{name}: {used / 2 ** 20:.1f}MB' for name, used in self.peaks.items()])
+
+    def reset(self) -> None:
+        self.peaks = dict()
+
+
 def find_unique_common_from_lists(input_list1, input_list2, warning=True, debug=True):
     """
     find common items from 2 lists, the returned elements are unique. repetitive items will be ignored